@@ -1,23 +1,40 @@
 """Initialize the Script class."""
-from PyQt5.QtCore import Qt
+from PyQt5.QtCore import Qt, pyqtSignal
 from PyQt5.QtGui import QStandardItem, QColor
 from PyQt5.QtWidgets import QInputDialog, QLineEdit
-from .request import request, _async_request
+from .request import request, pipeline, _async_request, add_push_listener
 from .ui import UserWindow, ThreeFieldsDialog, UpdatemerchantThreeFieldsDialog
 from threading import Thread as _async
 from .lang import _
 
+# Rows fetched or shown at a time, more are loaded when scrolled to the end
+PAGE_SIZE = 100
+
 
 class Script(UserWindow):
     """The Script class."""
 
+    # Emitted from the reply reader thread with a pushed store change
+    storeChanged = pyqtSignal(object)
+
     def __init__(self):
         """Initialize the Script class."""
         self.product_data, self.user_shopping_cart_data = [], []
         self.merchant_username = ''
         self.merchant_index_data = []
+        # Store whose products are shown and subscribed to
+        self.current_store = None
+        # Local copy of the product lists, with their catalog version
+        self.store_copies = {}
+        # Cursor of the next page of merchants, None once all are shown
+        self.merchant_cursor = None
+        # Number of products of the store shown in the product table
+        self.products_shown = 0
 
         super(Script, self).__init__()
+        # Product changes pushed by the server, applied on the UI thread
+        self.storeChanged.connect(self.apply_store_change)
+        add_push_listener(self.storeChanged.emit)
         # User register
         self.user_register.pushButton.clicked.connect(self.user_register_task)
         # User login
@@ -36,6 +53,12 @@ class Script(UserWindow):
         self.index.tableView_2.clicked.connect(
             self.handle_cell_clicked_2
             )  # Clicking the add to cart button
+        self.index.tableView.verticalScrollBar().valueChanged.connect(
+            self.merchant_scrolled
+            )  # Load the next merchants at the end of the list
+        self.index.tableView_2.verticalScrollBar().valueChanged.connect(
+            self.product_scrolled
+            )  # Show the next products at the end of the list
 
         self.index.pushButton_3.clicked.connect(
             self.login_out
@@ -106,21 +129,40 @@ class Script(UserWindow):
     def index_merchant_get_data(self):
         """Retrieve data for the merchant's home page."""
         self.merchant_model.removeRows(0, self.merchant_model.rowCount())
-        queryset = [[i.tolist()[0], ] for i in request(
-            'LIST_MERCHANT'
-            )[1].values]
-        for row_index, row_data in enumerate(queryset):
-            for col_index, col_data in enumerate(row_data):
-                item = QStandardItem(str(col_data))
-                item.setTextAlignment(Qt.AlignLeft)
-                self.merchant_model.setItem(row_index, col_index, item)
+        self.merchant_cursor = None
+        self.__load_merchant_page()
+
+    def __load_merchant_page(self):
+        """Append the next page of merchants to the merchant list."""
+        response = request('LIST_MERCHANT', PAGE_SIZE, self.merchant_cursor)
+        self.merchant_cursor = response[2]
+        start = self.merchant_model.rowCount()
+        for row_index, row in enumerate(response[1].rows(), start):
+            item = QStandardItem(str(row[0]))
+            item.setTextAlignment(Qt.AlignLeft)
+            self.merchant_model.setItem(row_index, 0, item)
+
+    def merchant_scrolled(self, value):
+        """Load more merchants when the list is scrolled to its end.
+
+        Args:
+            value (int): The position of the scroll bar.
+
+        Returns:
+            None
+        """
+        scroll_bar = self.index.tableView.verticalScrollBar()
+        if value == scroll_bar.maximum() and self.merchant_cursor is not None:
+            self.__load_merchant_page()
 
     def user_shopping_cart_get_data(self):
         """Retrieve data for the user's shopping cart."""
         self.user_shopping_cart_model.removeRows(
             0, self.user_shopping_cart_model.rowCount()
             )
-        queryset = [i.tolist() for i in request('CLIENT_GET_ITEMS')[1].values]
+        # Fetch the items and the total price with a single query
+        cart = request('CLIENT_GET_CART')
+        queryset = cart[1].rows()
         queryset = list(map(
             lambda i: [
                 i[4], i[0], i[1], i[2], f'{i[3]:.2f}', 'Delete'
@@ -138,9 +180,7 @@ class Script(UserWindow):
                 if col_index == 5:
                     item.setForeground(QColor(Qt.red))
         self.user_shopping_cart.label.setText(
-            _('Total amount:') + "{}:.2f".format(
-                request("CLIENT_GET_PRICE")[1]
-                )
+            _('Total amount:') + "{}:.2f".format(cart[2])
                 )
 
     def user_shopping_cart_task(self):
@@ -171,19 +211,120 @@ class Script(UserWindow):
     def handle_cell_clicked(self, index):
         """Handle cell click events on the home page."""
         value = index.data(Qt.DisplayRole)
-        queryset = [i.tolist() for i in request(
-            'LIST_PRODUCT', value)[1].values]
-        queryset = list(map(lambda i: [
-            i[0], i[2], f'{i[4]:.2f}', i[5], i[3],
-            _('Add to cart')], queryset))
-        self.product_data = queryset
-        for row_index, row_data in enumerate(queryset):
+        queryset = self.__apply_store_sync(
+            value, request(*self.__store_sync_request(value))
+            )
+        self.product_data = [self.__product_row(i) for i in queryset]
+        self.__show_products()
+        # Receive the stock changes instead of listing the store again
+        if value != self.current_store:
+            if self.current_store is not None:
+                _async_request('UNSUBSCRIBE_STORE', self.current_store)
+            _async_request('SUBSCRIBE_STORE', value)
+            self.current_store = value
+
+    def __store_sync_request(self, storename):
+        """Build the request for the products changed since the local copy.
+
+        Args:
+            storename (str): The name of the store.
+
+        Returns:
+            tuple: The command and arguments of the request.
+        """
+        copy = self.store_copies.get(storename)
+        return ('LIST_PRODUCT_SINCE', storename, copy[0] if copy else 0)
+
+    def __apply_store_sync(self, storename, response):
+        """Apply the reply of a sync request to the local copy of a store.
+
+        Args:
+            storename (str): The name of the store.
+            response (list): The reply to LIST_PRODUCT_SINCE.
+
+        Returns:
+            list: The products of the store, ordered by product id.
+        """
+        table, deleted, version, full = response[1:5]
+        products = {} if full else self.store_copies[storename][1]
+        for product_id in deleted:
+            products.pop(product_id, None)
+        for row in table.rows():
+            products[row[0]] = row
+        self.store_copies[storename] = (version, products)
+        return [products[key] for key in sorted(products)]
+
+    def __product_row(self, i):
+        """Format a product of a listing for the product table."""
+        return [i[0], i[2], f'{i[4]:.2f}', i[5], i[3], _('Add to cart')]
+
+    def __show_products(self, count=PAGE_SIZE):
+        """Fill the product table with the first products of the store.
+
+        Args:
+            count (int): The number of products shown, the others are shown
+                when the table is scrolled to its end.
+        """
+        self.product_model.setRowCount(0)
+        self.products_shown = 0
+        self.__show_more_products(count)
+
+    def __show_more_products(self, count):
+        """Append the next products of the store to the product table.
+
+        Args:
+            count (int): The number of products appended.
+        """
+        start = self.products_shown
+        rows = self.product_data[start:start + count]
+        for row_index, row_data in enumerate(rows, start):
             for col_index, col_data in enumerate(row_data):
                 item = QStandardItem(str(col_data))
                 item.setTextAlignment(Qt.AlignCenter)
                 if col_index == 5:
                     item.setForeground(QColor(Qt.blue))
                 self.product_model.setItem(row_index, col_index, item)
+        self.products_shown = start + len(rows)
+
+    def product_scrolled(self, value):
+        """Show more products when the table is scrolled to its end.
+
+        Args:
+            value (int): The position of the scroll bar.
+
+        Returns:
+            None
+        """
+        scroll_bar = self.index.tableView_2.verticalScrollBar()
+        if value == scroll_bar.maximum() and \
+                self.products_shown < len(self.product_data):
+            self.__show_more_products(PAGE_SIZE)
+
+    def apply_store_change(self, message):
+        """Apply the product changes pushed by the server.
+
+        Args:
+            message (list): The push message, with the store name and the
+                table of the changed products.
+
+        Returns:
+            None
+        """
+        copy = self.store_copies.get(message[1])
+        if copy is None:
+            return
+        products = copy[1]
+        for change in message[2].rows():
+            if change[6]:
+                products.pop(change[0], None)
+            else:
+                products[change[0]] = change[:6]
+        if message[1] == self.current_store:
+            self.product_data = [
+                self.__product_row(products[key]) for key in sorted(products)
+                ]
+            # Keep the products already scrolled to
+            self.__show_products(max(self.products_shown, PAGE_SIZE))
 
     def user_register_task(self):
         """Process user registration."""
@@ -235,9 +376,11 @@ class Script(UserWindow):
         self.merchant_shouye_model.removeRows(
             0, self.merchant_shouye_model.rowCount()
             )
-        queryset = [i.tolist() for i in request(
-            'LIST_PRODUCT', self.merchant_username
-            )[1].values]
+        products, profit = pipeline(
+            self.__store_sync_request(self.merchant_username),
+            ('MERCHANT_GET_PROFIT',)
+            )
+        queryset = self.__apply_store_sync(self.merchant_username, products)
         queryset = list(map(lambda i: [
             i[0], i[1], i[2], i[3], f'{i[4]:.2f}',
             i[5], 'Replenishment', 'Delete'
@@ -254,9 +397,7 @@ class Script(UserWindow):
                 elif col_index == 7:
                     item.setForeground(QColor(Qt.red))
         self.merchant_shouye.label.setText(
-            'Total profit: ' + '{}:.2f'.format(
-                request("MERCHANT_GET_PROFIT")[1]
-                )
+            'Total profit: ' + '{}:.2f'.format(profit[1])
             )
 
     def rimborso_o_cancellazione(self, index):
@@ -327,8 +468,14 @@ class Script(UserWindow):
         Raises:
             None.
         """
-        request('SET_MERCHANT_STORENAME', value_a)
-        request('SET_MERCHANT_PASSWORD', value_b, value_b)
-        request('SET_MERCHANT_EMAIL', value_c)
-        request('SET_MERCHANT_DESCRIPTION', value_d)
-        self.pop_frame('200 OK')
+        # Apply every field in a single round trip. Each one is kept or
+        # refused on its own, as the dialog has no current password to
+        # check the new one against
+        response = request(
+            'BATCH', 'EACH',
+            ('SET_MERCHANT_STORENAME', value_a),
+            ('SET_MERCHANT_PASSWORD', value_b, value_b),
+            ('SET_MERCHANT_EMAIL', value_c),
+            ('SET_MERCHANT_DESCRIPTION', value_d)
+            )[0]
+        self.pop_frame(response)
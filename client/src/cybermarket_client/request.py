@@ -1,14 +1,21 @@
 """Function that interact with the server."""
 import socket
-import pickle
+import itertools
 import time
+from concurrent.futures import Future
 from PyQt5.QtWidgets import QMessageBox
 from loguru import logger
-from threading import Thread as AsyncThread
-from .settings import TITLE, SERVER_HOST, SERVER_PORT
+from threading import Thread as AsyncThread, Lock
+from .settings import TITLE, SERVER_HOST, SERVER_PORT, REQUEST_TIMEOUT, \
+    HEARTBEAT_INTERVAL
+from .protocol import FrameDecoder, encode_frame
+from .codec import CODECS, encode_hello, parse_hello
 from .ui import CustomMessageBox
 from .lang import _
 
+# Request id of the messages pushed by the server
+PUSH = 'PUSH'
+
 
 def pop_frame(msg):
     """Display a frame with a message.
@@ -28,6 +35,238 @@ def pop_frame(msg):
     msg_box.exec_()
 
 
+class Connection:
+    """Persistent connection to the server shared by all requests.
+
+    Requests are written as soon as they are submitted, without waiting
+    for earlier replies. A background thread reads the replies and hands
+    each one to the caller waiting for its request id, so replies may
+    arrive in any order.
+
+    When connecting, the client offers the codecs of `CODECS` with the
+    compact binary one first, and uses the one chosen by the server.
+
+    Messages pushed by the server, whose request id is `PUSH`, are handed
+    to the push listeners on the reader thread.
+
+    The server closes idle connections, so a heartbeat thread sends a
+    `PING` when no request was sent for `HEARTBEAT_INTERVAL` seconds, to
+    keep receiving the pushes of the subscriptions.
+    """
+
+    def __init__(self, host, port):
+        """Initialize a connection that is opened on first use.
+
+        Args:
+            host (str): Address of the server.
+            port (int): Port of the server.
+        """
+        self.host = host
+        self.port = port
+        self.socket = None
+        self.codec = None
+        self.pending = {}
+        self.lock = Lock()
+        self.ids = itertools.count(1)
+        self.push_listeners = []
+        self.last_sent = time.monotonic()
+
+    def _open(self):
+        """Connect, negotiate the codec and start the reply reader thread."""
+        client_socket = socket.create_connection((self.host, self.port))
+        decoder = FrameDecoder()
+        try:
+            client_socket.sendall(encode_frame(encode_hello(list(CODECS))))
+            frames = []
+            while not frames:
+                data = client_socket.recv(65536)
+                if not data:
+                    raise ConnectionError(
+                        _('The server closed the connection')
+                        )
+                frames = decoder.feed(data)
+            chosen = parse_hello(frames[0])
+            if not chosen or chosen[0] not in CODECS:
+                raise ConnectionError(_('The server chose no known codec'))
+        except Exception:
+            client_socket.close()
+            raise
+        self.codec = CODECS[chosen[0]]
+        self.socket = client_socket
+        AsyncThread(
+            target=self._read_replies, args=(client_socket, decoder),
+            daemon=True
+            ).start()
+        AsyncThread(
+            target=self._heartbeat, args=(client_socket,), daemon=True
+            ).start()
+
+    def _heartbeat(self, client_socket):
+        """Send a PING on the socket whenever it is idle, until it closes.
+
+        Args:
+            client_socket (socket.socket): The socket to keep open.
+        """
+        while self.socket is client_socket:
+            idle = time.monotonic() - self.last_sent
+            if idle < HEARTBEAT_INTERVAL:
+                time.sleep(HEARTBEAT_INTERVAL - idle)
+                continue
+            try:
+                self.submit(('PING',))
+            except Exception as e:
+                logger.warning(f'Heartbeat failed: {e}')
+                return
+
+    def _read_replies(self, client_socket, decoder):
+        """Route every reply received on the socket to its waiting caller.
+
+        Args:
+            client_socket (socket.socket): The socket to read from.
+            decoder (FrameDecoder): Decoder holding already received bytes.
+        """
+        codec = self.codec
+        try:
+            while True:
+                data = client_socket.recv(65536)
+                if not data:
+                    raise ConnectionError(
+                        _('The server closed the connection')
+                        )
+                for frame in decoder.feed(data):
+                    response = codec.decode(frame)
+                    request_id = str(response[0]).split(' ', 1)[0]
+                    if request_id == PUSH:
+                        for listener in list(self.push_listeners):
+                            listener(response)
+                        continue
+                    with self.lock:
+                        future = self.pending.pop(request_id, None)
+                    if future:
+                        future.set_result(response)
+                    else:
+                        logger.warning(f'Unexpected response: {response}')
+        except Exception as e:
+            self._fail(client_socket, e)
+
+    def _fail(self, client_socket, error):
+        """Abort all requests waiting on a broken socket.
+
+        Args:
+            client_socket (socket.socket): The socket that failed.
+            error (Exception): The error reported to the waiting callers.
+        """
+        with self.lock:
+            if self.socket is not client_socket:
+                return
+            self.socket = None
+            pending, self.pending = self.pending, {}
+        client_socket.close()
+        for future in pending.values():
+            future.set_exception(error)
+
+    def forget(self, future):
+        """Stop waiting for the reply of a request, e.g. after a timeout.
+
+        A reply received later is logged as unexpected and dropped.
+
+        Args:
+            future (Future): The future returned by `submit`.
+        """
+        with self.lock:
+            if self.pending.get(future.request_id) is future:
+                del self.pending[future.request_id]
+
+    def submit(self, *messages):
+        """Send one or more requests without waiting for their replies.
+
+        Args:
+            *messages: Tuples of a command followed by its arguments.
+
+        Returns:
+            list: One Future per message, resolved with the reply.
+        """
+        futures, frames = [], []
+        with self.lock:
+            if self.socket is None:
+                self._open()
+            client_socket = self.socket
+            for cmd, *args in messages:
+                request_id = str(next(self.ids))
+                message = (cmd, request_id, *args)
+                logger.debug(f'Request parameters: {message}')
+                future = Future()
+                future.request_id = request_id
+                self.pending[request_id] = future
+                futures.append(future)
+                frames.append(encode_frame(self.codec.encode(message)))
+            self.last_sent = time.monotonic()
+            try:
+                client_socket.sendall(b''.join(frames))
+            except OSError as e:
+                error = e
+            else:
+                return futures
+        self._fail(client_socket, error)
+        return futures
+
+
+_connection = Connection(SERVER_HOST, SERVER_PORT)
+
+
+def add_push_listener(callback):
+    """Call a function with every message pushed by the server.
+
+    The function is called on the thread reading the replies, so it must
+    not touch the user interface directly.
+
+    Args:
+        callback (callable): Called with the pushed message.
+
+    Returns:
+        None
+    """
+    _connection.push_listeners.append(callback)
+
+
+def pipeline(*messages, **kwargs):
+    """Send several requests at once and wait for all their replies.
+
+    The requests travel to the server back to back, so a page that needs
+    several pieces of data pays for a single round trip. The server may
+    process them concurrently, so they must not depend on each other.
+
+    Args:
+        *messages: Tuples of a command followed by its arguments.
+        **kwargs: Additional keyword arguments:
+            - pop_frame (bool): Whether to display a frame with messages.
+
+    Returns:
+        list: The responses from the server, in the order of the requests.
+    """
+    responses = []
+    try:
+        futures = _connection.submit(*messages)
+    except Exception as e:
+        logger.error(f'{e}')
+        futures = []
+        responses = [f'{e}'] * len(messages)
+    for future in futures:
+        try:
+            response = future.result(timeout=REQUEST_TIMEOUT)
+            logger.success(f'Server response: {response}')
+            if kwargs.get('pop_frame'):
+                pop_frame(response[0])
+        except Exception as e:
+            # Do not keep the request of a reply that timed out
+            _connection.forget(future)
+            logger.error(f'{e}')
+            response = f'{e}'
+        responses.append(response)
+    logger.info('-' * 80)
+    return responses
+
+
 def request(cmd, *args, **kwargs):
     """Encapsulate a request to the server and handle the response.
 
@@ -40,25 +279,7 @@ def request(cmd, *args, **kwargs):
     Returns:
         str: The response from the server.
     """
-    client_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-    try:
-        client_socket.connect((SERVER_HOST, SERVER_PORT))
-        message = (cmd, str(int(time.time())), *args)
-        logger.debug(f'Request parameters: {message}')
-        client_socket.sendall(pickle.dumps(message))
-        response = pickle.loads(client_socket.recv(2048))
-        logger.success(f'Server response: {response}')
-        if kwargs.get('pop_frame'):
-            pop_frame(response[0])
-
-    except Exception as e:
-        logger.error(f'{e}')
-        response = f'{e}'
-
-    finally:
-        client_socket.close()
-    logger.info('-' * 80)
-    return response
+    return pipeline((cmd, *args), **kwargs)[0]
 
 
 def _async_request(cmd, *args, pop_frame=False):
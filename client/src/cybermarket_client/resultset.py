@@ -0,0 +1,53 @@
+"""Tables received from the server."""
+
+
+class ResultSet:
+    """Table of query results stored column by column.
+
+    The binary codec decodes tables straight into this class, so the
+    client does not need pandas to read a listing.
+    """
+
+    def __init__(self, columns, data):
+        """Initialize the table.
+
+        Args:
+            columns (list): The column names.
+            data (list): One sequence of values per column.
+        """
+        self.columns = list(columns)
+        self.data = list(data)
+
+    def __len__(self):
+        """Return the number of rows."""
+        return len(self.data[0]) if self.data else 0
+
+    def column(self, name):
+        """Return the values of a column.
+
+        Args:
+            name (str): The column name.
+
+        Returns:
+            Sequence of the column values.
+        """
+        return self.data[self.columns.index(name)]
+
+    def rows(self):
+        """Return the table as a list of rows.
+
+        Returns:
+            list: One list of values per row.
+        """
+        return [list(row) for row in zip(*self.data)]
+
+    def to_dataframe(self):
+        """Convert the table to a pandas DataFrame.
+
+        Returns:
+            pandas.DataFrame: The same data, with the same column names.
+        """
+        import pandas as pd
+        return pd.DataFrame(
+            dict(zip(self.columns, self.data)), columns=self.columns
+            )
@@ -19,3 +19,8 @@ index = os.path.join(STATIC_DIR, 'index.ui')
 TITLE = _('Cybermarket')
 SERVER_HOST = '127.0.0.1'
 SERVER_PORT = 22333
+# Seconds to wait for the reply to a request
+REQUEST_TIMEOUT = 30
+# Seconds without requests before an idle connection is kept open with a
+# PING, below the idle timeout of the server
+HEARTBEAT_INTERVAL = 60
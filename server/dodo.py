@@ -2,6 +2,12 @@
 Default: create wheel
 '''
 import glob
+import os
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
 from doit.tools import create_folder
 
 DOIT_CONFIG = {'default_tasks': ['setup']}
@@ -102,6 +108,81 @@ def task_test():
     }
 
 
+def find_postgresql_tool(name):
+    """Find a PostgreSQL server program, also outside of the PATH."""
+    found = shutil.which(name)
+    if found:
+        return found
+    # Debian and Ubuntu keep them in a directory per version
+    candidates = sorted(glob.glob(
+        '/usr/lib/postgresql/*/bin/{}'.format(name)))
+    if candidates:
+        return candidates[-1]
+    raise RuntimeError(
+        '{} not found, install PostgreSQL or set '
+        'CYBERMARKET_TEST_DATABASE_URL'.format(name))
+
+
+def free_port():
+    """Return a TCP port nobody listens on."""
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+def run_tests_on_postgresql():
+    """Run the tests on a throwaway PostgreSQL server."""
+    initdb = find_postgresql_tool('initdb')
+    pg_ctl = find_postgresql_tool('pg_ctl')
+    with tempfile.TemporaryDirectory(prefix='cybermarket_pg_') as directory:
+        data = os.path.join(directory, 'data')
+        port = free_port()
+        subprocess.run(
+            [initdb, '-D', data, '-U', 'cybermarket', '--auth=trust',
+             '-E', 'UTF8'],
+            check=True, stdout=subprocess.DEVNULL
+            )
+        subprocess.run(
+            [pg_ctl, '-D', data, '-w', '-l',
+             os.path.join(directory, 'server.log'),
+             '-o', "-k {} -p {} -c listen_addresses=''".format(
+                 directory, port),
+             'start'],
+            check=True, stdout=subprocess.DEVNULL
+            )
+        try:
+            url = 'postgresql+psycopg://cybermarket@/postgres' \
+                '?host={}&port={}'.format(directory, port)
+            print('Testing on', url)
+            return run_tests_on(url)
+        finally:
+            subprocess.run(
+                [pg_ctl, '-D', data, '-m', 'fast', '-w', 'stop'],
+                stdout=subprocess.DEVNULL
+                )
+
+
+def run_tests_on(url):
+    """Run the tests on the database of a SQLAlchemy URL."""
+    env = dict(os.environ, CYBERMARKET_TEST_DATABASE_URL=url)
+    result = subprocess.run(
+        [sys.executable, '-m', 'unittest', '-v', './tests/unit_test.py'],
+        env=env
+        )
+    return result.returncode == 0
+
+
+def task_test_backend():
+    """Preform tests on a database server, a temporary PostgreSQL one."""
+    url = os.getenv('CYBERMARKET_TEST_DATABASE_URL')
+    action = (run_tests_on, [url]) if url else run_tests_on_postgresql
+    return {
+        'actions': [action],
+        'task_dep': ['mo'],
+        'verbosity': 2
+    }
+
+
 def task_check():
     """Perform all checks."""
     return {
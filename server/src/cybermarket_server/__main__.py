@@ -3,16 +3,96 @@ This module provides an asynchronous server for handling client requests.
 
 The server listens on a local port and asynchronously processes requests.
 It maintains a connection list and associated message handling queues.
+Messages are exchanged as length-prefixed frames (see `protocol`) and
+serialized with the codec negotiated by the client (see `codec`).
 
 Functions:
+    process_request(connect, cmd, request_id, *args): Run one request.
+    write_replies(writer, outbox, codec): Send the queued messages.
+    deliver(loop, connect, message): Queue a push message for a connection.
     handle_client(reader, writer): Asynchronously handle client connections.
-    main(): Start the server and listen for incoming connections.
+    main(sock, index): Start the server and listen for incoming connections.
+    prepare_database(): Upgrade the database before serving.
+    run_server(coro): Run the server on the configured event loop.
+    serve_worker(sock, index): Run the server in a worker process.
 """
 import asyncio
-import pickle
-from .cmd_process import cmd_process
+import signal
+import socket
+from .catalog import catalog
+from .config import ServerConfig, load_config, create_listener
+from .config import event_loop_factory
+from .cmd_process import release_connection, release_all_connections
+from .cmd_process import too_many_requests
+from .codec import LEGACY_CODEC, encode_hello, parse_hello, negotiate
+from .inventory import sweep_reservations
+from .migration import migrate
+from .notify import hub
+from .outbox import Outbox
+from .protocol import FrameDecoder, ProtocolError, encode_frame
+from .ratelimit import RateLimiter, principal, request_commands
+from .setting import engine, WORKERS, WORKER_BACKLOG, RESERVATION_TTL
+from .setting import SQLITE_PROFILE, sqlite_pragmas
+from .supervisor import Supervisor
+from .worker import WorkerPool, run_in_session
+
+# Runtime settings, read from the command line when run as a program
+config = ServerConfig()
 
 connect_list = {}
+# Writers of the connections by their task, closed when the server stops
+clients = {}
+# Runs the database work of the requests off the event loop
+pool = WorkerPool(WORKERS, WORKER_BACKLOG)
+# Token buckets of the connections and users, see `ratelimit`
+limiter = RateLimiter()
+
+
+async def process_request(connect, cmd, request_id, *args):
+    """
+    Run one request and queue its reply for the connection.
+
+    Every reply starts with the request id, so the client can match the
+    replies of pipelined requests even if they are not sent in order.
+    A request whose handler raises is answered with a 500.
+
+    Args:
+        connect (str): The address of the connection making the request.
+        cmd (str): The command to be processed.
+        request_id (str): The unique identifier for the request.
+        args: Additional arguments of the command.
+    """
+    try:
+        result = await pool.run(cmd, request_id, connect, *args)
+    except Exception as error:
+        # The changes were rolled back, the client still gets its reply
+        print(f"{connect} {cmd} {request_id} failed: {error!r}")
+        result = [str(request_id) + " 500 Internal Server Error"]
+    await connect_list[connect].put(result)
+
+
+async def write_replies(writer, outbox, codec):
+    """
+    Send the messages queued for a connection until its outbox closes.
+
+    All the messages waiting are encoded and written at once, and the
+    writer only waits for the socket once more than `write_high_water`
+    bytes are buffered, instead of after every reply.
+
+    Args:
+        writer (StreamWriter): The stream writer of the connection.
+        outbox (Outbox): The messages to send.
+        codec (Codec): The codec negotiated by the connection.
+    """
+    while True:
+        messages = await outbox.take()
+        if not messages:
+            return
+        writer.writelines(
+            [encode_frame(codec.encode(message)) for message in messages])
+        if writer.transport.get_write_buffer_size() > \
+                config.write_high_water:
+            await writer.drain()
 
 
 # Run request handler asynchronously
@@ -28,57 +108,274 @@ async def handle_client(reader, writer):
         writer (StreamWriter): The stream writer object.
     """
     connect = "{}:{}".format(*writer.get_extra_info('peername'))
-    # Bind the user's pending queue and connection address through a dictionary
-    connect_list[connect] = asyncio.Queue()
+    if 0 < config.max_connections <= len(connect_list):
+        print(f"{connect} Refused, {len(connect_list)} connections open")
+        writer.close()
+        return
+    clients[asyncio.current_task()] = writer
+    sock = writer.get_extra_info('socket')
+    if sock is not None:
+        # asyncio enables it by default, it can be turned off to batch
+        # small writes in fewer packets
+        sock.setsockopt(
+            socket.IPPROTO_TCP, socket.TCP_NODELAY, int(config.tcp_nodelay))
+    # Bind the user's pending messages and connection address through a
+    # dictionary
+    outbox = connect_list[connect] = Outbox(
+        config.send_queue, config.slow_consumer)
+    # drain() waits from this size until the buffer is back to a quarter
+    writer.transport.set_write_buffer_limits(high=config.write_high_water)
     print(f"{connect} Connected")
+    loop = asyncio.get_running_loop()
+    # Reassemble length-prefixed frames from the incoming byte stream
+    decoder = FrameDecoder()
+    # Chosen by the first frame, either a hello or a legacy request
+    codec = None
+    # Requests that are still being processed
+    pending = set()
     cmd = ''
-    # Create two asynchronous tasks to send and receive
-    send = asyncio.create_task(reader.read(4096))
-    receive = asyncio.create_task(connect_list[connect].get())
-    # Disconnect when user requests end of service
-    while cmd != 'DISCONNECT':
-        # If one of the sending and receiving tasks is completed, process first
-        requests, _ = await asyncio.wait(
-            [send, receive],
-            return_when=asyncio.FIRST_COMPLETED)
-        for request in requests:
-            if request is send:
-                send = asyncio.create_task(reader.read(4096))
-                # Decode the request type and request id
-                cmd, request_id, *args = pickle.loads(request.result())
-                # Pass parameters to the request processing function
-                # Wait for processing to complete
-                result = cmd_process(cmd, request_id,
-                                     connect, *args)
-                await connect_list[connect].put(result)
-            elif request is receive:
-                receive = asyncio.create_task(connect_list[connect].get())
-                # Send the results in the queue to be sent to the client
-                writer.write(pickle.dumps(request.result()))
-                await writer.drain()
-    send.cancel()
-    receive.cancel()
-    print(connect, "DONE")
-    del connect_list[connect]
-    writer.close()
-    await writer.wait_closed()
-
-
-# Start service(handle_client) on local port 127.0.0.1:22333
-async def main():
+    # Read the requests here, and write the replies in their own task,
+    # started once the codec is known
+    send = asyncio.create_task(reader.read(config.read_size))
+    writing = None
+    # Time of the last bytes received, for the timeouts
+    last_received = loop.time()
+    # Whether the queued messages can still be sent when closing
+    graceful = False
+    try:
+        # Disconnect when user requests end of service
+        while cmd != 'DISCONNECT':
+            last_activity = max(last_received, outbox.last_sent)
+            timeout = None
+            if decoder.buffer and config.read_timeout > 0:
+                # A frame has started, the rest of it must follow
+                timeout = config.read_timeout
+            elif not pending and config.idle_timeout > 0:
+                timeout = config.idle_timeout
+            if timeout is not None:
+                timeout = max(0, last_activity + timeout - loop.time())
+            # If one of the sending and receiving tasks is completed,
+            # process first
+            requests, _ = await asyncio.wait(
+                [task for task in (send, writing) if task is not None],
+                timeout=timeout, return_when=asyncio.FIRST_COMPLETED)
+            if not requests:
+                if outbox.last_sent > last_activity:
+                    # Replies were sent meanwhile
+                    continue
+                print(f"{connect} Timed out")
+                break
+            if writing in requests:
+                # Raises if the connection was lost while writing
+                writing.result()
+                print(f"{connect} Too slow, disconnected")
+                break
+            for request in requests:
+                if request is send:
+                    data = request.result()
+                    # An empty read means the peer closed the connection
+                    if not data:
+                        cmd = 'DISCONNECT'
+                        break
+                    last_received = loop.time()
+                    send = asyncio.create_task(reader.read(config.read_size))
+                    # One read may carry several frames, or only part of one
+                    for frame in decoder.feed(data):
+                        if codec is None:
+                            offered = parse_hello(frame)
+                            if offered is None:
+                                codec = LEGACY_CODEC
+                            else:
+                                codec = negotiate(offered)
+                                writer.write(encode_frame(
+                                    encode_hello([codec.name])))
+                            writing = asyncio.create_task(
+                                write_replies(writer, outbox, codec))
+                            if offered is not None:
+                                continue
+                        # Decode the request type and request id
+                        cmd, request_id, *args = codec.decode(frame)
+                        if cmd == 'PING':
+                            # Heartbeat, answered without the worker pool
+                            await outbox.put([str(request_id) + " 200 OK"])
+                            continue
+                        if not limiter.allow(
+                                config, connect, principal(connect),
+                                request_commands(cmd, args)):
+                            await outbox.put(
+                                too_many_requests(request_id, connect))
+                            continue
+                        # Stop reading while the worker pool is saturated
+                        await pool.admit()
+                        # Process the request in its own task, so the next
+                        # request can be read before this one is answered
+                        task = asyncio.create_task(process_request(
+                            connect, cmd, request_id, *args))
+                        pending.add(task)
+                        task.add_done_callback(pending.discard)
+                        task.add_done_callback(lambda _: pool.release())
+                        if cmd == 'DISCONNECT':
+                            break
+        graceful = not outbox.closed
+    except (ConnectionError, ProtocolError) as error:
+        print(f"{connect} Connection lost: {error}")
+    except Exception as error:
+        # A request that cannot be decoded ends its connection only
+        print(f"{connect} Closed on error: {error!r}")
+    finally:
+        send.cancel()
+        if not graceful:
+            # Nothing more can be sent, do not let the requests wait
+            outbox.close()
+        # Let the requests already received finish before closing
+        await asyncio.gather(*pending, return_exceptions=True)
+        outbox.close(discard=False)
+        if writing is not None:
+            try:
+                # Send the last replies, unless the client stopped reading
+                await asyncio.wait_for(writing, config.read_timeout or None)
+            except Exception:
+                pass
+        if outbox.dropped:
+            print(f"{connect} Dropped {outbox.dropped} push messages")
+        limiter.forget(connect)
+        # Log out whoever was logged in on this connection
+        await pool.call(release_connection, connect)
+        print(connect, "DONE")
+        del connect_list[connect]
+        clients.pop(asyncio.current_task(), None)
+        writer.close()
+        try:
+            await writer.wait_closed()
+        except ConnectionError:
+            pass
+
+
+def deliver(loop, connect, message):
+    """
+    Queue a push message for a connection from any thread.
+
+    With the `block` slow consumer policy, a thread other than the one
+    of the event loop waits until the message is queued.
+
+    Args:
+        loop (AbstractEventLoop): The event loop of the server.
+        connect (str): The address of the connection.
+        message (list): The message to send.
+    """
+    async def put():
+        outbox = connect_list.get(connect)
+        if outbox is not None:
+            await outbox.put(message)
+
+    def push():
+        outbox = connect_list.get(connect)
+        if outbox is not None:
+            outbox.push(message)
+    try:
+        on_loop = asyncio.get_running_loop() is loop
+    except RuntimeError:
+        on_loop = False
+    if config.slow_consumer == 'block' and not on_loop:
+        # Hold the committing thread until the connection has room
+        asyncio.run_coroutine_threadsafe(put(), loop).result()
+    else:
+        loop.call_soon_threadsafe(push)
+
+
+async def main(sock=None, index=0):
     """
     Start the server and listen for incoming connections.
 
-    This coroutine sets up the server on a local port,
-    starts listening for incoming connections, and handles them
-    using the `handle_client` coroutine.
+    This coroutine upgrades the database schema, sets up the server on
+    a local port, starts listening for incoming connections, and handles
+    them using the `handle_client` coroutine. It runs until SIGTERM or
+    until cancelled, then closes the connections before the worker pool.
+
+    Args:
+        sock (socket): The listening socket shared by the worker
+            processes, None to bind one and run in a single process.
+        index (int): The index of the worker process. The first one
+            also releases the expired reservations.
     """
-    server = await asyncio.start_server(handle_client, '127.0.0.1', 22333)
+    if sock is None:
+        prepare_database()
+        sock = create_listener(config)
+    loop = asyncio.get_running_loop()
+    hub.attach(lambda connect, message: deliver(loop, connect, message))
+    if engine.dialect.name == 'sqlite' and engine.url.database != ':memory:':
+        pragmas = sqlite_pragmas(SQLITE_PROFILE)
+        print(f'SQLite profile {SQLITE_PROFILE}: ' + ', '.join(
+            f'{name}={value}' for name, value in pragmas.items()))
+    sweeper = None
+    if RESERVATION_TTL > 0 and index == 0:
+        print(f'Cart reservations expire after {RESERVATION_TTL}s')
+        sweeper = asyncio.create_task(sweep_reservations(pool))
+    stopped = loop.create_future()
+
+    def stop():
+        if not stopped.done():
+            stopped.set_result(None)
+    try:
+        # Stop with the cleanup below on SIGTERM, as sent by the supervisor
+        loop.add_signal_handler(signal.SIGTERM, stop)
+    except NotImplementedError:
+        # Signal handlers are not supported by the event loops of Windows
+        pass
+    server = await asyncio.start_server(handle_client, sock=sock)
     print('Service started')
-    async with server:
-        await server.serve_forever()
+    try:
+        await stopped
+    finally:
+        server.close()
+        # Close the connections, and wait for them to log out their users
+        for writer in clients.values():
+            writer.close()
+        await asyncio.gather(*clients, return_exceptions=True)
+        if sweeper is not None:
+            sweeper.cancel()
+        hub.attach(None)
+        pool.shutdown()
+        print('Catalog cache', catalog.stats())
+
+
+def prepare_database():
+    """Upgrade the database and forget the logins of a previous run."""
+    migrate(engine)
+    run_in_session(release_all_connections)
+
+
+def serve_worker(sock, index):
+    """
+    Run the server in a worker process of the supervisor.
+
+    Args:
+        sock (socket): The listening socket shared by the processes.
+        index (int): The index of the worker process.
+    """
+    run_server(main(sock, index))
+
+
+def run_server(coro):
+    """
+    Run the server on the event loop chosen by the settings.
+
+    Args:
+        coro (coroutine): The coroutine running the server.
+    """
+    name, loop_factory = event_loop_factory(config)
+    with asyncio.Runner(loop_factory=loop_factory) as runner:
+        runner.run(coro)
 
 
 # Run the main program asynchronously
 if __name__ == "__main__":
-    asyncio.run(main())
+    config = load_config()
+    print('Server settings: ' + config.describe())
+    print('Event loop: ' + event_loop_factory(config)[0])
+    if config.processes > 1:
+        prepare_database()
+        Supervisor(config.processes, serve_worker).run(
+            create_listener(config))
+    else:
+        run_server(main())
@@ -0,0 +1,197 @@
+"""
+Cache the catalog tables read by the listing commands.
+
+Browsing the stores is far more frequent than changing them, so the
+merchant list and the product list of each store are kept in memory once
+read. The handlers that change the catalog name the entries they make
+stale with `invalidate_on_commit`, and the entries are dropped when the
+transaction commits.
+
+Classes:
+    CatalogCache: Bounded read-through cache with LRU eviction.
+
+Functions:
+    products_key(storename): Return the key of the product list of a store.
+    invalidate_on_commit(session, *keys): Drop entries once committed.
+"""
+import threading
+from collections import OrderedDict
+from sqlalchemy import event
+from .setting import Session, CATALOG_CACHE_SIZE
+
+# Key of the merchant list
+MERCHANTS = ('merchants',)
+
+
+def products_key(storename):
+    """
+    Return the key of the product list of a store.
+
+    Args:
+        storename (str): The name of the store.
+
+    Returns:
+        tuple: The cache key.
+    """
+    return ('products', storename)
+
+
+class CatalogCache:
+    """
+    Bounded read-through cache with LRU eviction.
+
+    Every invalidation increases a generation counter. A value loaded
+    while an invalidation happened may predate the change, so it is
+    returned but not stored.
+
+    When the server runs several processes, their caches share a counter
+    of invalidations, see `share`. A process that finds the counter
+    increased by another one drops all its entries, since it does not
+    know which ones are stale.
+
+    Attributes:
+        maxsize (int): The number of entries kept, 0 disables the cache.
+        hits (int): The number of reads served from the cache.
+        misses (int): The number of reads that had to load the value.
+    """
+
+    def __init__(self, maxsize):
+        """
+        Initialize an empty cache.
+
+        Args:
+            maxsize (int): The number of entries kept.
+        """
+        self.maxsize = maxsize
+        self.entries = OrderedDict()
+        self.generation = 0
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+        self.shared = None
+        self.seen = 0
+
+    def share(self, counter):
+        """
+        Invalidate this cache together with the caches of other processes.
+
+        Args:
+            counter (multiprocessing.Value): The counter of invalidations,
+                an unsigned integer created before the processes forked.
+        """
+        with self.lock:
+            self.shared = counter
+            self.seen = counter.value
+
+    def _sync(self):
+        """Drop every entry if another process invalidated its cache."""
+        if self.shared is not None and self.shared.value != self.seen:
+            self.seen = self.shared.value
+            self.generation += 1
+            self.entries.clear()
+
+    def _announce(self):
+        """Make the other processes drop their entries."""
+        if self.shared is None:
+            return
+        with self.shared.get_lock():
+            # Still up to date once counted, unless another process
+            # invalidated since the last sync
+            if self.shared.value == self.seen:
+                self.seen += 1
+            self.shared.value += 1
+
+    def get(self, key, load):
+        """
+        Return the value of a key, loading it on a miss.
+
+        Args:
+            key (tuple): The key of the entry.
+            load (callable): Called without arguments to load the value.
+                A value of None is returned but never stored.
+
+        Returns:
+            The cached or loaded value.
+        """
+        with self.lock:
+            self._sync()
+            if key in self.entries:
+                self.entries.move_to_end(key)
+                self.hits += 1
+                return self.entries[key]
+            self.misses += 1
+            generation = self.generation
+        value = load()
+        if value is None or self.maxsize <= 0:
+            return value
+        with self.lock:
+            self._sync()
+            if generation == self.generation:
+                self.entries[key] = value
+                self.entries.move_to_end(key)
+                while len(self.entries) > self.maxsize:
+                    self.entries.popitem(last=False)
+        return value
+
+    def invalidate(self, *keys):
+        """
+        Drop entries from the cache.
+
+        Args:
+            keys: The keys of the entries to drop.
+        """
+        with self.lock:
+            self._sync()
+            self.generation += 1
+            for key in keys:
+                self.entries.pop(key, None)
+            self._announce()
+
+    def clear(self):
+        """Drop every entry from the cache."""
+        with self.lock:
+            self._sync()
+            self.generation += 1
+            self.entries.clear()
+            self._announce()
+
+    def stats(self):
+        """
+        Return the counters of the cache.
+
+        Returns:
+            dict: The hits, misses, current size and maximum size.
+        """
+        with self.lock:
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'size': len(self.entries),
+                'maxsize': self.maxsize
+            }
+
+
+def invalidate_on_commit(session, *keys):
+    """
+    Drop cache entries once the transaction of a session commits.
+
+    Dropping them before would let another request cache the data that
+    is about to change again.
+
+    Args:
+        session (Session): The session making the change.
+        keys: The keys of the entries made stale by the change.
+    """
+    session.info.setdefault('catalog_keys', set()).update(keys)
+
+
+@event.listens_for(Session, 'after_commit')
+def _invalidate_committed(session):
+    """Drop the entries named by the transaction that committed."""
+    keys = session.info.pop('catalog_keys', None)
+    if keys:
+        catalog.invalidate(*keys)
+
+
+# Cache shared by every handler of this process
+catalog = CatalogCache(CATALOG_CACHE_SIZE)
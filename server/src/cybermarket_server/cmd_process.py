@@ -1,14 +1,88 @@
 """Accept commands from server.py and output the results to the queue."""
-import pandas as pd
 from .model import Merchant, Client, Order, Product
 from .model import InventoryShortage
 from .invitation import create_ivitation, check_ivitation
-from .setting import session, lang
+from .catalog import catalog, MERCHANTS, products_key, invalidate_on_commit
+from .notify import hub
+from .paging import keyset_page, page_size
+from .search import match_query, search_terms, product_fts, rank
+from .registry import registry
+from .resultset import ResultSet
+from .setting import session, lang, PERSIST_LOGIN
 from .lang import _
 
 lang
 
 
+def logged_in_client(connected_address):
+    """
+    Return the client logged in on a connection.
+
+    Args:
+        connected_address (str): The address of the connection.
+
+    Return:
+        Client: The logged in client, or None.
+    """
+    client_id = registry.client(connected_address)
+    if client_id is None:
+        return None
+    return session.get(Client, client_id)
+
+
+def logged_in_merchant(connected_address):
+    """
+    Return the merchant logged in on a connection.
+
+    Args:
+        connected_address (str): The address of the connection.
+
+    Return:
+        Merchant: The logged in merchant, or None.
+    """
+    merchant_id = registry.merchant(connected_address)
+    if merchant_id is None:
+        return None
+    return session.get(Merchant, merchant_id)
+
+
+def release_connection(connected_address):
+    """
+    Log out whoever is logged in on a connection that has been closed.
+
+    Args:
+        connected_address (str): The address of the closed connection.
+    """
+    hub.unsubscribe(connected_address)
+    client_id, merchant_id = registry.drop(connected_address)
+    if not PERSIST_LOGIN:
+        return
+    for model, principal_id in ((Client, client_id),
+                                (Merchant, merchant_id)):
+        if principal_id is None:
+            continue
+        principal = session.get(model, principal_id)
+        if principal and principal.connected_address == connected_address:
+            principal.connected_address = None
+    session.commit()
+
+
+def release_all_connections():
+    """
+    Forget the persisted logins of the connections of a previous run.
+
+    No connection survives a restart of the server, but a server that
+    crashed never logged them out.
+    """
+    if not PERSIST_LOGIN:
+        return
+    for model in (Client, Merchant):
+        session.query(model).filter(
+            model.connected_address.isnot(None)
+            ).update({model.connected_address: None})
+    session.commit()
+
+
 def client_create(request_id, connected_address, *args):
     """
     Create a new client with the provided username, email, and password.
@@ -30,7 +104,7 @@ def client_create(request_id, connected_address, *args):
     else:
         client = Client(username=args[0], email=args[1], password=args[2])
         session.add(client)
-        session.commit()
+        session.flush()
         reply = str(request_id) + " 201 Created"
         return [reply]
 
@@ -47,8 +121,7 @@ def set_client_username(request_id, connected_address, *args):
     Return:
         [reply_message]
     """
-    result = session.query(Client).filter(
-        Client.connected_address == connected_address).first()
+    result = logged_in_client(connected_address)
     if result:
         result.set_username(args[0])
         msg = _("Username has been set")
@@ -72,8 +145,7 @@ def set_client_email(request_id, connected_address, *args):
     Return:
         [reply_message]
     """
-    result = session.query(Client).filter(
-        Client.connected_address == connected_address).first()
+    result = logged_in_client(connected_address)
     if result:
         result.set_email(args[0])
         msg = _("Email has been set")
@@ -98,8 +170,7 @@ def set_client_password(request_id, connected_address, *args):
     Return:
         [reply_message]
     """
-    result = session.query(Client).filter(
-        Client.connected_address == connected_address).first()
+    result = logged_in_client(connected_address)
     if result:
         if result.verify_password(args[1]):
             result.set_password(args[0], args[1])
@@ -132,9 +203,7 @@ def client_login(request_id, connected_address, *args):
     result = session.query(Client).filter(
         (Client.username == args[0]) | (Client.email == args[0])
         ).first()
-    login_status = session.query(Client.connected_address).filter(
-        Client.connected_address == connected_address).first()
-    if login_status:
+    if registry.client(connected_address) is not None:
         msg = _("The user has been logged in, please do not log in again")
         reply = str(request_id) + " 400 Bad Request: " + msg
         return [reply]
@@ -166,10 +235,9 @@ def client_logout(request_id, connected_address, *args):
     Return:
         [reply_message]
     """
-    result = session.query(Client).filter(
-        Client.connected_address == connected_address).first()
+    result = logged_in_client(connected_address)
     if result:
-        result.client_logout()
+        result.client_logout(connected_address)
         msg = _("You have successfully logged out")
         reply = str(request_id) + " 200 OK: " + msg
         return [reply]
@@ -192,8 +260,7 @@ def client_add_item(request_id, connected_address, *args):
     Return:
         [reply_message]
     """
-    result = session.query(Client).filter(
-        Client.connected_address == connected_address).first()
+    result = logged_in_client(connected_address)
     product = session.query(Product).filter(
         Product.productId == args[0]).first()
     if int(args[1]) <= 0:
@@ -205,7 +272,15 @@ def client_add_item(request_id, connected_address, *args):
         reply = str(request_id) + " 404 Not Found: " + msg
         return [reply]
     elif result:
-        result.add_item(args[0], int(args[1]))
+        try:
+            if result.add_item(args[0], int(args[1])):
+                # The stock held for the cart is no longer listed
+                invalidate_on_commit(
+                    session, products_key(product.merchant.storename))
+        except InventoryShortage:
+            msg = _("Not enough stock for this product")
+            reply = str(request_id) + " 400 Bad Request: " + msg
+            return [reply]
         msg = _("This product has been added to the shopping cart")
         reply = str(request_id) + " 200 OK: " + msg
         return [reply]
@@ -227,8 +302,7 @@ def client_remove_item(request_id, connected_address, *args):
     Return:
         [reply_message]
     """
-    result = session.query(Client).filter(
-        Client.connected_address == connected_address).first()
+    result = logged_in_client(connected_address)
     product = session.query(Order).filter(
             Order.product_id == args[0]
             ).first()
@@ -237,7 +311,10 @@ def client_remove_item(request_id, connected_address, *args):
         reply = str(request_id) + " 404 Not Found: " + msg
         return [reply]
     elif result:
-        result.remove_item(args[0])
+        if result.remove_item(args[0]):
+            # The stock given back is listed again
+            invalidate_on_commit(
+                session, products_key(product.product.merchant.storename))
         msg = _("This product has been removed from the shopping cart")
         reply = str(request_id) + " 200 OK: " + msg
         return [reply]
@@ -257,18 +334,17 @@ def client_get_items(request_id, connected_address, *args):
         *args: Variable length argument list: Do not require
 
     Return:
-        [reply_message, item_dataframe]
-        item_dataframe (pd.Dataframe): Dataframe of items in the shopping cart
+        [reply_message, item_table]
+        item_table (ResultSet): Table of items in the shopping cart
     """
-    result = session.query(Client).filter(
-        Client.connected_address == connected_address).first()
+    result = logged_in_client(connected_address)
     if result:
         msg = _("Obtained order list")
         reply = str(request_id) + " 200 OK: " + msg
         column_labels = [_('storename'), _("product_id"), _('productname'),
                          _('price'), _('quantity')]
-        df = pd.DataFrame(result.get_items(), columns=column_labels)
-        return [reply, df]
+        table = ResultSet.from_rows(column_labels, result.get_items())
+        return [reply, table]
     else:
         msg = _("You have not logged in or your login has timed out")
         reply = str(request_id) + " 401 Unauthorized: " + msg
@@ -288,8 +364,7 @@ def client_get_price(request_id, connected_address, *args):
         [reply_message, total_price]
         total_price: The price all items in the shopping cart
     """
-    result = session.query(Client).filter(
-        Client.connected_address == connected_address).first()
+    result = logged_in_client(connected_address)
     if result:
         msg = _("Order price obtained")
         reply = str(request_id) + " 200 OK: " + msg
@@ -300,6 +375,37 @@ def client_get_price(request_id, connected_address, *args):
         return [reply]
 
 
+def client_get_cart(request_id, connected_address, *args):
+    """
+    Retrieve the items in the client's shopping cart and their total price.
+
+    This answers CLIENT_GET_ITEMS and CLIENT_GET_PRICE at once, with a
+    single database query.
+
+    Args:
+        request_id (str): The unique identifier for the request.
+        connected_address (str): The address of the client making the request.
+        *args: Variable length argument list: Do not require
+
+    Return:
+        [reply_message, item_table, total_price]
+        item_table (ResultSet): Table of items in the shopping cart
+        total_price: The price all items in the shopping cart
+    """
+    result = logged_in_client(connected_address)
+    if result:
+        msg = _("Obtained order list")
+        reply = str(request_id) + " 200 OK: " + msg
+        column_labels = [_('storename'), _("product_id"), _('productname'),
+                         _('price'), _('quantity')]
+        items, total = result.get_cart()
+        return [reply, ResultSet.from_rows(column_labels, items), total]
+    else:
+        msg = _("You have not logged in or your login has timed out")
+        reply = str(request_id) + " 401 Unauthorized: " + msg
+        return [reply]
+
+
 def client_checkout_item(request_id, connected_address, *args):
     """
     Check out the items in the client's shopping cart.
@@ -312,11 +418,13 @@ def client_checkout_item(request_id, connected_address, *args):
     Return:
         [reply_message]
     """
-    result = session.query(Client).filter(
-        Client.connected_address == connected_address).first()
+    result = logged_in_client(connected_address)
     if result:
         try:
-            result.checkout_item()
+            stores = result.checkout_item()
+            invalidate_on_commit(
+                session, *(products_key(store) for store in stores)
+                )
             msg = _("Order has been checked out")
             reply = str(request_id) + " 200 OK: " + msg
             return [reply]
@@ -332,60 +440,298 @@ def client_checkout_item(request_id, connected_address, *args):
 
 def list_merchant(request_id, connected_address, *args):
     """
-    Retrieve a list of all merchants from the database.
+    Retrieve a list of merchants from the database.
+
+    Without arguments, all merchants are returned. Given a limit, the
+    merchants are returned by pages.
 
     Args:
         request_id (str): The unique identifier for the request.
         connected_address (str): The address of the client making the request.
-        *args: Variable length argument list: Do not require
+        args[0]: The number of merchants of a page, optional
+        args[1]: The cursor returned with the previous page, None for the
+            first page
+        args[2]: The sort key, "storename" by default
 
     Return:
-        [reply_message, merchant_dataframe]
-        merchant_dataframe (pd.Dataframe): Dataframe of all merchants
+        [reply_message, merchant_table] or, by pages,
+        [reply_message, merchant_table, next_cursor]
+        merchant_table (ResultSet): Table of the merchants
+        next_cursor (list): The cursor of the next page, None on the last
     """
-    result = session.query(Merchant).all()
-    merchant_list = []
-    for merchant in result:
-        merchant_list.append([
-            merchant.storename,
-            merchant.description,
-            merchant.email
-        ])
+    def query():
+        return session.query(
+            Merchant.storename,
+            Merchant.description,
+            Merchant.email
+            )
+
     column_labels = [_('storename'), _('description'),
                      _('email')]
-    df = pd.DataFrame(merchant_list, columns=column_labels)
+    if args:
+        keys = MERCHANT_SORT_KEYS.get(args[2] if len(args) > 2 else
+                                      "storename")
+        if keys is None:
+            msg = _("Unknown sort key")
+            reply = str(request_id) + " 400 Bad Request: " + msg
+            return [reply]
+        limit = page_size(args[0])
+        if limit is None:
+            msg = _("The page size should be an integer")
+            reply = str(request_id) + " 400 Bad Request: " + msg
+            return [reply]
+        rows, next_cursor = keyset_page(
+            query(), keys, limit, args[1] if len(args) > 1 else None)
+        reply = str(request_id) + " 200 OK"
+        return [reply, ResultSet.from_rows(column_labels, rows),
+                next_cursor]
+
+    def load():
+        return ResultSet.from_rows(column_labels, query().all())
+
+    table = catalog.get(MERCHANTS, load)
     reply = str(request_id) + " 200 OK"
-    return [reply, df]
+    return [reply, table]
 
 
 def list_product(request_id, connected_address, *args):
     """
     Retrieve a list of products from merchant by the store name.
 
+    Without more arguments than the store name, all its products are
+    returned. Given a limit, the products are returned by pages.
+
     Args:
         request_id (str): The unique identifier for the request.
         connected_address (str): The address of the client making the request.
         args[0]: Storename of the merchant
+        args[1]: The number of products of a page, optional
+        args[2]: The cursor returned with the previous page, None for the
+            first page
+        args[3]: The sort key, "product_id", "productname", "price" or
+            "stock", "product_id" by default
 
     Return:
-        [reply_message, product_dataframe]
-        product_dataframe (pd.Dataframe): Dataframe of products from merchant
+        [reply_message, product_table] or, by pages,
+        [reply_message, product_table, next_cursor]
+        product_table (ResultSet): Table of products from merchant
+        next_cursor (list): The cursor of the next page, None on the last
+    """
+    if len(args) > 1:
+        return list_product_page(request_id, *args)
+
+    def load():
+        result = session.query(Merchant).filter(
+            Merchant.storename == args[0]).first()
+        if not result:
+            return None
+        column_labels = [_('product_id'), _('storename'), _('productname'),
+                         _('description'), _('price'), _('stock')]
+        return ResultSet.from_rows(
+            column_labels, result.get_product_list())
+
+    table = catalog.get(products_key(args[0]), load)
+    if table is not None:
+        msg = _("Product list has been obtained")
+        reply = str(request_id) + " 200 OK: " + msg
+        return [reply, table]
+    else:
+        msg = _("No store with this name found")
+        reply = str(request_id) + " 404 Not Found: " + msg
+        return [reply]
+
+
+def list_product_page(request_id, storename, limit, cursor=None,
+                      sort="product_id"):
+    """
+    Retrieve one page of the products of a store.
+
+    Args:
+        request_id (str): The unique identifier for the request.
+        storename (str): Storename of the merchant.
+        limit (int): The number of products of a page.
+        cursor (list): The cursor returned with the previous page.
+        sort (str): The sort key.
+
+    Return:
+        [reply_message, product_table, next_cursor]
+    """
+    keys = PRODUCT_SORT_KEYS.get(sort)
+    if keys is None:
+        msg = _("Unknown sort key")
+        reply = str(request_id) + " 400 Bad Request: " + msg
+        return [reply]
+    limit = page_size(limit)
+    if limit is None:
+        msg = _("The page size should be an integer")
+        reply = str(request_id) + " 400 Bad Request: " + msg
+        return [reply]
+    result = session.query(Merchant).filter(
+        Merchant.storename == storename).first()
+    if not result:
+        msg = _("No store with this name found")
+        reply = str(request_id) + " 404 Not Found: " + msg
+        return [reply]
+    rows, next_cursor = keyset_page(
+        result.product_query(), keys, limit, cursor)
+    msg = _("Product list has been obtained")
+    reply = str(request_id) + " 200 OK: " + msg
+    column_labels = [_('product_id'), _('storename'), _('productname'),
+                     _('description'), _('price'), _('stock')]
+    return [reply, ResultSet.from_rows(column_labels, rows), next_cursor]
+
+
+def search_product(request_id, connected_address, text, filters=None,
+                   limit=50, cursor=None):
+    """
+    Search the products of every store by name and description.
+
+    Every word of the text must match a word of the product, or the
+    beginning of one. The best matches come first.
+
+    Args:
+        request_id (str): The unique identifier for the request.
+        connected_address (str): The address of the client making the request.
+        text (str): The words searched.
+        filters (dict): Optional filters, "storename", "min_price",
+            "max_price" and "in_stock".
+        limit (int): The number of products of a page.
+        cursor (list): The cursor returned with the previous page, None
+            for the first page.
+
+    Return:
+        [reply_message, product_table, next_cursor]
+        product_table (ResultSet): Table of the matching products
+        next_cursor (list): The cursor of the next page, None on the last
+    """
+    filters = filters or {}
+    unknown = set(filters) - set(SEARCH_FILTERS)
+    if unknown:
+        msg = _("Unknown search filter")
+        reply = str(request_id) + " 400 Bad Request: " + msg
+        return [reply]
+    try:
+        conditions = [SEARCH_FILTERS[name](value)
+                      for name, value in filters.items()]
+    except (TypeError, ValueError):
+        msg = _("The value of a search filter is invalid")
+        reply = str(request_id) + " 400 Bad Request: " + msg
+        return [reply]
+    limit = page_size(limit)
+    if limit is None:
+        msg = _("The page size should be an integer")
+        reply = str(request_id) + " 400 Bad Request: " + msg
+        return [reply]
+    terms = search_terms(text)
+    if not terms:
+        msg = _("Nothing to search")
+        reply = str(request_id) + " 400 Bad Request: " + msg
+        return [reply]
+    columns = [Product.productId, Merchant.storename, Product.productname,
+               Product.description, Product.price, Product.stock]
+    if session.get_bind().dialect.name == 'sqlite':
+        query = session.query(*columns, rank).join(
+            Product.merchant).join(
+            product_fts, product_fts.c.rowid == Product.productId).filter(
+            product_fts.c.product_fts.match(match_query(text)))
+        keys = [(rank, 6), (Product.productId, 0)]
+    else:
+        # Without the index, match the words anywhere in the text
+        query = session.query(*columns).join(Product.merchant)
+        for term in terms:
+            query = query.filter(
+                Product.productname.icontains(term, autoescape=True)
+                | Product.description.icontains(term, autoescape=True))
+        keys = [(Product.productname, 2), (Product.productId, 0)]
+    query = query.filter(*conditions)
+    rows, next_cursor = keyset_page(query, keys, limit, cursor)
+    msg = _("Product list has been obtained")
+    reply = str(request_id) + " 200 OK: " + msg
+    column_labels = [_('product_id'), _('storename'), _('productname'),
+                     _('description'), _('price'), _('stock')]
+    return [reply, ResultSet.from_rows(
+        column_labels, [row[:6] for row in rows]), next_cursor]
+
+
+def list_product_since(request_id, connected_address, *args):
+    """
+    Retrieve the products of a store changed since a catalog version.
+
+    Args:
+        request_id (str): The unique identifier for the request.
+        connected_address (str): The address of the client making the request.
+        args[0]: Storename of the merchant
+        args[1]: The catalog version the client has, 0 for none
+
+    Return:
+        [reply_message, product_table, deleted_ids, version, full]
+        product_table (ResultSet): Table of the products added or changed
+        deleted_ids (list): The productId of the products deleted
+        version (int): The current catalog version of the store
+        full (bool): Whether the table replaces the whole product list
     """
     result = session.query(Merchant).filter(
         Merchant.storename == args[0]).first()
     if result:
+        rows, deleted, version, full = result.get_product_changes(
+            int(args[1]))
         msg = _("Product list has been obtained")
         reply = str(request_id) + " 200 OK: " + msg
         column_labels = [_('product_id'), _('storename'), _('productname'),
                          _('description'), _('price'), _('stock')]
-        df = pd.DataFrame(result.get_product_list(), columns=column_labels)
-        return [reply, df]
+        table = ResultSet.from_rows(column_labels, rows)
+        return [reply, table, deleted, version, full]
     else:
         msg = _("No store with this name found")
         reply = str(request_id) + " 404 Not Found: " + msg
         return [reply]
 
 
+def subscribe_store(request_id, connected_address, *args):
+    """
+    Subscribe the connection to the product changes of a store.
+
+    Once subscribed, the connection receives a push message whenever a
+    product of the store is added, changed, restocked, sold or deleted.
+
+    Args:
+        request_id (str): The unique identifier for the request.
+        connected_address (str): The address of the client making the request.
+        args[0]: Storename of the merchant
+
+    Return:
+        [reply_message]
+    """
+    if session.query(Merchant.merchantId).filter(
+            Merchant.storename == args[0]).first():
+        hub.subscribe(connected_address, args[0])
+        msg = _("You are subscribed to the changes of this store")
+        reply = str(request_id) + " 200 OK: " + msg
+        return [reply]
+    else:
+        msg = _("No store with this name found")
+        reply = str(request_id) + " 404 Not Found: " + msg
+        return [reply]
+
+
+def unsubscribe_store(request_id, connected_address, *args):
+    """
+    Unsubscribe the connection from the product changes of a store.
+
+    Args:
+        request_id (str): The unique identifier for the request.
+        connected_address (str): The address of the client making the request.
+        args[0]: Storename of the merchant, every store if not given
+
+    Return:
+        [reply_message]
+    """
+    hub.unsubscribe(connected_address, args[0] if args else None)
+    msg = _("You are no longer subscribed to the changes of this store")
+    reply = str(request_id) + " 200 OK: " + msg
+    return [reply]
+
+
 def merchant_create_ivitation(
         request_id, connected_address, *args):
     """
@@ -400,12 +746,11 @@ def merchant_create_ivitation(
         [reply_message, invitation_code]
         invitation_code (str): Alphanumeric string of length 12.
     """
-    result = session.query(Merchant).filter(
-        Merchant.connected_address == connected_address).first()
+    result = logged_in_merchant(connected_address)
     if result:
         msg = _("Invitation code has been generated")
         reply = str(request_id) + " 200 OK: " + msg
-        return [reply, create_ivitation(result.storename)]
+        return [reply, create_ivitation(session, result.storename)]
     else:
         msg = _("You have not logged in or your login has timed out")
         reply = str(request_id) + " 401 Unauthorized: " + msg
@@ -429,7 +774,7 @@ def merchant_create(request_id, connected_address, *args):
     Return:
         [reply_message]
     """
-    if check_ivitation(args[4], args[5]):
+    if check_ivitation(session, args[4], args[5]):
         if session.query(Merchant).filter(
                 Merchant.storename == args[0]).first():
             msg = _("This storename is occupied")
@@ -443,7 +788,8 @@ def merchant_create(request_id, connected_address, *args):
                 password=args[3]
                 )
             session.add(merchant)
-            session.commit()
+            session.flush()
+            invalidate_on_commit(session, MERCHANTS, products_key(args[0]))
             reply = str(request_id) + " 201 Created"
             return [reply]
     else:
@@ -470,9 +816,7 @@ def merchant_login(request_id, connected_address, *args):
     result = session.query(Merchant).filter(
         (Merchant.storename == args[0]) | (Merchant.email == args[0])
         ).first()
-    login_status = session.query(Merchant.connected_address).filter(
-        Merchant.connected_address == connected_address).first()
-    if login_status:
+    if registry.merchant(connected_address) is not None:
         msg = _("The merchant has been logged in, please do not log in again")
         reply = str(request_id) + " 400 Bad Request: " + msg
         return [reply]
@@ -504,10 +848,9 @@ def merchant_logout(request_id, connected_address, *args):
     Return:
         [reply_message]
     """
-    result = session.query(Merchant).filter(
-        Merchant.connected_address == connected_address).first()
+    result = logged_in_merchant(connected_address)
     if result:
-        result.merchant_logout()
+        result.merchant_logout(connected_address)
         msg = _("You have successfully logged out")
         reply = str(request_id) + " 200 OK: " + msg
         return [reply]
@@ -529,9 +872,12 @@ def set_merchant_storename(request_id, connected_address, *args):
     Return:
         [reply_message]
     """
-    result = session.query(Merchant).filter(
-        Merchant.connected_address == connected_address).first()
+    result = logged_in_merchant(connected_address)
     if result:
+        invalidate_on_commit(
+            session, MERCHANTS,
+            products_key(result.storename), products_key(args[0])
+            )
         result.set_storename(args[0])
         msg = _("Storename has been set")
         reply = str(request_id) + " 200 OK: " + msg
@@ -554,10 +900,10 @@ def set_merchant_email(request_id, connected_address, *args):
     Return:
         [reply_message]
     """
-    result = session.query(Merchant).filter(
-        Merchant.connected_address == connected_address).first()
+    result = logged_in_merchant(connected_address)
     if result:
         result.set_email(args[0])
+        invalidate_on_commit(session, MERCHANTS)
         msg = _("Email has been set")
         reply = str(request_id) + " 200 OK: " + msg
         return [reply]
@@ -580,10 +926,10 @@ def set_merchant_description(
     Return:
         [reply_message]
     """
-    result = session.query(Merchant).filter(
-        Merchant.connected_address == connected_address).first()
+    result = logged_in_merchant(connected_address)
     if result:
         result.set_description(args[0])
+        invalidate_on_commit(session, MERCHANTS)
         msg = _("Description has been set")
         reply = str(request_id) + " 200 OK: " + msg
         return [reply]
@@ -606,8 +952,7 @@ def set_merchant_password(request_id, connected_address, *args):
     Return:
         [reply_message]
     """
-    result = session.query(Merchant).filter(
-        Merchant.connected_address == connected_address).first()
+    result = logged_in_merchant(connected_address)
     if result:
         if result.verify_password(args[1]):
             result.set_password(args[0], args[1])
@@ -638,10 +983,10 @@ def merchant_add_product(request_id, connected_address, *args):
     Return:
         [reply_message]
     """
-    result = session.query(Merchant).filter(
-        Merchant.connected_address == connected_address).first()
+    result = logged_in_merchant(connected_address)
     if result:
         result.add_product(args[0], args[1], args[2])
+        invalidate_on_commit(session, products_key(result.storename))
         msg = _("This product has been added to the product list")
         reply = str(request_id) + " 200 OK: " + msg
         return [reply]
@@ -663,10 +1008,20 @@ def merchant_del_product(request_id, connected_address, *args):
     Return:
         [reply_message]
     """
-    result = session.query(Merchant).filter(
-        Merchant.connected_address == connected_address).first()
+    result = logged_in_merchant(connected_address)
+    product = session.query(Product).filter(
+        Product.productId == args[0]).first()
     if result:
-        result.del_product(args[0])
+        if not product:
+            msg = _("The product you are trying to delete cannot be found")
+            reply = str(request_id) + " 404 Not Found: " + msg
+            return [reply]
+        elif product.merchant_id != result.merchantId:
+            msg = _("You are deleting an item that is not from this store")
+            reply = str(request_id) + " 403 Forbidden: " + msg
+            return [reply]
+        result.del_product(product.productId)
+        invalidate_on_commit(session, products_key(result.storename))
         msg = _("This product has been deleted from the product list")
         reply = str(request_id) + " 200 OK: " + msg
         return [reply]
@@ -690,13 +1045,13 @@ def merchant_restock_product(
     Return:
         [reply_message]
     """
-    result = session.query(Merchant).filter(
-        Merchant.connected_address == connected_address).first()
+    result = logged_in_merchant(connected_address)
     product = session.query(Product).filter(
         Product.productId == args[0]).first()
     if result:
         if product and product.merchant_id == result.merchantId:
             product.restock(int(args[1]))
+            invalidate_on_commit(session, products_key(result.storename))
             msg = _("This product has been restock")
             reply = str(request_id) + " 200 OK: " + msg
             return [reply]
@@ -723,8 +1078,7 @@ def merchant_get_profit(request_id, connected_address, *args):
         [reply_message, total_profit]
         total_profit (float): This merchant's total profit
     """
-    result = session.query(Merchant).filter(
-        Merchant.connected_address == connected_address).first()
+    result = logged_in_merchant(connected_address)
     if result:
         msg = _("Your total profit has been obtained")
         reply = str(request_id) + " 200 OK: " + msg
@@ -735,6 +1089,117 @@ def merchant_get_profit(request_id, connected_address, *args):
         return [reply]
 
 
+def reply_succeeded(reply):
+    """
+    Tell whether a reply reports success.
+
+    Args:
+        reply (list): The reply returned by a command function.
+
+    Return:
+        bool: True if the status code of the reply is 2xx.
+    """
+    parts = str(reply[0]).split(' ', 2)
+    return len(parts) > 1 and parts[1].startswith('2')
+
+
+def batch(request_id, connected_address, *args):
+    """
+    Execute several commands in one database transaction.
+
+    In ATOMIC mode the batch stops at the first command that fails and
+    everything it changed is rolled back. In EACH mode every command runs
+    in its own savepoint, so a failed command is rolled back alone and the
+    others are kept, even if it raises: it is then answered with a 400 for
+    invalid arguments and a 500 otherwise. Commands that log in or out or
+    subscribe to a store, and nested batches, are not accepted since the
+    state they bind to the connection is not transactional.
+
+    Args:
+        request_id (str): The unique identifier for the request.
+        connected_address (str): The address of the client making the request.
+        args[0]: The mode of the batch, "ATOMIC" or "EACH".
+        args[1:]: The commands, each a tuple of a command and its arguments.
+
+    Return:
+        [reply_message, replies]
+        replies (list): The reply of each command executed, in order.
+    """
+    mode = args[0] if args else None
+    if mode not in BATCH_MODES:
+        msg = _("Unknown batch mode")
+        reply = str(request_id) + " 400 Bad Request: " + msg
+        return [reply]
+    replies = []
+    for command in args[1:]:
+        cmd, *command_args = command
+        func = function_dict.get(cmd)
+        if not func or cmd in BATCH_EXCLUDED:
+            msg = _("This method cannot be called in a batch")
+            result = [str(request_id) + " 400 Bad Request: " + msg]
+        elif mode == "EACH":
+            savepoint = session.begin_nested()
+            try:
+                result = func(request_id, connected_address, *command_args)
+            except (IndexError, TypeError, ValueError):
+                msg = _("The arguments of the command are invalid")
+                result = [str(request_id) + " 400 Bad Request: " + msg]
+            except Exception as error:
+                print(f"{connected_address} {cmd} {request_id} failed: "
+                      f"{error!r}")
+                result = [str(request_id) + " 500 Internal Server Error"]
+            if reply_succeeded(result):
+                savepoint.commit()
+            else:
+                savepoint.rollback()
+        else:
+            result = func(request_id, connected_address, *command_args)
+        replies.append(result)
+        if mode == "ATOMIC" and not reply_succeeded(result):
+            session.rollback()
+            msg = _("A command of the batch failed, the batch was rolled back")
+            reply = str(request_id) + " 409 Conflict: " + msg
+            return [reply, replies]
+    msg = _("The batch has been executed")
+    reply = str(request_id) + " 200 OK: " + msg
+    return [reply, replies]
+
+
+def in_stock_filter(value):
+    """
+    Build the condition of the in_stock filter of SEARCH_PRODUCT.
+
+    Args:
+        value (bool): Whether the products must be in stock or sold out.
+
+    Return:
+        The condition on the stock of the products.
+    """
+    if value not in (True, False):
+        raise ValueError(f"Not a boolean: {value!r}")
+    return Product.stock > 0 if value else Product.stock <= 0
+
+
+# Sort keys of the paginated listings, ending with a unique column
+MERCHANT_SORT_KEYS = {
+    "storename": [(Merchant.storename, 0)]
+}
+PRODUCT_SORT_KEYS = {
+    "product_id": [(Product.productId, 0)],
+    "productname": [(Product.productname, 2), (Product.productId, 0)],
+    "price": [(Product.price, 4), (Product.productId, 0)],
+    "stock": [(Product.stock, 5), (Product.productId, 0)]
+}
+
+# Filters of SEARCH_PRODUCT, building the condition from the value and
+# raising ValueError or TypeError for an invalid value
+SEARCH_FILTERS = {
+    "storename": lambda value: Merchant.storename == str(value),
+    "min_price": lambda value: Product.price >= float(value),
+    "max_price": lambda value: Product.price <= float(value),
+    "in_stock": in_stock_filter
+}
+
 function_dict = {
     "CLIENT_CREATE": client_create,
     "CLIENT_LOGIN": client_login,
@@ -746,9 +1211,14 @@ function_dict = {
     "CLIENT_REMOVE_ITEM": client_remove_item,
     "CLIENT_GET_ITEMS": client_get_items,
     "CLIENT_GET_PRICE": client_get_price,
+    "CLIENT_GET_CART": client_get_cart,
     "CLIENT_CHECKOUT_ITEM": client_checkout_item,
     "LIST_MERCHANT": list_merchant,
     "LIST_PRODUCT": list_product,
+    "LIST_PRODUCT_SINCE": list_product_since,
+    "SEARCH_PRODUCT": search_product,
+    "SUBSCRIBE_STORE": subscribe_store,
+    "UNSUBSCRIBE_STORE": unsubscribe_store,
     "MERCHANT_CREATE_IVITATION": merchant_create_ivitation,
     "MERCHANT_CREATE": merchant_create,
     "MERCHANT_LOGIN": merchant_login,
@@ -760,7 +1230,22 @@ function_dict = {
     "MERCHANT_ADD_PRODUCT": merchant_add_product,
     "MERCHANT_DEL_PRODUCT": merchant_del_product,
     "MERCHANT_RESTOCK_PRODUCT": merchant_restock_product,
-    "MERCHANT_GET_PROFIT": merchant_get_profit
+    "MERCHANT_GET_PROFIT": merchant_get_profit,
+    "BATCH": batch
+}
+
+BATCH_MODES = ("ATOMIC", "EACH")
+
+# Commands that change what is bound to the connection in the registry or
+# the hub, which a rolled back batch would not undo
+BATCH_EXCLUDED = {
+    "BATCH",
+    "CLIENT_LOGIN",
+    "CLIENT_LOGOUT",
+    "MERCHANT_LOGIN",
+    "MERCHANT_LOGOUT",
+    "SUBSCRIBE_STORE",
+    "UNSUBSCRIBE_STORE"
 }
 
 
@@ -778,15 +1263,42 @@ def cmd_process(cmd, request_id, connected_address, *args):
     If the command is found in the function dictionary, the corresponding
     function is called with the provided arguments.
     If the command is not found, a "400 Bad Request" error message is returned.
+    The changes made by the function are committed once it returns, and
+    rolled back if it raises.
 
     Return:
         reply (list): List with prompt information and query results
     """
     func = function_dict.get(cmd)
     if func:
-        reply = func(request_id, connected_address, *args)
+        try:
+            reply = func(request_id, connected_address, *args)
+            session.commit()
+        except Exception:
+            session.rollback()
+            raise
         return reply
     else:
         msg = _("You are trying to call an undefined method")
         reply = str(request_id) + " 400 Bad Request: " + msg
         return [reply]
+
+
+def too_many_requests(request_id, connected_address, *args):
+    """
+    Reply to a request refused by the rate limits.
+
+    The request is not run, so this needs no database and is called on
+    the event loop.
+
+    Args:
+        request_id (str): The unique identifier for the request.
+        connected_address (str): The address of the client making the request.
+        *args: Variable length argument list: Do not require
+
+    Return:
+        [reply_message]
+    """
+    msg = _("Too many requests, please slow down")
+    reply = str(request_id) + " 429 Too Many Requests: " + msg
+    return [reply]
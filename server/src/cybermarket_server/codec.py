@@ -0,0 +1,374 @@
+"""
+Serialization formats of the messages exchanged with the client.
+
+A codec turns a request or a reply into the payload of a frame and back.
+The client announces the codecs it understands in a hello frame sent
+right after connecting, and the server answers with the one it picked.
+Clients that do not send a hello keep using pickle.
+
+Classes:
+    BinaryCodec: Compact typed binary format with column-packed tables.
+    PickleCodec: Legacy format, kept for clients without negotiation.
+        Result sets are sent to these clients as pandas DataFrames.
+    CodecError: Raised when a value cannot be encoded or decoded.
+
+Functions:
+    encode_hello(names): Build the payload of a hello frame.
+    parse_hello(payload): Return the codec names of a hello frame.
+    negotiate(names): Pick the preferred codec among the offered ones.
+"""
+import array
+import numbers
+import pickle
+import struct
+import sys
+from .resultset import ResultSet, pack_column
+
+# Marks a frame as a codec negotiation instead of a request
+HELLO = b'CYBERMARKET-HELLO'
+
+# Stands for the reply message in the pickled template of a listing
+REPLY_MARKER = '\x00cybermarket-reply\x00'
+# Pickle opcode of a str with a four byte length
+BINUNICODE = b'X'
+
+NONE = 0x00
+FALSE = 0x01
+TRUE = 0x02
+INT = 0x03
+FLOAT = 0x04
+STR = 0x05
+BYTES = 0x06
+LIST = 0x07
+TUPLE = 0x08
+DICT = 0x09
+TABLE = 0x0A
+
+# Column encodings inside a table
+INT_COLUMN = ord('q')
+FLOAT_COLUMN = ord('d')
+ANY_COLUMN = ord('o')
+
+INT64 = struct.Struct('<q')
+FLOAT64 = struct.Struct('<d')
+LENGTH = struct.Struct('<I')
+INT64_MIN, INT64_MAX = -2 ** 63, 2 ** 63 - 1
+# Packed arrays travel in little-endian byte order
+SWAP = sys.byteorder != 'little'
+
+
+class CodecError(Exception):
+    """Raise when a message cannot be encoded or decoded."""
+
+
+class PickleCodec:
+    """
+    Legacy codec serializing messages with pickle.
+
+    A listing reply, a message followed by a table, is pickled once per
+    table with a marker in place of the message. Later replies with the
+    same table splice their own message into the pickled template, so a
+    table kept by the catalog cache is not converted and pickled again
+    for every client.
+    """
+
+    name = 'pickle'
+
+    def encode(self, obj):
+        """
+        Serialize a message.
+
+        Args:
+            obj: The request or reply to serialize.
+
+        Returns:
+            bytes: The serialized message.
+        """
+        if isinstance(obj, list) and len(obj) == 2 \
+                and isinstance(obj[0], str) \
+                and isinstance(obj[1], ResultSet):
+            return self._encode_listing(obj[0], obj[1])
+        return pickle.dumps(self._legacy(obj))
+
+    def decode(self, data):
+        """
+        Deserialize a message.
+
+        Args:
+            data (bytes): The payload of a frame.
+
+        Returns:
+            The request or reply.
+        """
+        return pickle.loads(data)
+
+    def _encode_listing(self, reply, table):
+        """Serialize a reply message and a table from a template."""
+        template = table.encodings.get(self.name)
+        if template is None:
+            # Protocol 3 has no frames, whose lengths would change with
+            # the message. The marker, like any message, is memoized
+            # once, so the memo indices of the table stay the same.
+            data = pickle.dumps(
+                [REPLY_MARKER, table.to_dataframe()], protocol=3)
+            marker = REPLY_MARKER.encode('utf-8')
+            marker = BINUNICODE + LENGTH.pack(len(marker)) + marker
+            start = data.index(marker)
+            template = (data[:start], data[start + len(marker):])
+            table.encodings[self.name] = template
+        data = reply.encode('utf-8', 'surrogatepass')
+        return b''.join((
+            template[0], BINUNICODE, LENGTH.pack(len(data)), data,
+            template[1]
+            ))
+
+    def _legacy(self, obj):
+        """Replace result sets by the DataFrames older clients expect."""
+        if isinstance(obj, ResultSet):
+            return obj.to_dataframe()
+        if isinstance(obj, (list, tuple)) and any(
+                isinstance(item, ResultSet) for item in obj):
+            return type(obj)(self._legacy(item) for item in obj)
+        return obj
+
+
+class BinaryCodec:
+    """
+    Compact binary codec with typed values and column-packed tables.
+
+    Each value starts with a one byte tag. Integers and floats take eight
+    bytes, strings and bytes are length-prefixed, and tables are sent
+    column by column, with integer and float columns packed as arrays.
+    """
+
+    name = 'binary'
+
+    def encode(self, obj):
+        """
+        Serialize a message.
+
+        Args:
+            obj: The request or reply to serialize.
+
+        Returns:
+            bytes: The serialized message.
+        """
+        out = bytearray()
+        self._encode(obj, out)
+        return bytes(out)
+
+    def decode(self, data):
+        """
+        Deserialize a message.
+
+        Args:
+            data (bytes): The payload of a frame.
+
+        Returns:
+            The request or reply.
+        """
+        view = memoryview(data)
+        try:
+            obj, offset = self._decode(view, 0)
+        except (IndexError, struct.error, UnicodeDecodeError) as error:
+            raise CodecError("Malformed message: {}".format(error))
+        if offset != len(view):
+            raise CodecError("Trailing bytes after message")
+        return obj
+
+    def _encode(self, obj, out):
+        """Append the encoding of one value to the output buffer."""
+        if obj is None:
+            out.append(NONE)
+        elif obj is True or obj is False:
+            out.append(TRUE if obj else FALSE)
+        elif isinstance(obj, str):
+            data = obj.encode('utf-8')
+            out.append(STR)
+            out += LENGTH.pack(len(data))
+            out += data
+        elif isinstance(obj, numbers.Integral):
+            if not INT64_MIN <= obj <= INT64_MAX:
+                raise CodecError("Integer out of range: {}".format(obj))
+            out.append(INT)
+            out += INT64.pack(obj)
+        elif isinstance(obj, numbers.Real):
+            out.append(FLOAT)
+            out += FLOAT64.pack(obj)
+        elif isinstance(obj, (bytes, bytearray)):
+            out.append(BYTES)
+            out += LENGTH.pack(len(obj))
+            out += obj
+        elif isinstance(obj, (list, tuple)):
+            out.append(LIST if isinstance(obj, list) else TUPLE)
+            out += LENGTH.pack(len(obj))
+            for item in obj:
+                self._encode(item, out)
+        elif isinstance(obj, dict):
+            out.append(DICT)
+            out += LENGTH.pack(len(obj))
+            for key, value in obj.items():
+                self._encode(key, out)
+                self._encode(value, out)
+        elif isinstance(obj, ResultSet):
+            # Tables are often shared through the catalog cache, so their
+            # encoding is kept and reused for the next replies
+            encoded = obj.encodings.get(self.name)
+            if encoded is None:
+                start = len(out)
+                self._encode_table(obj.columns, obj.data, out)
+                obj.encodings[self.name] = bytes(out[start:])
+            else:
+                out += encoded
+        else:
+            raise CodecError(
+                "Cannot encode value of type {}".format(type(obj).__name__)
+                )
+
+    def _encode_table(self, columns, data, out):
+        """Append a table given as column names and column values."""
+        out.append(TABLE)
+        out += LENGTH.pack(len(columns))
+        for name, values in zip(columns, data):
+            self._encode(name, out)
+            self._encode_column(values, out)
+
+    def _encode_column(self, values, out):
+        """Append one column, packed as an array when it is numeric."""
+        packed = pack_column(values)
+        if not isinstance(packed, array.array):
+            out.append(ANY_COLUMN)
+            out += LENGTH.pack(len(packed))
+            for value in packed:
+                self._encode(value, out)
+            return
+        out.append(ord(packed.typecode))
+        if SWAP:
+            packed = array.array(packed.typecode, packed)
+            packed.byteswap()
+        out += LENGTH.pack(len(packed))
+        out += packed.tobytes()
+
+    def _decode(self, view, offset):
+        """Decode the value at offset, return it and the next offset."""
+        tag = view[offset]
+        offset += 1
+        if tag == NONE:
+            return None, offset
+        if tag == FALSE:
+            return False, offset
+        if tag == TRUE:
+            return True, offset
+        if tag == INT:
+            return INT64.unpack_from(view, offset)[0], offset + 8
+        if tag == FLOAT:
+            return FLOAT64.unpack_from(view, offset)[0], offset + 8
+        if tag in (STR, BYTES, LIST, TUPLE, DICT, TABLE):
+            (length,) = LENGTH.unpack_from(view, offset)
+            offset += LENGTH.size
+        else:
+            raise CodecError("Unknown tag {}".format(tag))
+        if tag in (STR, BYTES):
+            end = offset + length
+            if end > len(view):
+                raise CodecError("Truncated message")
+            data = bytes(view[offset:end])
+            return (data.decode('utf-8') if tag == STR else data), end
+        if tag in (LIST, TUPLE):
+            items = []
+            for _ in range(length):
+                item, offset = self._decode(view, offset)
+                items.append(item)
+            return (items if tag == LIST else tuple(items)), offset
+        if tag == DICT:
+            result = {}
+            for _ in range(length):
+                key, offset = self._decode(view, offset)
+                result[key], offset = self._decode(view, offset)
+            return result, offset
+        columns, data = [], []
+        for _ in range(length):
+            name, offset = self._decode(view, offset)
+            values, offset = self._decode_column(view, offset)
+            columns.append(name)
+            data.append(values)
+        return self._make_table(columns, data), offset
+
+    def _decode_column(self, view, offset):
+        """Decode one table column, return it and the next offset."""
+        kind = view[offset]
+        (length,) = LENGTH.unpack_from(view, offset + 1)
+        offset += 1 + LENGTH.size
+        if kind == ANY_COLUMN:
+            values = []
+            for _ in range(length):
+                value, offset = self._decode(view, offset)
+                values.append(value)
+            return values, offset
+        if kind not in (INT_COLUMN, FLOAT_COLUMN):
+            raise CodecError("Unknown column type {}".format(kind))
+        packed = array.array(chr(kind))
+        end = offset + length * packed.itemsize
+        if end > len(view):
+            raise CodecError("Truncated message")
+        packed.frombytes(view[offset:end])
+        if SWAP:
+            packed.byteswap()
+        return packed, end
+
+    def _make_table(self, columns, data):
+        """Build the table object handed to the caller."""
+        return ResultSet(columns, data)
+
+
+CODECS = {
+    BinaryCodec.name: BinaryCodec(),
+    PickleCodec.name: PickleCodec(),
+}
+# Codec of the connections that did not negotiate one
+LEGACY_CODEC = CODECS[PickleCodec.name]
+
+
+def encode_hello(names):
+    """
+    Build the payload of a hello frame.
+
+    Args:
+        names (list): Codec names, the preferred first.
+
+    Returns:
+        bytes: The payload of the hello frame.
+    """
+    return HELLO + b' ' + ','.join(names).encode('ascii')
+
+
+def parse_hello(payload):
+    """
+    Return the codec names announced by a hello frame.
+
+    Args:
+        payload (bytes): The payload of a frame.
+
+    Returns:
+        list: The codec names, or None if the frame is not a hello.
+    """
+    if not payload.startswith(HELLO + b' '):
+        return None
+    names = payload[len(HELLO) + 1:].decode('ascii', 'replace')
+    return [name for name in names.split(',') if name]
+
+
+def negotiate(names):
+    """
+    Pick the first offered codec that the server supports.
+
+    Args:
+        names (list): Codec names offered by the client, preferred first.
+
+    Returns:
+        The selected codec, the legacy codec if none is supported.
+    """
+    for name in names:
+        if name in CODECS:
+            return CODECS[name]
+    return LEGACY_CODEC
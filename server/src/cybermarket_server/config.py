@@ -0,0 +1,263 @@
+"""
+Runtime settings of the server: sockets, connection limits, event loop.
+
+Each setting is taken from, by increasing priority, its default, the
+configuration file, the environment and the command line. The file is
+TOML, given with --config or CYBERMARKET_CONFIG, with the settings in a
+`server` table:
+
+    [server]
+    host = "0.0.0.0"
+    port = 22333
+    backlog = 512
+    read_size = 65536
+    event_loop = "uvloop"
+
+The environment variable of a setting is its name in upper case prefixed
+with CYBERMARKET_, e.g. CYBERMARKET_READ_SIZE, and its command line flag
+is its name with dashes, e.g. --read-size.
+
+Classes:
+    ServerConfig: The runtime settings of the server.
+
+Functions:
+    load_config(argv, environ): Read the settings from every source.
+    create_listener(config): Bind the listening socket of the server.
+    event_loop_factory(config): Return the event loop to run the server on.
+"""
+import argparse
+import os
+import socket
+import tomllib
+from .outbox import SLOW_CONSUMER_POLICIES
+from .ratelimit import parse_command_rates
+
+# Type, default value and description of each setting
+OPTIONS = {
+    'host': (str, '127.0.0.1', "Address to listen on"),
+    'port': (int, 22333, "Port to listen on"),
+    'backlog': (int, 100, "Connections waiting to be accepted"),
+    'read_size': (int, 65536, "Bytes read from a connection at once"),
+    'tcp_nodelay': (bool, True, "Send small replies without delay"),
+    'send_buffer': (int, 0, "SO_SNDBUF of the connections, 0 for the "
+                            "system default"),
+    'receive_buffer': (int, 0, "SO_RCVBUF of the connections, 0 for the "
+                               "system default"),
+    'event_loop': (str, 'auto', "Event loop, 'asyncio', 'uvloop' or "
+                                "'auto' to use uvloop when installed"),
+    'processes': (int, 1, "Processes accepting connections on the port"),
+    'max_connections': (int, 1000, "Connections served at once by each "
+                                   "process, 0 for no limit"),
+    'idle_timeout': (float, 300.0, "Seconds without traffic before a "
+                                   "connection is closed, 0 to never"),
+    'read_timeout': (float, 30.0, "Seconds to receive the rest of a frame "
+                                  "once started, 0 to wait forever"),
+    'send_queue': (int, 256, "Messages queued for a connection before it "
+                             "is a slow consumer, 0 for no limit"),
+    'slow_consumer': (str, 'drop', "What a full send queue does, 'block' "
+                                   "the producer, 'drop' push messages or "
+                                   "'disconnect'"),
+    'write_high_water': (int, 65536, "Bytes buffered for a connection "
+                                     "before the writer waits for them to "
+                                     "be sent"),
+    'rate_limit': (float, 0.0, "Requests per second of a connection, 0 for "
+                               "no limit"),
+    'rate_burst': (int, 20, "Requests a connection may send at once above "
+                            "its rate"),
+    'principal_rate_limit': (float, 0.0, "Requests per second of a user, or "
+                                         "of a host before logging in, over "
+                                         "all its connections to one server "
+                                         "process, 0 for no limit"),
+    'principal_rate_burst': (int, 50, "Requests a user may send at once "
+                                      "above its rate"),
+    'command_rate_limits': (str, '', "Requests per second of a user for "
+                                     "some commands, e.g. "
+                                     "'LIST_PRODUCT=5/20,SEARCH_PRODUCT=2'")
+}
+EVENT_LOOPS = ('auto', 'asyncio', 'uvloop')
+
+
+def parse_bool(value):
+    """
+    Parse a boolean setting.
+
+    Args:
+        value (str or bool): The value, e.g. "1", "true", "no".
+
+    Returns:
+        bool: The parsed value.
+    """
+    if isinstance(value, bool):
+        return value
+    text = str(value).strip().lower()
+    if text in ('1', 'true', 'yes', 'on'):
+        return True
+    if text in ('0', 'false', 'no', 'off'):
+        return False
+    raise ValueError(f"Not a boolean: {value}")
+
+
+class ServerConfig:
+    """
+    The runtime settings of the server.
+
+    Every name of OPTIONS is an attribute, holding its default value
+    until `update` sets it.
+
+    Attributes:
+        sources (dict): Where each setting was taken from, "default",
+            the path of the file, "environment" or "command line".
+    """
+
+    def __init__(self):
+        """Initialize the settings with their default values."""
+        self.sources = {}
+        for name, (kind, default, description) in OPTIONS.items():
+            setattr(self, name, default)
+            self.sources[name] = 'default'
+
+    def update(self, values, source):
+        """
+        Set settings from one source.
+
+        Args:
+            values (dict): The values by setting name, as strings or of
+                the type of the setting.
+            source (str): The name of the source.
+        """
+        for name, value in values.items():
+            if name not in OPTIONS:
+                raise ValueError(f"Unknown server setting {name}")
+            kind = OPTIONS[name][0]
+            setattr(self, name, parse_bool(value) if kind is bool
+                    else kind(value))
+            self.sources[name] = source
+        if self.event_loop not in EVENT_LOOPS:
+            raise ValueError(f"Unknown event loop {self.event_loop}")
+        if self.slow_consumer not in SLOW_CONSUMER_POLICIES:
+            raise ValueError(
+                f"Unknown slow consumer policy {self.slow_consumer}")
+        parse_command_rates(self.command_rate_limits)
+
+    def describe(self):
+        """
+        Describe the effective settings, for the startup log.
+
+        Returns:
+            str: Each setting with its value and source.
+        """
+        return ', '.join(
+            f'{name}={getattr(self, name)} ({self.sources[name]})'
+            for name in OPTIONS
+            )
+
+
+def parse_arguments(argv):
+    """
+    Parse the command line of the server.
+
+    Args:
+        argv (list): The arguments, without the program name.
+
+    Returns:
+        Namespace: The configuration file and the settings given, None
+        for those not given.
+    """
+    parser = argparse.ArgumentParser(
+        prog='cybermarket_server',
+        description="Serve the online network market."
+        )
+    parser.add_argument('--config', help="TOML configuration file")
+    for name, (kind, default, description) in OPTIONS.items():
+        flag = '--' + name.replace('_', '-')
+        if kind is bool:
+            parser.add_argument(flag, action=argparse.BooleanOptionalAction,
+                                default=None, help=description)
+        else:
+            parser.add_argument(flag, type=kind, default=None,
+                                help=description)
+    return parser.parse_args(argv)
+
+
+def load_config(argv=None, environ=None):
+    """
+    Read the settings of the server from every source.
+
+    Args:
+        argv (list): The command line arguments, those of the process by
+            default.
+        environ (dict): The environment, that of the process by default.
+
+    Returns:
+        ServerConfig: The effective settings.
+    """
+    environ = os.environ if environ is None else environ
+    arguments = parse_arguments(argv)
+    config = ServerConfig()
+    path = arguments.config or environ.get('CYBERMARKET_CONFIG')
+    if path:
+        with open(path, 'rb') as file:
+            config.update(tomllib.load(file).get('server', {}), path)
+    config.update({
+        name: environ['CYBERMARKET_' + name.upper()]
+        for name in OPTIONS if 'CYBERMARKET_' + name.upper() in environ
+        }, 'environment')
+    config.update({
+        name: getattr(arguments, name)
+        for name in OPTIONS if getattr(arguments, name) is not None
+        }, 'command line')
+    return config
+
+
+def create_listener(config):
+    """
+    Bind the listening socket of the server.
+
+    The buffer sizes are set before listening, so the connections it
+    accepts inherit them, and the receive window can be scaled to them.
+
+    Args:
+        config (ServerConfig): The settings of the server.
+
+    Returns:
+        socket: The listening socket.
+    """
+    family = socket.AF_INET6 if ':' in config.host else socket.AF_INET
+    sock = socket.socket(family, socket.SOCK_STREAM)
+    try:
+        if os.name == 'posix':
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        if config.send_buffer > 0:
+            sock.setsockopt(
+                socket.SOL_SOCKET, socket.SO_SNDBUF, config.send_buffer)
+        if config.receive_buffer > 0:
+            sock.setsockopt(
+                socket.SOL_SOCKET, socket.SO_RCVBUF, config.receive_buffer)
+        sock.bind((config.host, config.port))
+        sock.listen(config.backlog)
+    except OSError:
+        sock.close()
+        raise
+    return sock
+
+
+def event_loop_factory(config):
+    """
+    Return the event loop to run the server on.
+
+    Args:
+        config (ServerConfig): The settings of the server.
+
+    Returns:
+        tuple: The name of the event loop, and a callable creating it, or
+        None for the default event loop of asyncio.
+    """
+    if config.event_loop == 'asyncio':
+        return 'asyncio', None
+    try:
+        import uvloop
+    except ImportError:
+        if config.event_loop == 'uvloop':
+            raise
+        return 'asyncio', None
+    return 'uvloop', uvloop.new_event_loop
@@ -0,0 +1,69 @@
+"""
+Release the stock held by the expired cart reservations.
+
+With CYBERMARKET_RESERVATION_TTL set, adding a product to a cart takes
+the quantity from its stock and holds it for the client, so it cannot be
+sold to someone else before the client checks out. The reservation ends
+after the TTL: the item stays in the cart, but its stock is given back
+and the checkout takes it again, if still available.
+
+Functions:
+    release_expired(now, limit): Give back the stock of the expired items.
+    sweep_reservations(pool, interval): Release them periodically.
+"""
+import asyncio
+import time
+from .catalog import invalidate_on_commit, products_key
+from .model import Order
+from .setting import session, RESERVATION_SWEEP
+
+
+def release_expired(now=None, limit=500):
+    """
+    Give back the stock reserved by the expired items of the carts.
+
+    Args:
+        now (float): The current time in seconds since the epoch, the
+            time of the call by default.
+        limit (int): The number of items released at most, the next
+            call releases the others.
+
+    Returns:
+        int: The number of items released.
+    """
+    now = time.time() if now is None else now
+    try:
+        orders = session.query(Order).filter(
+            Order.reserved_until <= now
+            ).order_by(Order.reserved_until).limit(limit).with_for_update(
+            ).all()
+        stores = set()
+        for order in orders:
+            stores.add(order.product.merchant.storename)
+            order.release()
+        invalidate_on_commit(
+            session, *(products_key(store) for store in stores))
+        session.commit()
+    except Exception:
+        session.rollback()
+        raise
+    return len(orders)
+
+
+async def sweep_reservations(pool, interval=RESERVATION_SWEEP):
+    """
+    Release the expired reservations until cancelled.
+
+    Args:
+        pool (WorkerPool): The pool running the database work.
+        interval (float): The seconds between two releases.
+    """
+    while True:
+        try:
+            released = await pool.call(release_expired)
+        except Exception as error:
+            print(f'Releasing the expired reservations failed: {error}')
+        else:
+            if released:
+                print(f'Released {released} expired reservations')
+        await asyncio.sleep(interval)
@@ -1,8 +1,8 @@
 """Provide Invitation class and methods for creating and using invitations."""
 import random
 import string
-from sqlalchemy import Column, Integer, String
-from .setting import engine, Base, session
+from sqlalchemy import Column, Integer, String, Index
+from .setting import engine, Base
 
 
 class Invitation(Base):
@@ -12,6 +12,10 @@ class Invitation(Base):
     id = Column(Integer, primary_key=True)
     merchantname = Column(String)
     code = Column(String)
+    __table_args__ = (
+        Index('ix_invitation_merchantname_code', merchantname, code,
+              unique=True),
+    )
 
     def __repr__(self):
         """
@@ -35,11 +39,12 @@ def generate_random_string():
     return ''.join(random.choice(characters) for _ in range(12))
 
 
-def create_ivitation(merchantname):
+def create_ivitation(session, merchantname):
     """
     Create an invitation code for a given merchant and stores in the database.
 
     Parameters:
+        session (Session): The database session of the request.
         merchantname (str): The name of the merchant for whom the code is
         created.
 
@@ -49,15 +54,16 @@ def create_ivitation(merchantname):
     code = generate_random_string()
     ivitation = Invitation(merchantname=merchantname, code=code)
     session.add(ivitation)
-    session.commit()
+    session.flush()
     return code
 
 
-def check_ivitation(merchantname, code):
+def check_ivitation(session, merchantname, code):
     """
     Check if an invitation code provided by a merchant exists in the database.
 
     Parameters:
+        session (Session): The database session of the request.
         merchantname (str): The name of the merchant who provided the code.
         code (str): The invitation code to be verified.
 
@@ -70,6 +76,6 @@ def check_ivitation(merchantname, code):
         ).first()
     if result:
         session.delete(result)
-        session.commit()
+        session.flush()
         return True
     return False
@@ -0,0 +1,107 @@
+"""
+Bring an existing database up to date with the models.
+
+`Base.metadata.create_all` creates missing tables together with their
+indexes, but it never changes a table that already exists. Databases
+created by older versions therefore lack the columns and indexes
+declared since, which this module adds.
+
+Functions:
+    add_missing_columns(engine, metadata): Add the missing columns.
+    create_missing_indexes(engine, metadata): Add the missing indexes.
+    migrate(engine): Run every migration step on the database.
+"""
+from sqlalchemy import inspect
+from sqlalchemy.schema import CreateColumn
+from sqlalchemy.exc import IntegrityError, OperationalError
+from .setting import Base
+from .search import ensure_search_index, FTS_TABLE
+
+
+def add_missing_columns(engine, metadata):
+    """
+    Add the declared columns that do not exist in the database yet.
+
+    New columns must have a server default, or allow NULL, so that the
+    rows already stored get a value.
+
+    Args:
+        engine (Engine): The engine of the database to upgrade.
+        metadata (MetaData): The metadata declaring the columns.
+
+    Returns:
+        list: The names of the columns that were added, as table.column.
+    """
+    inspector = inspect(engine)
+    added = []
+    with engine.begin() as connection:
+        for table in metadata.sorted_tables:
+            if not inspector.has_table(table.name):
+                continue
+            existing = {
+                column['name'] for column in inspector.get_columns(table.name)
+            }
+            for column in table.columns:
+                if column.name in existing:
+                    continue
+                definition = CreateColumn(column).compile(
+                    dialect=engine.dialect)
+                table_name = engine.dialect.identifier_preparer.format_table(
+                    table)
+                connection.exec_driver_sql(
+                    f"ALTER TABLE {table_name} ADD COLUMN {definition}"
+                    )
+                added.append(f"{table.name}.{column.name}")
+    return added
+
+
+def create_missing_indexes(engine, metadata):
+    """
+    Create the declared indexes that do not exist in the database yet.
+
+    An index that cannot be created, for example a unique index over
+    rows that hold duplicates, is reported and skipped.
+
+    Args:
+        engine (Engine): The engine of the database to upgrade.
+        metadata (MetaData): The metadata declaring the indexes.
+
+    Returns:
+        list: The names of the indexes that were created.
+    """
+    inspector = inspect(engine)
+    created = []
+    for table in metadata.sorted_tables:
+        if not inspector.has_table(table.name):
+            continue
+        existing = {
+            index['name'] for index in inspector.get_indexes(table.name)
+        }
+        for index in table.indexes:
+            if index.name in existing:
+                continue
+            try:
+                index.create(engine)
+            except (IntegrityError, OperationalError) as error:
+                print(f"Index {index.name} was not created: {error.orig}")
+            else:
+                created.append(index.name)
+    return created
+
+
+def migrate(engine):
+    """
+    Run every migration step on the database.
+
+    Args:
+        engine (Engine): The engine of the database to upgrade.
+    """
+    # Import the models so that all their tables are declared on Base
+    from . import model, invitation
+    model, invitation
+    for name in add_missing_columns(engine, Base.metadata):
+        print(f"Added column {name}")
+    for name in create_missing_indexes(engine, Base.metadata):
+        print(f"Created index {name}")
+    if ensure_search_index(engine):
+        print(f"Created search index {FTS_TABLE}")
@@ -1,7 +1,20 @@
-"""Contain classes associated with database tables, and exception classes."""
-from sqlalchemy import Column, Integer, String, Float, ForeignKey
-from .setting import engine, Base, session
-from sqlalchemy.orm import relationship
+"""
+Contain classes associated with database tables, and exception classes.
+
+Model methods work in the session their instance was loaded in, which is
+the session of the request being processed. They only flush their
+changes, committing is left to `cmd_process`.
+"""
+import time
+from sqlalchemy import Column, Integer, String, Float, ForeignKey, Index
+from sqlalchemy import bindparam, delete, func, select, update
+from .setting import engine, Base, PERSIST_LOGIN, RESERVATION_TTL
+from .setting import TOMBSTONE_LIMIT
+from .registry import registry
+from .notify import publish_on_commit
+from .search import attach_search_index
+from sqlalchemy.orm import object_session, relationship
+from sqlalchemy.orm.attributes import set_committed_value
 
 
 class InventoryShortage(Exception):
@@ -46,6 +59,64 @@ class InventoryShortage(Exception):
         return self.message
 
 
+class CartChanged(Exception):
+    """Raise when a cart changes while it is being checked out."""
+
+
+# Checkouts of a cart changed meanwhile, e.g. by the release of an
+# expired reservation, before giving up
+CHECKOUT_ATTEMPTS = 3
+
+
+def checkout_shortage(item):
+    """
+    Build the error of an item of a checkout short of stock.
+
+    Args:
+        item (Row): The item, with its product name and store name.
+
+    Returns:
+        InventoryShortage: The error to raise.
+    """
+    return InventoryShortage(
+        "Inventory shortage for product {} from merchant {}, \
+checkout was not fully executed and this item is still in your cart".format(
+            item.productname,
+            item.storename
+        )
+    )
+
+
+def next_catalog_version(session, merchant_id):
+    """
+    Increase the catalog version of a store and return it.
+
+    Every write to the products of a store gives them the next version,
+    so clients can ask for the products changed since the version they
+    already have.
+
+    Args:
+        session (Session): The session making the change.
+        merchant_id (int): The ID of the merchant owning the store.
+
+    Returns:
+        int: The new catalog version of the store.
+    """
+    merchant = Merchant.__table__
+    version = session.execute(
+        update(merchant).where(
+            merchant.c.merchantId == merchant_id
+        ).values(
+            catalog_version=merchant.c.catalog_version + 1
+        ).returning(merchant.c.catalog_version)
+    ).scalar_one()
+    loaded = session.identity_map.get(
+        session.identity_key(Merchant, merchant_id))
+    if loaded is not None:
+        set_committed_value(loaded, 'catalog_version', version)
+    return version
+
+
 class Client(Base):
     """
     Client class, corresponds to the 'client' table in the database.
@@ -63,9 +134,9 @@ class Client(Base):
     __tablename__ = 'client'
     clientId = Column(Integer, primary_key=True)
     username = Column(String, unique=True)
-    email = Column(String)
+    email = Column(String, index=True)
     password = Column(String)
-    connected_address = Column(String, default=None)
+    connected_address = Column(String, default=None, index=True)
     order = relationship("Order", backref="client")
 
     def get_username(self):
@@ -79,8 +150,9 @@ class Client(Base):
         Args:
             new_username (str): The new username to be set for the client.
         """
+        session = object_session(self)
         self.username = new_username
-        session.commit()
+        session.flush()
 
     def get_email(self):
         """Return the email of the client."""
@@ -93,8 +165,9 @@ class Client(Base):
         Args:
             new_email (str): The new email to be set for the client.
         """
+        session = object_session(self)
         self.email = new_email
-        session.commit()
+        session.flush()
 
     def verify_password(self, password):
         """
@@ -120,66 +193,118 @@ class Client(Base):
             bool: True if the password was successfully changed,
             False otherwise.
         """
+        session = object_session(self)
         if self.password == old_password:
             self.password = new_password
-            session.commit()
+            session.flush()
             return True
         return False
 
     def client_login(self, password, connected_address):
         """
-        Log the client in by setting connected address, verifying the password.
+        Log the client in by binding the connection, verifying the password.
+
+        The connected address is only stored in the database when the
+        persisted login mirror is enabled.
 
         Parameters:
             password (str): The client's password for verification.
             connected_address (str): The address to set as connected.
-        """
-        if self.verify_password(password):
+
+        Returns:
+            bool: True if the client is now logged in on the connection.
+        """
+        session = object_session(self)
+        if not self.verify_password(password):
+            return False
+        if not registry.login_client(connected_address, self.clientId):
+            return False
+        if PERSIST_LOGIN:
             self.connected_address = connected_address
-            session.commit()
+            session.flush()
+        return True
 
-    def client_logout(self):
-        """Log the client out by clearing their connected address."""
-        self.connected_address = None
-        session.commit()
+    def client_logout(self, connected_address):
+        """
+        Log the client out of a connection.
+
+        Parameters:
+            connected_address (str): The address of the connection.
+        """
+        session = object_session(self)
+        registry.logout_client(connected_address)
+        if PERSIST_LOGIN:
+            self.connected_address = None
+            session.flush()
 
     def add_item(self, product_id, quantity):
         """
         Add or increase quantity of product to the order.
 
+        When reservations are enabled, the quantity added is taken from the
+        stock of the product and held for the client until the reservation
+        expires, which adding more of the product extends.
+
         Parameters:
             product_id (int): The ID of the product to add.
             quantity (int): The quantity of the product to add.
+
+        Returns:
+            int: The quantity reserved, 0 if reservations are disabled.
+
+        Raises:
+            InventoryShortage: If the stock cannot cover the reservation.
         """
+        session = object_session(self)
+        reserved = 0
+        if RESERVATION_TTL > 0:
+            # Taken before the cart changes, so a shortage changes nothing
+            product = session.get(Product, product_id)
+            if not product.adjust_stock(-quantity):
+                raise InventoryShortage(
+                    "Inventory shortage for product {}".format(
+                        product.productname))
+            reserved = quantity
         result = session.query(Order).filter(
             Order.client_id == self.clientId,
             Order.product_id == product_id
             ).first()
-        if result:
-            result.quantity += quantity
-            session.commit()
-        else:
-            new_item = Order(
+        if not result:
+            result = Order(
                 client_id=self.clientId,
-                quantity=quantity,
+                quantity=0,
+                reserved=0,
                 product_id=product_id
                 )
-            session.add(new_item)
-            session.commit()
+            session.add(result)
+        result.quantity += quantity
+        if reserved:
+            result.reserved += reserved
+            result.reserved_until = time.time() + RESERVATION_TTL
+        session.flush()
+        return reserved
 
     def remove_item(self, product_id):
         """
         Remove a product from the client's order.
 
+        The stock reserved for the item is given back to the product.
+
         Parameters:
             product_id (int): The ID of the product to remove.
+
+        Returns:
+            int: The quantity that was reserved.
         """
+        session = object_session(self)
         result = session.query(Order).filter(
             Order.client_id == self.clientId,
             Order.product_id == product_id
             ).first()
+        reserved = result.release()
         session.delete(result)
-        session.commit()
+        session.flush()
+        return reserved
 
     def get_items(self):
         """
@@ -189,6 +314,7 @@ class Client(Base):
             list: A list of tuples containing store name, product name, price,
             and quantity of each item.
         """
+        session = object_session(self)
         result = session.query(
             Merchant.storename,
             Product.productId,
@@ -201,7 +327,7 @@ class Client(Base):
                 Merchant, Product.merchant_id == Merchant.merchantId
             ).filter(
                 Order.client_id == self.clientId
-            ).all()
+            ).order_by(Order.id).all()
         return result
 
     def get_price(self):
@@ -211,27 +337,170 @@ class Client(Base):
         Returns:
             float: The total price of the items.
         """
-        sum_price = 0
-        item_list = self.get_items()
-        for item in item_list:
-            sum_price += item[3]*item[4]
-        return sum_price
+        session = object_session(self)
+        return session.query(
+            func.coalesce(func.sum(Product.price*Order.quantity), 0)
+            ).select_from(Order).join(
+                Product, Order.product_id == Product.productId
+            ).filter(
+                Order.client_id == self.clientId
+            ).scalar()
+
+    def get_cart(self):
+        """
+        Retrieve the items in the client's basket and their total price.
+
+        Both come from a single query, the total being computed by a
+        window function over the same rows.
+
+        Returns:
+            tuple: The list of items as returned by `get_items`, and the
+            total price of the items.
+        """
+        session = object_session(self)
+        rows = session.query(
+            Merchant.storename,
+            Product.productId,
+            Product.productname,
+            Product.price,
+            Order.quantity,
+            func.sum(Product.price*Order.quantity).over()
+            ).join(
+                Product, Order.product_id == Product.productId
+            ).join(
+                Merchant, Product.merchant_id == Merchant.merchantId
+            ).filter(
+                Order.client_id == self.clientId
+            ).order_by(Order.id).all()
+        total = rows[0][5] if rows else 0
+        return [row[:5] for row in rows], total
 
     def checkout_item(self):
-        """Check out all items in the client's basket, finalizing the order."""
-        for item in self.order:
-            if item.quantity <= item.product.stock:
-                item.checkout()
-                session.delete(item)
-                session.commit()
-            else:
-                raise InventoryShortage(
-                    "Inventory shortage for product {} from merchant {}, \
-checkout was not fully executed and this item is still in your cart".format(
-                        item.product.productname,
-                        item.product.merchant.storename
-                    )
-                )
+        """
+        Check out all items in the client's basket, finalizing the order.
+
+        The stock of every item is checked with one query before anything
+        changes. Stock, merchant profits and the basket are then updated
+        with set-based statements in a savepoint, so a shortage on any item
+        leaves the whole basket unchanged. The stock is only decreased
+        where it still covers the quantity, so concurrent checkouts cannot
+        oversell even on backends without row locks. The quantity reserved
+        for an item was already taken from the stock.
+
+        SQLite reads the cart outside of any transaction and ignores the
+        row locks, so an item is only deleted if its quantity and
+        reservation are still the ones read. Otherwise the checkout is
+        rolled back and tried again on the current cart.
+
+        Returns:
+            set: The store names of the products checked out.
+        """
+        for attempt in range(CHECKOUT_ATTEMPTS):
+            try:
+                return self._checkout_cart()
+            except CartChanged:
+                continue
+        raise InventoryShortage(
+            "Your cart changed during the checkout, please try again")
+
+    def _checkout_cart(self):
+        """
+        Check out the cart as read at the beginning of the call.
+
+        Returns:
+            set: The store names of the products checked out.
+
+        Raises:
+            CartChanged: If an item changed since it was read, nothing
+                was changed then.
+        """
+        session = object_session(self)
+        items = session.query(
+            Order.id,
+            Order.product_id,
+            Order.quantity,
+            Order.reserved,
+            Product.productname,
+            Product.description,
+            Product.price,
+            Product.stock,
+            Product.merchant_id,
+            Merchant.storename
+            ).join(
+                Product, Order.product_id == Product.productId
+            ).join(
+                Merchant, Product.merchant_id == Merchant.merchantId
+            ).filter(
+                Order.client_id == self.clientId
+            ).order_by(Order.id).with_for_update(of=[Product, Order]).all()
+        for item in items:
+            if item.quantity - item.reserved > item.stock:
+                raise checkout_shortage(item)
+        if not items:
+            return set()
+        profits = {}
+        for item in items:
+            profits[item.merchant_id] = profits.get(item.merchant_id, 0) \
+                + item.price*item.quantity
+        product = Product.__table__
+        with session.begin_nested():
+            versions = {
+                merchant_id: next_catalog_version(session, merchant_id)
+                for merchant_id in profits
+            }
+            taken = session.execute(
+                update(product).where(
+                    product.c.productId == bindparam('product_id'),
+                    product.c.stock >= bindparam('quantity')
+                ).values(
+                    stock=product.c.stock - bindparam('quantity'),
+                    version=bindparam('new_version')
+                ),
+                [{'product_id': item.product_id,
+                  'quantity': item.quantity - item.reserved,
+                  'new_version': versions[item.merchant_id]}
+                 for item in items]
+            )
+            if taken.rowcount != len(items):
+                # The stock changed since it was checked, the products
+                # left without the new version are the ones short
+                current = dict(session.execute(
+                    select(product.c.productId, product.c.version).where(
+                        product.c.productId.in_(
+                            [item.product_id for item in items]))
+                ).all())
+                raise checkout_shortage(next(
+                    item for item in items
+                    if current[item.product_id] != versions[item.merchant_id]
+                ))
+            merchant = Merchant.__table__
+            session.execute(
+                update(merchant).where(
+                    merchant.c.merchantId == bindparam('merchant_id')
+                ).values(profit=merchant.c.profit + bindparam('amount')),
+                [{'merchant_id': merchant_id, 'amount': amount}
+                 for merchant_id, amount in profits.items()]
+            )
+            order = Order.__table__
+            deleted = session.execute(
+                delete(order).where(
+                    order.c.id == bindparam('order_id'),
+                    order.c.quantity == bindparam('seen_quantity'),
+                    order.c.reserved == bindparam('seen_reserved')
+                ),
+                [{'order_id': item.id, 'seen_quantity': item.quantity,
+                  'seen_reserved': item.reserved} for item in items]
+            )
+            if deleted.rowcount != len(items):
+                # The stock taken above used a stale reservation
+                raise CartChanged()
+        for item in items:
+            publish_on_commit(session, item.storename, (
+                item.product_id, item.storename, item.productname,
+                item.description, item.price,
+                item.stock - item.quantity + item.reserved, False
+                ))
+        return {item.storename for item in items}
 
 
 class Order(Base):
@@ -242,16 +511,27 @@ class Order(Base):
 
     Associate with the Product class through a relationship.
 
-    Provide methods for setting and getting quantities,
-    as well as a method for checking out the current item.
+    Provide methods for setting and getting quantities, and for releasing
+    the stock reserved for the item.
     """
 
     __tablename__ = 'order'
     id = Column(Integer, primary_key=True)
     client_id = Column(Integer, ForeignKey('client.clientId'))
-    product_id = Column(Integer, ForeignKey('product.productId'))
+    product_id = Column(Integer, ForeignKey('product.productId'), index=True)
     quantity = Column(Integer)
+    # Part of the quantity taken from the stock and held for the client,
+    # until the time given in seconds since the epoch
+    reserved = Column(Integer, nullable=False, default=0, server_default='0')
+    reserved_until = Column(Float)
     product = relationship("Product")
+    # A product appears at most once in a cart, the index also serves
+    # lookups by client_id alone
+    __table_args__ = (
+        Index('ix_order_client_id_product_id', client_id, product_id,
+              unique=True),
+        Index('ix_order_reserved_until', reserved_until),
+    )
 
     def set_quantity(self, new_quantity):
         """
@@ -260,16 +540,42 @@ class Order(Base):
         Args:
             new_quantity (int): The quantity to be set for the order.
         """
+        session = object_session(self)
         self.quantity = new_quantity
-        session.commit()
+        session.flush()
 
     def get_quantity(self):
         """Get quantity for the order."""
         return self.quantity
 
-    def checkout(self):
-        """Check out the current item, by the purchase method to purchase."""
-        self.product.purchase(self.quantity)
+    def release(self):
+        """
+        Give the stock reserved for the item back to the product.
+
+        Returns:
+            int: The quantity that was reserved.
+        """
+        session = object_session(self)
+        session.flush()
+        reserved = self.reserved or 0
+        if not reserved:
+            return 0
+        # Claim the reservation first, a checkout or another release may
+        # have used it since it was read
+        order = Order.__table__
+        claimed = session.execute(
+            update(order).where(
+                order.c.id == self.id,
+                order.c.reserved == reserved
+            ).values(reserved=0, reserved_until=None)
+        ).rowcount
+        if not claimed:
+            session.expire(self)
+            return 0
+        set_committed_value(self, 'reserved', 0)
+        set_committed_value(self, 'reserved_until', None)
+        self.product.adjust_stock(reserved)
+        return reserved
 
 
 class Product(Base):
@@ -280,7 +586,7 @@ class Product(Base):
     description, merchant ID, etc.
 
     Provide methods for getting and setting product names, prices,
-    descriptions, as well as methods for restocking and purchasing.
+    descriptions, as well as methods for restocking and adjusting stock.
     """
 
     __tablename__ = 'product'
@@ -289,7 +595,14 @@ class Product(Base):
     price = Column(Float)
     stock = Column(Integer)
     description = Column(String)
-    merchant_id = Column(Integer, ForeignKey('merchant.merchantId'))
+    merchant_id = Column(Integer, ForeignKey('merchant.merchantId'),
+                         index=True)
+    # Catalog version of the store when the product last changed
+    version = Column(Integer, nullable=False, default=0, server_default='0')
+
+    __table_args__ = (
+        Index('ix_product_merchant_id_version', merchant_id, version),
+    )
 
     def get_productname(self):
         """Get the name of the product."""
@@ -302,8 +615,11 @@ class Product(Base):
         Args:
             new_productname (str): The new name to be set for the product.
         """
+        session = object_session(self)
         self.productname = new_productname
-        session.commit()
+        self.touch()
+        session.flush()
+        self.publish_change()
 
     def get_price(self):
         """
@@ -321,8 +637,11 @@ class Product(Base):
         Args:
             new_price (float): The new price to be set for the product.
         """
+        session = object_session(self)
         self.price = new_price
-        session.commit()
+        self.touch()
+        session.flush()
+        self.publish_change()
 
     def get_description(self):
         """
@@ -341,8 +660,11 @@ class Product(Base):
             new_description (str): The new description to be set for the
             product.
         """
+        session = object_session(self)
         self.description = new_description
-        session.commit()
+        self.touch()
+        session.flush()
+        self.publish_change()
 
     def restock(self, quantity):
         """
@@ -351,19 +673,60 @@ class Product(Base):
         Parameters:
             quantity (int): The quantity to be added to the stock.
         """
-        self.stock += quantity
-        session.commit()
+        self.adjust_stock(quantity)
 
-    def purchase(self, quantity):
+    def adjust_stock(self, change):
         """
-        Process the purchase, reduce the stock and increase the profit.
+        Change the stock in one statement, unless it would become negative.
+
+        The stock is updated in the database instead of being written back
+        from this instance, so concurrent changes are never lost.
+
+        Parameters:
+            change (int): The quantity added to the stock, negative to take.
+
+        Returns:
+            bool: True if the stock was changed, False on a shortage.
+        """
+        session = object_session(self)
+        product = Product.__table__
+        stock = session.execute(
+            update(product).where(
+                product.c.productId == self.productId,
+                product.c.stock >= -change
+            ).values(
+                stock=product.c.stock + change
+            ).returning(product.c.stock)
+        ).scalar()
+        if stock is None:
+            return False
+        set_committed_value(self, 'stock', stock)
+        self.touch()
+        session.flush()
+        self.publish_change()
+        return True
+
+    def touch(self):
+        """Give the product the next catalog version of its store."""
+        self.version = next_catalog_version(
+            object_session(self), self.merchant_id)
+
+    def publish_change(self, deleted=False):
+        """
+        Push the product to the subscribers of its store once committed.
 
         Parameters:
-            quantity (int): The quantity of the product to be purchased.
+            deleted (bool): Whether the product is being deleted.
         """
-        self.stock -= quantity
-        self.merchant.profit += self.price*quantity
-        session.commit()
+        storename = self.merchant.storename
+        publish_on_commit(object_session(self), storename, (
+            self.productId, storename, self.productname, self.description,
+            self.price, self.stock, deleted
+            ))
+
+
+# Keep the full-text index of the products with the product table
+attach_search_index(Product.__table__)
 
 
 class Merchant(Base):
@@ -384,10 +747,13 @@ class Merchant(Base):
     merchantId = Column(Integer, primary_key=True)
     storename = Column(String, unique=True)
     description = Column(String)
-    email = Column(String)
+    email = Column(String, index=True)
     password = Column(String)
-    connected_address = Column(String, default=None)
+    connected_address = Column(String, default=None, index=True)
     profit = Column(Float, default=0.0)
+    # Increased by every write to the products of the store
+    catalog_version = Column(
+        Integer, nullable=False, default=0, server_default='0')
     product = relationship("Product", backref="merchant")
 
     def get_storename(self):
@@ -407,8 +773,9 @@ class Merchant(Base):
             new_storename (str): The new store name to be set.
 
         """
+        session = object_session(self)
         self.storename = new_storename
-        session.commit()
+        session.flush()
 
     def get_description(self):
         """
@@ -427,8 +794,9 @@ class Merchant(Base):
             new_description (str): The new description to be set.
 
         """
+        session = object_session(self)
         self.description = new_description
-        session.commit()
+        session.flush()
 
     def get_email(self):
         """
@@ -447,8 +815,9 @@ class Merchant(Base):
             new_email (str): The new email to be set.
 
         """
+        session = object_session(self)
         self.email = new_email
-        session.commit()
+        session.flush()
 
     def get_profit(self):
         """
@@ -483,9 +852,10 @@ class Merchant(Base):
             bool: True if the password was successfully changed,
             False otherwise.
         """
+        session = object_session(self)
         if self.password == old_password:
             self.password = new_password
-            session.commit()
+            session.flush()
             return True
         return False
 
@@ -493,37 +863,112 @@ class Merchant(Base):
         """
         Log the merchant in by connected address and verifying their password.
 
+        The connected address is only stored in the database when the
+        persisted login mirror is enabled.
+
         Parameters:
             password (str): The merchant's password for verification.
             connected_address (str): The address to set as connected.
-        """
-        if self.verify_password(password):
+
+        Returns:
+            bool: True if the merchant is now logged in on the connection.
+        """
+        session = object_session(self)
+        if not self.verify_password(password):
+            return False
+        if not registry.login_merchant(connect, self.merchantId):
+            return False
+        if PERSIST_LOGIN:
             self.connected_address = connect
-            session.commit()
+            session.flush()
+        return True
 
-    def merchant_logout(self):
-        """Log the merchant out by clearing their connected address."""
-        self.connected_address = None
-        session.commit()
+    def merchant_logout(self, connect):
+        """
+        Log the merchant out of a connection.
+
+        Parameters:
+            connect (str): The address of the connection.
+        """
+        session = object_session(self)
+        registry.logout_merchant(connect)
+        if PERSIST_LOGIN:
+            self.connected_address = None
+            session.flush()
+
+    def product_query(self):
+        """
+        Build the query of the products associated with this merchant.
+
+        Returns:
+            Query: Unordered query of the product id, store name, product
+            name, description, price and stock of each product.
+        """
+        session = object_session(self)
+        return session.query(
+            Product.productId,
+            Merchant.storename,
+            Product.productname,
+            Product.description,
+            Product.price,
+            Product.stock
+            ).join(
+                Merchant, Product.merchant_id == Merchant.merchantId
+            ).filter(
+                Product.merchant_id == self.merchantId
+            )
 
     def get_product_list(self):
         """
         Retrieve a list of products associated with this merchant.
 
         Returns:
-            list: A list of Product objects.
-        """
-        product_list = []
-        for product in self.product:
-            product_list.append([
-                product.productId,
-                product.merchant.storename,
-                product.productname,
-                product.description,
-                product.price,
-                product.stock
-                ])
-        return product_list
+            list: A list of tuples containing product id, store name,
+            product name, description, price and stock of each product.
+        """
+        return self.product_query().order_by(Product.productId).all()
+
+    def get_product_changes(self, since):
+        """
+        Retrieve the products changed since a catalog version.
+
+        Parameters:
+            since (int): The catalog version the caller already has, 0 for
+            none.
+
+        Returns:
+            tuple: The rows of the products added or changed, as returned
+            by `get_product_list`, the IDs of the products deleted, the
+            current catalog version, and whether the rows are the whole
+            product list. They are if `since` is 0, newer than the
+            current version, or older than the deletions still
+            remembered, in which case no IDs are deleted.
+        """
+        session = object_session(self)
+        version = session.query(Merchant.catalog_version).filter(
+            Merchant.merchantId == self.merchantId
+            ).scalar()
+        full = since <= 0 or since > version
+        tombstones = session.query(
+            ProductTombstone.product_id, ProductTombstone.version
+            ).filter(
+                ProductTombstone.merchant_id == self.merchantId,
+                ProductTombstone.version > since
+            ).order_by(ProductTombstone.version).all()
+        if not full and len(tombstones) >= TOMBSTONE_LIMIT > 0:
+            # Older tombstones may have been pruned, see `del_product`
+            full = session.query(ProductTombstone.id).filter(
+                ProductTombstone.merchant_id == self.merchantId,
+                ProductTombstone.version <= since
+                ).first() is None
+        query = self.product_query()
+        if full:
+            return query.order_by(Product.productId).all(), [], version, True
+        rows = query.filter(
+            Product.version > since
+            ).order_by(Product.productId).all()
+        deleted = [row.product_id for row in tombstones]
+        return rows, deleted, version, False
 
     def add_product(self, productname, price, description):
         """
@@ -534,28 +979,90 @@ class Merchant(Base):
             price (float): The price of the new product.
             description (str): The description of the new product.
         """
+        session = object_session(self)
         new_product = Product(
             productname=productname,
             price=price,
             stock=0,
             description=description,
-            merchant_id=self.merchantId
+            merchant_id=self.merchantId,
+            version=next_catalog_version(session, self.merchantId)
             )
         session.add(new_product)
-        session.commit()
+        session.flush()
+        new_product.publish_change()
 
     def del_product(self, id):
         """
-        Delete a product by its ID from the 'product' table.
+        Delete a product of this merchant by its ID.
 
         Parameters:
             product_id (int): The ID of the product to delete.
+
+        Returns:
+            bool: False if this merchant has no product with this ID.
         """
-        result = session.query(Product).filter(Product.productId == id).first()
+        session = object_session(self)
+        result = session.query(Product).filter(
+            Product.productId == id,
+            Product.merchant_id == self.merchantId
+            ).first()
+        if result is None:
+            return False
+        result.publish_change(deleted=True)
+        session.add(ProductTombstone(
+            product_id=result.productId,
+            merchant_id=result.merchant_id,
+            version=next_catalog_version(session, result.merchant_id)
+            ))
         session.delete(result)
-        session.commit()
+        session.flush()
+        prune_tombstones(session, self.merchantId)
+        return True
+
+
+class ProductTombstone(Base):
+    """
+    ProductTombstone class, corresponds to the 'product_tombstone' table.
+
+    Remember the deleted products, so that clients syncing the product
+    list of a store since a catalog version also learn about deletions.
+    Only the last `TOMBSTONE_LIMIT` of each store are kept.
+    """
+
+    __tablename__ = 'product_tombstone'
+    id = Column(Integer, primary_key=True)
+    product_id = Column(Integer)
+    merchant_id = Column(Integer, ForeignKey('merchant.merchantId'))
+    # Catalog version of the store when the product was deleted
+    version = Column(Integer)
+
+    __table_args__ = (
+        Index('ix_product_tombstone_merchant_id_version',
+              merchant_id, version),
+    )
+
+
+def prune_tombstones(session, merchant_id):
+    """
+    Forget the deleted products of a store beyond `TOMBSTONE_LIMIT`.
+
+    Parameters:
+        session (Session): The session deleting the products.
+        merchant_id (int): The ID of the merchant of the store.
+    """
+    if TOMBSTONE_LIMIT <= 0:
+        return
+    oldest_kept = session.query(ProductTombstone.version).filter(
+        ProductTombstone.merchant_id == merchant_id
+        ).order_by(ProductTombstone.version.desc()).offset(
+            TOMBSTONE_LIMIT - 1).limit(1).scalar()
+    if oldest_kept is not None:
+        session.query(ProductTombstone).filter(
+            ProductTombstone.merchant_id == merchant_id,
+            ProductTombstone.version < oldest_kept
+            ).delete(synchronize_session=False)
 
 
 # Create the corresponding Tabel in database
 Base.metadata.create_all(engine)
-session.close()
@@ -0,0 +1,167 @@
+"""
+Push changes of the product lists to the connections subscribed to them.
+
+A connection subscribes to a store with SUBSCRIBE_STORE. Every product
+added, changed, restocked, sold or deleted in that store is then sent to
+it as a push message, instead of the client polling LIST_PRODUCT:
+
+    ["PUSH STORE_CHANGED", storename, changes]
+
+`changes` is a table with the columns of LIST_PRODUCT followed by a
+`deleted` column, holding the current row of every product that changed.
+The model records the changes with `publish_on_commit`, and they are only
+pushed once the transaction commits.
+
+Classes:
+    NotificationHub: Track the subscriptions and deliver push messages.
+
+Functions:
+    publish_on_commit(session, storename, row): Push a change once committed.
+"""
+import threading
+from sqlalchemy import event
+from .resultset import ResultSet
+from .setting import Session
+
+# Request id of the messages that do not answer a request
+PUSH = "PUSH"
+
+CHANGE_COLUMNS = ['product_id', 'storename', 'productname', 'description',
+                  'price', 'stock', 'deleted']
+
+
+class NotificationHub:
+    """
+    Track which connections are subscribed to which stores.
+
+    The hub does not know how to reach a connection. The server attaches
+    a delivery function, which may be called from any thread.
+
+    When the server runs several processes, each one has a hub for its
+    own connections. The changes are forwarded to the hubs of the other
+    processes through their inboxes, see `link`.
+    """
+
+    def __init__(self):
+        """Initialize a hub without subscriptions."""
+        self.subscribers = {}
+        self.deliver = None
+        self.peers = []
+        self.lock = threading.Lock()
+
+    def attach(self, deliver):
+        """
+        Set how push messages reach the connections.
+
+        Args:
+            deliver (callable): Called with the address of a connection and
+                the message to send it, None to stop delivering.
+        """
+        self.deliver = deliver
+
+    def subscribe(self, connected_address, storename):
+        """
+        Subscribe a connection to the changes of a store.
+
+        Args:
+            connected_address (str): The address of the connection.
+            storename (str): The name of the store.
+        """
+        with self.lock:
+            self.subscribers.setdefault(storename, set()).add(
+                connected_address)
+
+    def unsubscribe(self, connected_address, storename=None):
+        """
+        Unsubscribe a connection from a store, or from every store.
+
+        Args:
+            connected_address (str): The address of the connection.
+            storename (str): The name of the store, None for all of them.
+        """
+        with self.lock:
+            names = list(self.subscribers) if storename is None \
+                else [storename]
+            for name in names:
+                connections = self.subscribers.get(name)
+                if connections is None:
+                    continue
+                connections.discard(connected_address)
+                if not connections:
+                    del self.subscribers[name]
+
+    def link(self, inbox, peers):
+        """
+        Exchange the changes with the hubs of the other processes.
+
+        A daemon thread publishes the changes received in the inbox of
+        this process.
+
+        Args:
+            inbox (multiprocessing.Queue): The inbox of this process.
+            peers (list): The inboxes of the other processes.
+        """
+        self.peers = list(peers)
+
+        def receive():
+            while True:
+                storename, rows = inbox.get()
+                self.publish(storename, rows, forward=False)
+
+        threading.Thread(
+            target=receive, name='cybermarket-hub', daemon=True).start()
+
+    def publish(self, storename, rows, forward=True):
+        """
+        Push the changes of a store to its subscribers.
+
+        Args:
+            storename (str): The name of the store.
+            rows (list): The changed rows, in the order of CHANGE_COLUMNS.
+            forward (bool): Also send the changes to the other processes.
+        """
+        if forward:
+            for peer in self.peers:
+                peer.put((storename, rows))
+        deliver = self.deliver
+        with self.lock:
+            connections = list(self.subscribers.get(storename, ()))
+        if deliver is None or not connections:
+            return
+        message = [PUSH + " STORE_CHANGED", storename,
+                   ResultSet.from_rows(CHANGE_COLUMNS, rows)]
+        for connected_address in connections:
+            deliver(connected_address, message)
+
+
+def publish_on_commit(session, storename, row):
+    """
+    Push a product change once the transaction of a session commits.
+
+    Args:
+        session (Session): The session making the change.
+        storename (str): The name of the store of the product.
+        row (tuple): The product after the change, in the order of
+            CHANGE_COLUMNS. A later change of the same product replaces it.
+    """
+    changes = session.info.setdefault('store_changes', {})
+    changes.setdefault(storename, {})[row[0]] = row
+
+
+@event.listens_for(Session, 'after_commit')
+def _publish_committed(session):
+    """Push the changes made by the transaction that committed."""
+    changes = session.info.pop('store_changes', None)
+    for storename, rows in (changes or {}).items():
+        hub.publish(storename, list(rows.values()))
+
+
+@event.listens_for(Session, 'after_soft_rollback')
+def _discard_rolled_back(session, previous_transaction):
+    """Forget the changes of a transaction that was rolled back."""
+    if not previous_transaction.nested:
+        session.info.pop('store_changes', None)
+
+
+# Hub shared by every handler of this process
+hub = NotificationHub()
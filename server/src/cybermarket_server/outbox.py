@@ -0,0 +1,159 @@
+"""
+Bounded queue of the messages waiting to be sent to one connection.
+
+A client that reads its replies slower than they are produced, such as
+a phone on a poor network, used to make its queue, and the memory of the
+server, grow without limit. The outbox holds at most `send_queue`
+messages (see `config`), and what happens to a message that finds it
+full depends on the slow consumer policy:
+
+- `block`: the producer waits for room. The requests of the connection
+  wait for their replies to be queued, so the server stops reading from
+  it once the worker pool admits no more of them. Push messages wait in
+  the worker thread committing the change, which slows down the writes
+  to the stores the connection is subscribed to.
+- `drop`: push messages are dropped, and requests wait like with
+  `block`. The client can reload the listing it subscribed to.
+- `disconnect`: the connection is closed.
+
+The writer of the connection takes every queued message at once, so the
+replies of pipelined requests leave in a single write.
+
+Classes:
+    Outbox: The messages waiting to be sent to one connection.
+"""
+import asyncio
+from collections import deque
+
+SLOW_CONSUMER_POLICIES = ('block', 'drop', 'disconnect')
+
+
+class Outbox:
+    """
+    The messages waiting to be sent to one connection.
+
+    It must be used from the event loop of the connection only.
+
+    Attributes:
+        limit (int): The number of messages held at most, 0 for no limit.
+        policy (str): The slow consumer policy, one of
+            SLOW_CONSUMER_POLICIES.
+        closed (bool): True once the connection is closed, or was too
+            slow with the `disconnect` policy.
+        dropped (int): The number of push messages dropped.
+        last_sent (float): The event loop time of the last messages
+            taken by the writer.
+    """
+
+    def __init__(self, limit=0, policy='drop'):
+        """
+        Initialize an empty outbox.
+
+        Args:
+            limit (int): The number of messages held at most, 0 for no
+                limit.
+            policy (str): The slow consumer policy.
+        """
+        if policy not in SLOW_CONSUMER_POLICIES:
+            raise ValueError(f"Unknown slow consumer policy {policy}")
+        self.limit = limit
+        self.policy = policy
+        self.messages = deque()
+        self.closed = False
+        self.dropped = 0
+        self.last_sent = 0.0
+        self.ready = asyncio.Event()
+        self.room = asyncio.Event()
+        self.room.set()
+
+    def __len__(self):
+        """Return the number of messages waiting."""
+        return len(self.messages)
+
+    def full(self):
+        """
+        Tell whether the outbox holds as many messages as it can.
+
+        Returns:
+            bool: True if a new message would exceed the limit.
+        """
+        return 0 < self.limit <= len(self.messages)
+
+    def _append(self, message):
+        """Queue a message and wake up the writer."""
+        self.messages.append(message)
+        self.ready.set()
+
+    async def put(self, message):
+        """
+        Queue a message, waiting for room unless the policy disconnects.
+
+        The message is discarded if the outbox is or gets closed.
+
+        Args:
+            message (list): The message to send.
+        """
+        while self.full() and not self.closed:
+            if self.policy == 'disconnect':
+                self.close()
+                return
+            self.room.clear()
+            await self.room.wait()
+        if not self.closed:
+            self._append(message)
+
+    def push(self, message):
+        """
+        Queue a message without waiting, applying the policy when full.
+
+        With the `block` policy, the message is queued even over the
+        limit, since the caller cannot wait.
+
+        Args:
+            message (list): The message to send.
+
+        Returns:
+            bool: True if the message was queued.
+        """
+        if self.closed:
+            return False
+        if self.full():
+            if self.policy == 'disconnect':
+                self.close()
+                return False
+            if self.policy == 'drop':
+                self.dropped += 1
+                return False
+        self._append(message)
+        return True
+
+    async def take(self):
+        """
+        Wait for messages and take all of them.
+
+        Returns:
+            list: The queued messages, in order, empty once closed and
+            all taken.
+        """
+        await self.ready.wait()
+        messages = list(self.messages)
+        self.messages.clear()
+        if not self.closed:
+            self.ready.clear()
+        self.room.set()
+        self.last_sent = asyncio.get_running_loop().time()
+        return messages
+
+    def close(self, discard=True):
+        """
+        Stop queueing messages and wake up everyone waiting.
+
+        Args:
+            discard (bool): Drop the queued messages, instead of leaving
+                them to the writer for a last write.
+        """
+        self.closed = True
+        if discard:
+            self.messages.clear()
+        self.ready.set()
+        self.room.set()
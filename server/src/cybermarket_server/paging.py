@@ -0,0 +1,72 @@
+"""
+Split listings into pages with keyset cursors.
+
+A page is read by ordering the rows on a sort key and taking the rows
+that come after the last row of the previous page, instead of skipping
+the previous rows with an offset. Each page therefore costs the same
+however deep the caller is in the listing, and rows added or deleted
+meanwhile do not shift the pages.
+
+The cursor is the list of the sort key values of the last row of a page.
+Clients send it back unchanged to get the next page.
+
+Functions:
+    page_size(limit): Read the number of rows of a page.
+    keyset_page(query, keys, limit, cursor): Return one page of a query.
+"""
+from sqlalchemy import and_, or_
+from .setting import MAX_PAGE_SIZE
+
+
+def page_size(limit):
+    """
+    Read the number of rows of a page asked for by a client.
+
+    Args:
+        limit (int): The number of rows asked for.
+
+    Returns:
+        int: The limit, brought within 1 and MAX_PAGE_SIZE, or None if it
+        is not an integer.
+    """
+    try:
+        return max(1, min(int(limit), MAX_PAGE_SIZE))
+    except (TypeError, ValueError):
+        return None
+
+
+def keyset_page(query, keys, limit, cursor=None):
+    """
+    Return one page of the rows of a query.
+
+    Args:
+        query (Query): The query of the rows, without ORDER BY.
+        keys (list): The sort key as (column, index) pairs, where index is
+            the position of the column value in a row. The last column
+            must be unique, so that the order of the rows is total.
+        limit (int): The number of rows of a page, see `page_size`.
+        cursor (list): The cursor returned with the previous page, None
+            for the first page.
+
+    Returns:
+        tuple: The rows of the page, and the cursor of the next page, None
+        if this is the last page.
+    """
+    limit = page_size(limit)
+    if limit is None:
+        raise ValueError("The page size is not an integer")
+    if cursor:
+        # Rows after the cursor in the lexicographic order of the key
+        after = []
+        for position, (column, index) in enumerate(keys):
+            equal = [keys[previous][0] == cursor[previous]
+                     for previous in range(position)]
+            after.append(and_(*equal, column > cursor[position]))
+        query = query.filter(or_(*after))
+    rows = query.order_by(
+        *(column for column, index in keys)
+        ).limit(limit + 1).all()
+    if len(rows) <= limit:
+        return rows, None
+    rows = rows[:limit]
+    return rows, [rows[-1][index] for column, index in keys]
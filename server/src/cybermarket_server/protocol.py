@@ -0,0 +1,98 @@
+"""
+Length-prefixed framing of the messages exchanged with the client.
+
+Every message on the wire is a frame made of a fixed-size header holding
+the length of the payload, followed by the payload itself. This allows
+several messages to be sent back to back on one connection and messages
+to be larger than what a single read returns.
+
+Functions:
+    encode_frame(payload): Prepend the length header to a payload.
+
+Classes:
+    FrameDecoder: Incrementally split a byte stream back into payloads.
+    ProtocolError: Raised when the byte stream is not a valid frame stream.
+"""
+import struct
+
+# Unsigned 32-bit length in network byte order
+HEADER = struct.Struct('!I')
+# Refuse frames that are clearly not produced by a well-behaved peer
+MAX_FRAME_SIZE = 16 * 1024 * 1024
+
+
+class ProtocolError(Exception):
+    """Raise when the received data does not follow the framing protocol."""
+
+
+def encode_frame(payload):
+    """
+    Wrap a payload into a frame ready to be written to the socket.
+
+    Args:
+        payload (bytes): The serialized message.
+
+    Returns:
+        bytes: The length header followed by the payload.
+    """
+    if len(payload) > MAX_FRAME_SIZE:
+        raise ProtocolError(
+            "Frame of {} bytes exceeds the limit of {} bytes".format(
+                len(payload), MAX_FRAME_SIZE
+            )
+        )
+    return HEADER.pack(len(payload)) + payload
+
+
+class FrameDecoder:
+    """
+    Streaming decoder turning received chunks into complete payloads.
+
+    Chunks are appended with `feed`, which returns every frame completed
+    so far. Incomplete frames are kept in the buffer until the rest of
+    their bytes arrive.
+    """
+
+    def __init__(self, max_frame_size=MAX_FRAME_SIZE):
+        """
+        Initialize an empty decoder.
+
+        Args:
+            max_frame_size (int): Largest payload accepted from the peer.
+        """
+        self.buffer = bytearray()
+        self.max_frame_size = max_frame_size
+
+    def feed(self, data):
+        """
+        Append received bytes and extract all complete frames.
+
+        Args:
+            data (bytes): Bytes received from the socket.
+
+        Returns:
+            list: Payloads (bytes) of the frames completed by this chunk.
+        """
+        self.buffer += data
+        frames = []
+        offset = 0
+        while len(self.buffer) - offset >= HEADER.size:
+            (length,) = HEADER.unpack_from(self.buffer, offset)
+            if length > self.max_frame_size:
+                raise ProtocolError(
+                    "Frame of {} bytes exceeds the limit of {} bytes".format(
+                        length, self.max_frame_size
+                    )
+                )
+            end = offset + HEADER.size + length
+            if end > len(self.buffer):
+                break
+            frames.append(bytes(self.buffer[offset + HEADER.size:end]))
+            offset = end
+        if offset:
+            del self.buffer[:offset]
+        return frames
+
+    def pending(self):
+        """Return the number of buffered bytes not yet forming a frame."""
+        return len(self.buffer)
@@ -0,0 +1,261 @@
+"""
+Token bucket rate limits of the requests.
+
+Every request takes a token from up to three buckets, each refilled at a
+steady rate and holding at most a burst of tokens:
+
+- the bucket of its connection, with `rate_limit` and `rate_burst`,
+- the bucket of its principal, with `principal_rate_limit` and
+  `principal_rate_burst`, shared by the connections of a user to the
+  process,
+- the bucket of its command for its principal, for the commands listed in
+  `command_rate_limits`, e.g. "LIST_PRODUCT=5/20,SEARCH_PRODUCT=2" for 5
+  LIST_PRODUCT per second with bursts of 20, and 2 SEARCH_PRODUCT.
+
+The principal is the client, or else the merchant, logged in on the
+connection, and the host of the connection before logging in, so a
+script opening many connections shares one bucket. A request is only
+accepted if every bucket has a token for it, and is answered with a 429
+otherwise. A BATCH takes a token for each of its commands, so one with
+more commands than a burst is always refused.
+
+The buckets live in the memory of the server process. With `processes`
+above 1, the connections of a principal may be accepted by several
+processes, each of which grants it the rates of the settings.
+
+See `config` for the settings, a rate of 0 disables a bucket.
+
+Classes:
+    TokenBucket: Tokens refilled at a steady rate.
+    RateLimiter: The buckets of the connections, principals and commands.
+
+Functions:
+    parse_command_rates(text): Read the rates of the commands.
+    principal(connected_address): Return who makes the requests.
+    request_commands(cmd, args): Return the commands a request runs.
+"""
+import math
+import time
+from collections import Counter
+from .registry import registry
+
+
+class TokenBucket:
+    """
+    Tokens refilled at a steady rate, up to a burst.
+
+    Attributes:
+        rate (float): The tokens added per second.
+        burst (int): The tokens held at most.
+        tokens (float): The tokens available at `updated`.
+        updated (float): The time of the last refill.
+    """
+
+    __slots__ = ('rate', 'burst', 'tokens', 'updated')
+
+    def __init__(self, rate, burst, now):
+        """
+        Initialize a full bucket.
+
+        Args:
+            rate (float): The tokens added per second.
+            burst (int): The tokens held at most.
+            now (float): The current time in seconds.
+        """
+        self.rate = rate
+        self.burst = burst
+        self.tokens = float(burst)
+        self.updated = now
+
+    def refill(self, now):
+        """
+        Add the tokens earned since the last refill.
+
+        Args:
+            now (float): The current time in seconds.
+
+        Returns:
+            float: The tokens available.
+        """
+        if now > self.updated:
+            self.tokens = min(
+                self.burst, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+        return self.tokens
+
+    def full(self, now):
+        """
+        Tell whether the bucket is as full as a new one.
+
+        Args:
+            now (float): The current time in seconds.
+
+        Returns:
+            bool: True if forgetting the bucket changes nothing.
+        """
+        return self.refill(now) >= self.burst
+
+
+def parse_command_rates(text):
+    """
+    Read the rates of the commands.
+
+    Args:
+        text (str): Comma separated COMMAND=RATE or COMMAND=RATE/BURST.
+            The burst is the rate rounded up by default.
+
+    Returns:
+        dict: The rate and burst by command name.
+    """
+    rates = {}
+    for item in (text or '').split(','):
+        if not item.strip():
+            continue
+        name, separator, value = item.partition('=')
+        if not separator or not name.strip():
+            raise ValueError(f"Not a command rate: {item}")
+        rate, _, burst = value.partition('/')
+        rate = float(rate)
+        burst = int(burst) if burst else max(1, math.ceil(rate))
+        if rate < 0 or burst < 1:
+            raise ValueError(f"Not a command rate: {item}")
+        rates[name.strip().upper()] = (rate, burst)
+    return rates
+
+
+def principal(connected_address):
+    """
+    Return who makes the requests of a connection.
+
+    Args:
+        connected_address (str): The address of the connection.
+
+    Returns:
+        tuple: The kind of principal and its id or host.
+    """
+    client_id = registry.client(connected_address)
+    if client_id is not None:
+        return ('client', client_id)
+    merchant_id = registry.merchant(connected_address)
+    if merchant_id is not None:
+        return ('merchant', merchant_id)
+    return ('host', connected_address.rpartition(':')[0])
+
+
+def request_commands(cmd, args):
+    """
+    Return the commands a request runs.
+
+    Args:
+        cmd (str): The command of the request.
+        args (list): The arguments of the request.
+
+    Returns:
+        list: The commands of a BATCH, or the command itself.
+    """
+    if cmd == 'BATCH':
+        commands = [
+            command[0] for command in args[1:]
+            if isinstance(command, (list, tuple)) and command
+        ]
+        if commands:
+            return commands
+    return [cmd]
+
+
+class RateLimiter:
+    """
+    The token buckets of the connections, principals and commands.
+
+    The settings are passed to every call, so that they can be changed
+    without losing the buckets. It must be used from the event loop only.
+    """
+
+    # Buckets kept before the full ones are forgotten
+    PRUNE_SIZE = 4096
+
+    def __init__(self):
+        """Initialize a limiter without buckets."""
+        self.connections = {}
+        self.principals = {}
+        self.commands = {}
+        self.command_rates = ('', {})
+        self.prune_size = self.PRUNE_SIZE
+
+    def _rates(self, config):
+        """Return the parsed rates of the commands of the settings."""
+        text = config.command_rate_limits
+        if self.command_rates[0] != text:
+            self.command_rates = (text, parse_command_rates(text))
+        return self.command_rates[1]
+
+    def _prune(self, now):
+        """Forget the full buckets of the principals and commands."""
+        for buckets in (self.principals, self.commands):
+            for key in [key for key, bucket in buckets.items()
+                        if bucket.full(now)]:
+                del buckets[key]
+        size = len(self.principals) + len(self.commands)
+        self.prune_size = max(self.PRUNE_SIZE, 2 * size)
+
+    def allow(self, config, connected_address, principal, commands,
+              now=None):
+        """
+        Take the tokens of a request, if every bucket has them.
+
+        Args:
+            config (ServerConfig): The settings of the server.
+            connected_address (str): The address of the connection.
+            principal (tuple): Who makes the request, see `principal`.
+            commands (list): The commands the request runs.
+            now (float): The current monotonic time, that of the call by
+                default.
+
+        Returns:
+            bool: True if the request is accepted.
+        """
+        now = time.monotonic() if now is None else now
+        if len(self.principals) + len(self.commands) > self.prune_size:
+            self._prune(now)
+        # Each bucket with the tokens the request takes from it
+        takes = []
+        if config.rate_limit > 0:
+            takes.append((self._bucket(
+                self.connections, connected_address, config.rate_limit,
+                config.rate_burst, now), len(commands)))
+        if config.principal_rate_limit > 0:
+            takes.append((self._bucket(
+                self.principals, principal, config.principal_rate_limit,
+                config.principal_rate_burst, now), len(commands)))
+        rates = self._rates(config)
+        for cmd, count in Counter(commands).items():
+            if cmd in rates and rates[cmd][0] > 0:
+                takes.append((self._bucket(
+                    self.commands, (principal, cmd), *rates[cmd], now),
+                    count))
+        # A batch larger than a burst could never be paid for, and is refused
+        if any(bucket.refill(now) < count for bucket, count in takes):
+            return False
+        for bucket, count in takes:
+            bucket.tokens -= count
+        return True
+
+    @staticmethod
+    def _bucket(buckets, key, rate, burst, now):
+        """Return the bucket of a key, created full if missing."""
+        bucket = buckets.get(key)
+        if bucket is None:
+            bucket = buckets[key] = TokenBucket(rate, burst, now)
+        else:
+            # The settings may have changed
+            bucket.rate, bucket.burst = rate, burst
+        return bucket
+
+    def forget(self, connected_address):
+        """
+        Forget the bucket of a closed connection.
+
+        Args:
+            connected_address (str): The address of the connection.
+        """
+        self.connections.pop(connected_address, None)
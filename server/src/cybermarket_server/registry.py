@@ -0,0 +1,131 @@
+"""
+In-memory registry of who is logged in on which connection.
+
+Logging in binds the client or merchant id to the address of the
+connection. Handlers resolve the principal of a request with a dictionary
+lookup instead of scanning the `connected_address` column, which is only
+written when the persisted mirror is enabled in the settings.
+
+Classes:
+    SessionRegistry: Map connections to the logged in client and merchant.
+"""
+import threading
+
+
+class SessionRegistry:
+    """
+    Map each connection to the client and merchant logged in on it.
+
+    A connection may have one client and one merchant logged in at the
+    same time, as with the `connected_address` columns.
+    """
+
+    def __init__(self):
+        """Initialize an empty registry."""
+        self.clients = {}
+        self.merchants = {}
+        self.lock = threading.Lock()
+
+    def client(self, connected_address):
+        """
+        Return the id of the client logged in on a connection.
+
+        Args:
+            connected_address (str): The address of the connection.
+
+        Returns:
+            int: The client id, or None if no client is logged in.
+        """
+        return self.clients.get(connected_address)
+
+    def merchant(self, connected_address):
+        """
+        Return the id of the merchant logged in on a connection.
+
+        Args:
+            connected_address (str): The address of the connection.
+
+        Returns:
+            int: The merchant id, or None if no merchant is logged in.
+        """
+        return self.merchants.get(connected_address)
+
+    def login_client(self, connected_address, client_id):
+        """
+        Bind a client to a connection.
+
+        Args:
+            connected_address (str): The address of the connection.
+            client_id (int): The id of the client.
+
+        Returns:
+            bool: False if a client is already logged in on the connection.
+        """
+        with self.lock:
+            if connected_address in self.clients:
+                return False
+            self.clients[connected_address] = client_id
+            return True
+
+    def login_merchant(self, connected_address, merchant_id):
+        """
+        Bind a merchant to a connection.
+
+        Args:
+            connected_address (str): The address of the connection.
+            merchant_id (int): The id of the merchant.
+
+        Returns:
+            bool: False if a merchant is already logged in on the connection.
+        """
+        with self.lock:
+            if connected_address in self.merchants:
+                return False
+            self.merchants[connected_address] = merchant_id
+            return True
+
+    def logout_client(self, connected_address):
+        """
+        Remove the client bound to a connection.
+
+        Args:
+            connected_address (str): The address of the connection.
+
+        Returns:
+            int: The id of the client logged out, or None.
+        """
+        with self.lock:
+            return self.clients.pop(connected_address, None)
+
+    def logout_merchant(self, connected_address):
+        """
+        Remove the merchant bound to a connection.
+
+        Args:
+            connected_address (str): The address of the connection.
+
+        Returns:
+            int: The id of the merchant logged out, or None.
+        """
+        with self.lock:
+            return self.merchants.pop(connected_address, None)
+
+    def drop(self, connected_address):
+        """
+        Forget everything bound to a closed connection.
+
+        Args:
+            connected_address (str): The address of the connection.
+
+        Returns:
+            tuple: The ids of the client and merchant that were logged in.
+        """
+        with self.lock:
+            return (
+                self.clients.pop(connected_address, None),
+                self.merchants.pop(connected_address, None)
+            )
+
+
+# Registry shared by every handler of this process
+registry = SessionRegistry()
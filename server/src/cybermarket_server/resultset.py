@@ -0,0 +1,135 @@
+"""
+Lightweight tables returned by the listing commands.
+
+A ResultSet keeps the column names and one sequence per column. Integer
+and float columns are packed into arrays, which the binary codec writes
+to the wire as they are. Callers that want a pandas DataFrame can ask
+for one with `to_dataframe`.
+
+Functions:
+    pack_column(values): Store a column as compactly as its values allow.
+
+Classes:
+    ResultSet: Column-oriented table of query results.
+"""
+import array
+import numbers
+
+INT64_MIN, INT64_MAX = -2 ** 63, 2 ** 63 - 1
+
+
+def pack_column(values):
+    """
+    Store a column as compactly as its values allow.
+
+    Args:
+        values (sequence): The values of the column.
+
+    Returns:
+        array.array of int64 or float64 if every value fits, else a list.
+    """
+    if isinstance(values, array.array):
+        return values
+    values = list(values)
+    if values and all(
+            isinstance(value, numbers.Integral)
+            and not isinstance(value, bool)
+            and INT64_MIN <= value <= INT64_MAX
+            for value in values):
+        return array.array('q', values)
+    if values and all(isinstance(value, float) for value in values):
+        return array.array('d', values)
+    return values
+
+
+class ResultSet:
+    """
+    Column-oriented table of query results.
+
+    Attributes:
+        columns (list): The column names.
+        data (list): One sequence of values per column.
+        encodings (dict): The encoding of the table by each codec, kept
+            by the codecs. A table must not be changed once encoded.
+    """
+
+    def __init__(self, columns, data):
+        """
+        Initialize the table from its columns.
+
+        Args:
+            columns (list): The column names.
+            data (list): One sequence of values per column.
+        """
+        self.columns = list(columns)
+        self.data = [pack_column(values) for values in data]
+        self.encodings = {}
+
+    @classmethod
+    def from_rows(cls, columns, rows):
+        """
+        Build a table from query rows.
+
+        Args:
+            columns (list): The column names.
+            rows (list): Rows as sequences, in the order of the columns.
+
+        Returns:
+            ResultSet: The table.
+        """
+        rows = list(rows)
+        if not rows:
+            return cls(columns, [[] for _ in columns])
+        return cls(columns, zip(*rows))
+
+    def __len__(self):
+        """Return the number of rows."""
+        return len(self.data[0]) if self.data else 0
+
+    def __eq__(self, other):
+        """Compare the column names and values of two tables."""
+        if not isinstance(other, ResultSet):
+            return NotImplemented
+        return self.columns == other.columns and [
+            list(values) for values in self.data
+            ] == [list(values) for values in other.data]
+
+    def column(self, name):
+        """
+        Return the values of a column.
+
+        Args:
+            name (str): The column name.
+
+        Returns:
+            Sequence of the column values.
+        """
+        return self.data[self.columns.index(name)]
+
+    def rows(self):
+        """
+        Return the table as a list of rows.
+
+        Returns:
+            list: One list of values per row.
+        """
+        return [list(row) for row in zip(*self.data)]
+
+    def to_dataframe(self):
+        """
+        Convert the table to a pandas DataFrame.
+
+        Packed columns are handed to pandas as numpy views of the arrays,
+        without copying their values.
+
+        Returns:
+            pandas.DataFrame: The same data, with the same column names.
+        """
+        import numpy as np
+        import pandas as pd
+        data = {}
+        for name, values in zip(self.columns, self.data):
+            if isinstance(values, array.array):
+                values = np.frombuffer(values, dtype=values.typecode)
+            data[name] = values
+        return pd.DataFrame(data, columns=self.columns, copy=False)
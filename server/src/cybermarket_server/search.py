@@ -0,0 +1,140 @@
+"""
+Full-text index of the products for SEARCH_PRODUCT.
+
+On SQLite the names and descriptions of the products are indexed by an
+FTS5 table. It is an external content table over `product`, so the text
+is not stored twice, and triggers on `product` keep it in sync with every
+write, including the ones made outside of the models.
+
+Other backends have no index, and search with case-insensitive LIKE
+patterns instead.
+
+Functions:
+    match_query(text): Return the FTS5 query searching a text.
+    create_search_index(connection): Create and fill the index.
+    attach_search_index(table): Create the index with the product table.
+    ensure_search_index(engine): Create the index if it is missing.
+"""
+import re
+from sqlalchemy import column, event, func, inspect, table
+
+FTS_TABLE = 'product_fts'
+
+# The index, and the hidden column named after it which MATCH applies to
+product_fts = table(FTS_TABLE, column('rowid'), column(FTS_TABLE))
+
+# BM25 score of a match, weighting the name over the description. Lower
+# is better, so the best matches come first in ascending order
+rank = func.bm25(product_fts.c[FTS_TABLE], 10.0, 1.0)
+
+SEARCH_DDL = [
+    f"""CREATE VIRTUAL TABLE IF NOT EXISTS {FTS_TABLE} USING fts5(
+        productname, description,
+        content='product', content_rowid='productId',
+        tokenize='unicode61 remove_diacritics 2', prefix='2 3'
+        )""",
+    f"""CREATE TRIGGER IF NOT EXISTS {FTS_TABLE}_insert
+        AFTER INSERT ON product BEGIN
+        INSERT INTO {FTS_TABLE}(rowid, productname, description)
+        VALUES (new.productId, new.productname, new.description);
+        END""",
+    f"""CREATE TRIGGER IF NOT EXISTS {FTS_TABLE}_delete
+        AFTER DELETE ON product BEGIN
+        INSERT INTO {FTS_TABLE}({FTS_TABLE}, rowid, productname, description)
+        VALUES ('delete', old.productId, old.productname, old.description);
+        END""",
+    f"""CREATE TRIGGER IF NOT EXISTS {FTS_TABLE}_update
+        AFTER UPDATE OF productname, description ON product BEGIN
+        INSERT INTO {FTS_TABLE}({FTS_TABLE}, rowid, productname, description)
+        VALUES ('delete', old.productId, old.productname, old.description);
+        INSERT INTO {FTS_TABLE}(rowid, productname, description)
+        VALUES (new.productId, new.productname, new.description);
+        END"""
+]
+
+
+def search_terms(text):
+    """
+    Split a search text into words.
+
+    Args:
+        text (str): The text typed by the user.
+
+    Returns:
+        list: The words of the text, punctuation and operators dropped.
+    """
+    return re.findall(r'\w+', text or '')
+
+
+def match_query(text):
+    """
+    Return the FTS5 query searching a text.
+
+    Every word of the text must match, as a word or the beginning of one.
+    The words are quoted, so the text cannot use the FTS5 query syntax.
+
+    Args:
+        text (str): The text typed by the user.
+
+    Returns:
+        str: The FTS5 query, None if the text has no words.
+    """
+    terms = search_terms(text)
+    if not terms:
+        return None
+    return ' '.join(f'"{term}"*' for term in terms)
+
+
+def create_search_index(connection):
+    """
+    Create the index and its triggers, and index the existing products.
+
+    Args:
+        connection (Connection): A connection to the SQLite database.
+    """
+    for statement in SEARCH_DDL:
+        connection.exec_driver_sql(statement)
+    connection.exec_driver_sql(
+        f"INSERT INTO {FTS_TABLE}({FTS_TABLE}) VALUES ('rebuild')"
+        )
+
+
+def _create_with_table(target, connection, **kw):
+    """Create the index once the product table is created."""
+    if connection.dialect.name == 'sqlite':
+        create_search_index(connection)
+
+
+def _drop_with_table(target, connection, **kw):
+    """Drop the index once the product table is dropped."""
+    if connection.dialect.name == 'sqlite':
+        connection.exec_driver_sql(f"DROP TABLE IF EXISTS {FTS_TABLE}")
+
+
+def attach_search_index(product_table):
+    """
+    Create and drop the index together with the product table.
+
+    Args:
+        product_table (Table): The product table.
+    """
+    event.listen(product_table, 'after_create', _create_with_table)
+    event.listen(product_table, 'after_drop', _drop_with_table)
+
+
+def ensure_search_index(engine):
+    """
+    Create the index of a database created without it.
+
+    Args:
+        engine (Engine): The engine of the database.
+
+    Returns:
+        bool: True if the index was created.
+    """
+    if engine.dialect.name != 'sqlite' or \
+            inspect(engine).has_table(FTS_TABLE):
+        return False
+    with engine.begin() as connection:
+        create_search_index(connection)
+    return True
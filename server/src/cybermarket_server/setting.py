@@ -1,30 +1,171 @@
 """Some initialization settings for the sqlalchemy.orm framework."""
 import os
 import locale
-from sqlalchemy import create_engine
+from sqlalchemy import create_engine, event, make_url
 from sqlalchemy.orm import declarative_base
-from sqlalchemy.orm import sessionmaker
+from sqlalchemy.orm import sessionmaker, scoped_session
+from sqlalchemy.pool import QueuePool, StaticPool
 
 module_path = os.path.abspath(__file__)
 module_dir = os.path.dirname(module_path)
 db_path = os.path.join(module_dir, 'database/cybermarket.db')
 
+# Also store the address of logged in users in the connected_address
+# columns, the in-memory registry alone decides who is logged in
+PERSIST_LOGIN = os.getenv("CYBERMARKET_PERSIST_LOGIN", "0") == "1"
+# Number of threads running requests, 0 runs them on the event loop
+WORKERS = int(os.getenv("CYBERMARKET_WORKERS", "4"))
+# Requests allowed to wait for a free worker before reading is paused
+WORKER_BACKLOG = int(os.getenv("CYBERMARKET_WORKER_BACKLOG", "16"))
+# Database connections kept open, and extra ones opened under load
+POOL_SIZE = int(os.getenv("CYBERMARKET_POOL_SIZE", "5"))
+MAX_OVERFLOW = int(os.getenv("CYBERMARKET_MAX_OVERFLOW", "10"))
+# Seconds after which a pooled connection is replaced, -1 keeps it forever
+POOL_RECYCLE = int(os.getenv("CYBERMARKET_POOL_RECYCLE", "3600"))
+# Catalog tables kept in memory by the listing commands, 0 disables it
+CATALOG_CACHE_SIZE = int(os.getenv("CYBERMARKET_CATALOG_CACHE_SIZE", "256"))
+# Seconds the items added to a cart hold their stock, 0 disables it
+RESERVATION_TTL = int(os.getenv("CYBERMARKET_RESERVATION_TTL", "0"))
+# Seconds between two releases of the expired reservations
+RESERVATION_SWEEP = float(os.getenv("CYBERMARKET_RESERVATION_SWEEP", "5"))
+# Deleted products remembered per store for LIST_PRODUCT_SINCE, the
+# clients syncing from an older version reload the whole list
+TOMBSTONE_LIMIT = int(os.getenv("CYBERMARKET_TOMBSTONE_LIMIT", "1000"))
+# Largest number of rows of a page returned by the paginated listings
+MAX_PAGE_SIZE = int(os.getenv("CYBERMARKET_MAX_PAGE_SIZE", "500"))
+# Database used by the server, any URL supported by SQLAlchemy
+DATABASE_URL = os.getenv("CYBERMARKET_DATABASE_URL", 'sqlite:///' + db_path)
+# Database used by the tests, whose tables they drop and create again
+TEST_DATABASE_URL = os.getenv(
+    "CYBERMARKET_TEST_DATABASE_URL", 'sqlite:///:memory:'
+    )
+# Prepared statements cached by each SQLite connection
+STATEMENT_CACHE = int(os.getenv("CYBERMARKET_STATEMENT_CACHE", "256"))
+
+# PRAGMAs applied to every SQLite connection. "durable" keeps every
+# committed transaction across a power loss. "fast" syncs the WAL only at
+# checkpoints, so the last transactions may be lost on a power loss
+# (never on a crash of the server alone), and maps the database in memory.
+SQLITE_PROFILES = {
+    "durable": {
+        "journal_mode": "WAL",
+        "synchronous": "FULL",
+        "busy_timeout": 5000,
+        "cache_size": -16000,
+        "temp_store": "MEMORY",
+        "mmap_size": 0
+    },
+    "fast": {
+        "journal_mode": "WAL",
+        "synchronous": "NORMAL",
+        "busy_timeout": 5000,
+        "cache_size": -64000,
+        "temp_store": "MEMORY",
+        "mmap_size": 268435456
+    }
+}
+SQLITE_PROFILE = os.getenv("CYBERMARKET_SQLITE_PROFILE", "durable")
+
+
+def sqlite_pragmas(profile):
+    """
+    Return the PRAGMAs of a SQLite profile.
+
+    Each PRAGMA of the profile can be overridden with an environment
+    variable named after it, e.g. CYBERMARKET_SQLITE_SYNCHRONOUS.
+
+    Args:
+        profile (str): The name of the profile, "durable" or "fast".
+
+    Return:
+        dict: The value of each PRAGMA.
+    """
+    if profile not in SQLITE_PROFILES:
+        raise ValueError(f"Unknown SQLite profile {profile}")
+    pragmas = dict(SQLITE_PROFILES[profile])
+    for name in pragmas:
+        value = os.getenv("CYBERMARKET_SQLITE_" + name.upper())
+        if value is not None:
+            pragmas[name] = value
+    return pragmas
+
+
+def apply_pragmas(dbapi_connection, pragmas):
+    """
+    Apply PRAGMAs to a new SQLite connection.
+
+    Args:
+        dbapi_connection (sqlite3.Connection): The connection.
+        pragmas (dict): The value of each PRAGMA.
+    """
+    cursor = dbapi_connection.cursor()
+    try:
+        for name, value in pragmas.items():
+            cursor.execute(f"PRAGMA {name}={value}")
+    finally:
+        cursor.close()
+
+
+def create_database_engine(url):
+    """
+    Create the engine of a database URL.
+
+    SQLite files get the PRAGMA profile and the statement cache. An
+    in-memory SQLite database is shared with the worker threads through a
+    single connection. Other backends get the pool settings, with a ping
+    before reuse since their connections may be closed by the server.
+
+    Args:
+        url (str): The SQLAlchemy URL of the database.
+
+    Return:
+        Engine: The engine of the database.
+    """
+    url = make_url(url)
+    if url.get_backend_name() != 'sqlite':
+        return create_engine(
+            url,
+            echo=False,
+            pool_size=POOL_SIZE,
+            max_overflow=MAX_OVERFLOW,
+            pool_recycle=POOL_RECYCLE,
+            pool_pre_ping=True
+            )
+    if url.database in (None, '', ':memory:'):
+        # Share the single in-memory database with the worker threads
+        return create_engine(
+            url,
+            echo=False,
+            connect_args={'check_same_thread': False},
+            poolclass=StaticPool
+            )
+    engine = create_engine(
+        url,
+        echo=False,
+        connect_args={'cached_statements': STATEMENT_CACHE},
+        poolclass=QueuePool,
+        pool_size=POOL_SIZE,
+        max_overflow=MAX_OVERFLOW,
+        pool_recycle=POOL_RECYCLE
+        )
+    pragmas = sqlite_pragmas(SQLITE_PROFILE)
+    event.listen(
+        engine, "connect",
+        lambda dbapi_connection, record: apply_pragmas(
+            dbapi_connection, pragmas
+            )
+        )
+    return engine
+
 
 def get_engine():
     """Set the database engine according to the system environment."""
     # Check the environment variables for the existence of tests and docstring
     testing = os.getenv("CYBERMARKET")
-    if testing == "TESTING":
-        engine = create_engine('sqlite:///:memory:', echo=False)
-    elif testing == "DOCSTRING":
-        engine = create_engine('sqlite:///:memory:', echo=False)
-    else:
-        # If it does not exist, use the default database
-        engine = create_engine(
-            'sqlite:///' + db_path,
-            echo=False
-            )
-    return engine
+    if testing in ("TESTING", "DOCSTRING"):
+        return create_database_engine(TEST_DATABASE_URL)
+    # If it is not configured, use the default database
+    return create_database_engine(DATABASE_URL)
 
 
 # Language setting
@@ -39,5 +180,6 @@ Base = declarative_base()
 # Create database session
 Session = sessionmaker(bind=engine)
 
-# The custom class can be used to construct a new Session
-session = Session()
+# Each thread gets its own session, so worker threads never share one.
+# The session is removed after every request, see worker.run_in_session
+session = scoped_session(Session)
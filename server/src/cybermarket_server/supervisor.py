@@ -0,0 +1,149 @@
+"""
+Run the server in several processes sharing one listening socket.
+
+One event loop only uses one core, and decoding requests, building the
+listings and the ORM work are all bound by the CPU. With `processes`
+above 1 in the server settings (see `config`), the listening socket is
+bound first, then the supervisor forks the worker processes, which all
+accept connections from it. A worker that exits is started again.
+
+A connection stays in the process that accepted it for its whole life,
+so the logins of the registry, keyed by the address of the connection,
+never need to be shared. What the processes share is set up before they
+fork:
+
+- the counter of invalidations of the catalog caches, see
+  `CatalogCache.share`,
+- the inboxes exchanging the product changes between the notification
+  hubs, see `NotificationHub.link`.
+
+The worker processes are forked, so this mode needs a POSIX system.
+
+Classes:
+    Supervisor: Start the worker processes and restart those that exit.
+"""
+import multiprocessing
+import multiprocessing.connection
+import signal
+import sys
+import time
+from .catalog import catalog
+from .notify import hub
+from .setting import engine
+
+# Seconds a worker process must live, or it is restarted after a delay
+RESTART_DELAY = 1.0
+
+
+def _exit(signum, frame):
+    """Stop the supervisor, and its worker processes, on SIGTERM."""
+    sys.exit(0)
+
+
+def _run_worker(serve, sock, index, inboxes):
+    """
+    Run the server in a forked worker process.
+
+    Args:
+        serve (callable): Called with the socket and the index.
+        sock (socket): The listening socket.
+        index (int): The index of the worker process.
+        inboxes (list): The inboxes of the hubs of every process.
+    """
+    # Stopped by the supervisor, not by the Ctrl+C sent to the group. Its
+    # SIGTERM is handled by the event loop of the server, once started
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    # The pooled connections of the supervisor must not be shared
+    engine.dispose(close=False)
+    hub.link(inboxes[index], inboxes[:index] + inboxes[index + 1:])
+    serve(sock, index)
+
+
+class Supervisor:
+    """
+    Start the worker processes and restart those that exit.
+
+    Attributes:
+        count (int): The number of worker processes.
+        serve (callable): Run in each worker process with the listening
+            socket and the index of the process, until it stops.
+    """
+
+    def __init__(self, count, serve):
+        """
+        Initialize the supervisor.
+
+        Args:
+            count (int): The number of worker processes.
+            serve (callable): Run in each worker process.
+        """
+        self.count = count
+        self.serve = serve
+        self.context = multiprocessing.get_context('fork')
+        self.processes = {}
+        self.started = {}
+        self.sock = None
+        self.inboxes = []
+
+    def start(self, index):
+        """
+        Start a worker process.
+
+        Args:
+            index (int): The index of the worker process.
+        """
+        process = self.context.Process(
+            target=_run_worker,
+            args=(self.serve, self.sock, index, self.inboxes),
+            name=f'cybermarket-{index}'
+            )
+        process.start()
+        self.processes[index] = process
+        self.started[index] = time.monotonic()
+        print(f'Worker {index} started, pid {process.pid}')
+
+    def stop(self):
+        """Stop the worker processes and wait for them."""
+        for process in self.processes.values():
+            if process.is_alive():
+                process.terminate()
+        for process in self.processes.values():
+            process.join()
+
+    def run(self, sock):
+        """
+        Supervise the worker processes until stopped.
+
+        Args:
+            sock (socket): The listening socket, bound and listening.
+        """
+        self.sock = sock
+        self.inboxes = [self.context.Queue() for _ in range(self.count)]
+        catalog.share(self.context.Value('Q', 0))
+        # Each worker opens its own connections to the database
+        engine.dispose()
+        signal.signal(signal.SIGTERM, _exit)
+        try:
+            for index in range(self.count):
+                self.start(index)
+            while True:
+                sentinels = {
+                    process.sentinel: index
+                    for index, process in self.processes.items()
+                }
+                for ready in multiprocessing.connection.wait(sentinels):
+                    index = sentinels[ready]
+                    process = self.processes[index]
+                    process.join()
+                    print(f'Worker {index} exited with code '
+                          f'{process.exitcode}, restarting')
+                    # Do not spin on a worker crashing at startup
+                    if time.monotonic() - self.started[index] < \
+                            RESTART_DELAY:
+                        time.sleep(RESTART_DELAY)
+                    self.start(index)
+        except KeyboardInterrupt:
+            pass
+        finally:
+            self.stop()
+            self.sock.close()
@@ -0,0 +1,186 @@
+"""
+Run the blocking request processing outside of the event loop.
+
+`cmd_process` talks to the database through SQLAlchemy, which blocks the
+calling thread. The worker pool runs it in a thread pool so that a slow
+request only occupies one worker instead of freezing every connection.
+
+Classes:
+    WorkerPool: Thread pool with a bounded number of admitted requests,
+        shared fairly between the connections.
+"""
+import asyncio
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from .cmd_process import cmd_process
+from .setting import session
+
+
+def run_in_session(func, *args):
+    """
+    Call a function using the database in a worker thread.
+
+    The thread-local session is removed afterwards, so every call starts
+    from a fresh session and never sees stale objects.
+
+    Args:
+        func (callable): The function to call.
+        args: The arguments of the function.
+
+    Return:
+        The value returned by the function.
+    """
+    try:
+        return func(*args)
+    finally:
+        session.remove()
+
+
+def _copy_result(task, future):
+    """Resolve a future with the outcome of a finished task."""
+    if future.cancelled():
+        return
+    if task.cancelled():
+        future.cancel()
+    elif task.exception() is not None:
+        future.set_exception(task.exception())
+    else:
+        future.set_result(task.result())
+
+
+class WorkerPool:
+    """
+    Dispatch requests to worker threads with back-pressure.
+
+    At most `workers + backlog` requests are admitted at the same time.
+    Once this limit is reached, `admit` waits, which stops the connection
+    from reading further requests until a worker becomes free.
+
+    The requests admitted wait in a queue per connection, and the free
+    workers take them from the connections in turn. A connection sending
+    many requests at once therefore does not delay the requests of the
+    others by more than one of its own per worker.
+
+    With zero workers, requests run directly on the event loop.
+    """
+
+    def __init__(self, workers, backlog):
+        """
+        Initialize the pool.
+
+        Args:
+            workers (int): Number of worker threads, 0 disables the pool.
+            backlog (int): Requests allowed to wait for a free worker.
+        """
+        self.workers = workers
+        self.executor = None
+        if workers > 0:
+            self.executor = ThreadPoolExecutor(
+                max_workers=workers,
+                thread_name_prefix='cybermarket-worker'
+                )
+        self.slots = asyncio.Semaphore(max(workers, 1) + backlog)
+        # Requests waiting for a worker, by connection
+        self.queues = {}
+        # Connections with waiting requests, in the order of their turn
+        self.turns = deque()
+        self.running = 0
+
+    async def admit(self):
+        """Wait until the pool accepts one more request."""
+        await self.slots.acquire()
+
+    def release(self):
+        """Give back the slot taken by `admit`."""
+        self.slots.release()
+
+    def saturated(self):
+        """Return True if the next call to `admit` would wait."""
+        return self.slots.locked()
+
+    async def call(self, func, *args):
+        """
+        Call a function using the database on a worker thread.
+
+        Args:
+            func (callable): The function to call.
+            args: The arguments of the function.
+
+        Return:
+            The value returned by the function.
+        """
+        if self.executor is None:
+            return run_in_session(func, *args)
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(
+            self.executor, run_in_session, func, *args
+            )
+
+    def _dispatch(self):
+        """Start the next waiting requests, one connection at a time."""
+        while self.running < self.workers and self.turns:
+            connected_address = self.turns.popleft()
+            queue = self.queues[connected_address]
+            future, func, args = queue.popleft()
+            if queue:
+                self.turns.append(connected_address)
+            else:
+                del self.queues[connected_address]
+            if future.cancelled():
+                continue
+            self.running += 1
+            task = asyncio.ensure_future(self.call(func, *args))
+            task.add_done_callback(self._finished)
+            task.add_done_callback(
+                lambda task, future=future: _copy_result(task, future))
+
+    def _finished(self, task):
+        """Give the worker of a finished request to the next one."""
+        self.running -= 1
+        self._dispatch()
+
+    async def schedule(self, connected_address, func, *args):
+        """
+        Call a function on a worker thread, in the turn of a connection.
+
+        Args:
+            connected_address (str): The address of the connection.
+            func (callable): The function to call.
+            args: The arguments of the function.
+
+        Return:
+            The value returned by the function.
+        """
+        if self.executor is None:
+            return run_in_session(func, *args)
+        future = asyncio.get_running_loop().create_future()
+        queue = self.queues.get(connected_address)
+        if queue is None:
+            queue = self.queues[connected_address] = deque()
+            self.turns.append(connected_address)
+        queue.append((future, func, args))
+        self._dispatch()
+        return await future
+
+    async def run(self, cmd, request_id, connected_address, *args):
+        """
+        Process a request on a worker thread.
+
+        Args:
+            cmd (str): The command to be processed.
+            request_id (str): The unique identifier for the request.
+            connected_address (str): The address of the client.
+            args: Additional arguments of the command.
+
+        Return:
+            reply (list): List with prompt information and query results
+        """
+        return await self.schedule(
+            connected_address,
+            cmd_process, cmd, request_id, connected_address, *args
+            )
+
+    def shutdown(self):
+        """Wait for running requests and stop the worker threads."""
+        if self.executor is not None:
+            self.executor.shutdown(wait=True)
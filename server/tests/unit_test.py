@@ -1,11 +1,53 @@
 from tests import setting_unittest
 import unittest
+import asyncio
 import src.cybermarket_server.cmd_process as cmd_process
 import pandas as pd
 import src.cybermarket_server.invitation as invitation
+import src.cybermarket_server.protocol as protocol
+import src.cybermarket_server.codec as codec
+import src.cybermarket_server.resultset as resultset
+import src.cybermarket_server.registry as registry
+import src.cybermarket_server.migration as migration
+import sqlalchemy
+import os
+import tempfile
+import src.cybermarket_server.setting as setting
+import src.cybermarket_server.__main__ as server
+import src.cybermarket_server.worker as worker
+import src.cybermarket_server.catalog as catalog
+import src.cybermarket_server.notify as notify
+import src.cybermarket_server.model as model
+import src.cybermarket_server.search as search
+import src.cybermarket_server.inventory as inventory
+import src.cybermarket_server.config as config
+import src.cybermarket_server.outbox as outbox
+import src.cybermarket_server.ratelimit as ratelimit
+import time
+import queue
+import socket
+import signal
+import pickle
+import multiprocessing
+from unittest import mock
 
 setting_unittest
 
+# Start from empty tables when the tests use a configured database
+setting.Base.metadata.drop_all(setting.engine)
+setting.Base.metadata.create_all(setting.engine)
+
+# An id no product has, since the ids of deleted rows are not reused by
+# every backend
+MISSING_PRODUCT_ID = -1
+
+
+def product_id(productname, storename="Cybermarket"):
+    return cmd_process.session.query(cmd_process.Product.productId).join(
+        cmd_process.Merchant).filter(
+        cmd_process.Product.productname == productname,
+        cmd_process.Merchant.storename == storename).scalar()
+
 
 class TestClientCreate(unittest.TestCase):
     def setUp(cls):
@@ -174,10 +216,10 @@ class TestClientAddItem(unittest.TestCase):
             "8005", "127.0.0.1:33000", "Cybermarket", "123456"
         )
         cmd_process.merchant_del_product(
-            "8006", "127.0.0.1:33000", 1
+            "8006", "127.0.0.1:33000", product_id("router")
         )
         cmd_process.merchant_del_product(
-            "8007", "127.0.0.1:33000", 2
+            "8007", "127.0.0.1:33000", product_id("switch")
         )
         cmd_process.merchant_logout(
             "8008", "127.0.0.1:33000"
@@ -193,13 +235,13 @@ class TestClientAddItem(unittest.TestCase):
             "0", "127.0.0.1:33000", "liuhailin", "123456"
         )
         result = cmd_process.client_add_item(
-            "1", "127.0.0.1:33000", 1, 5
+            "1", "127.0.0.1:33000", product_id("router"), 5
         )
         expected_result = [
             "1 200 OK: This product has been added to the shopping cart"
             ]
         cmd_process.client_remove_item(
-            "2", "127.0.0.1:33000", 1
+            "2", "127.0.0.1:33000", product_id("router")
         )
         cmd_process.client_logout(
             "3", "127.0.0.1:33000"
@@ -211,14 +253,14 @@ class TestClientAddItem(unittest.TestCase):
             "0", "127.0.0.1:33000", "liuhailin", "123456"
         )
         result = cmd_process.client_add_item(
-            "1", "127.0.0.1:33000", 3, 5
+            "1", "127.0.0.1:33000", MISSING_PRODUCT_ID, 5
         )
         expected_result = [
             "1 404 Not Found: The product you are trying to add cannot be \
 found"
             ]
         cmd_process.client_remove_item(
-            "2", "127.0.0.1:33000", 1
+            "2", "127.0.0.1:33000", product_id("router")
         )
         cmd_process.client_logout(
             "3", "127.0.0.1:33000"
@@ -258,10 +300,10 @@ class TestClientRemoveItem(unittest.TestCase):
             "8005", "127.0.0.1:33000", "Cybermarket", "123456"
         )
         cmd_process.merchant_del_product(
-            "8006", "127.0.0.1:33000", 1
+            "8006", "127.0.0.1:33000", product_id("router")
         )
         cmd_process.merchant_del_product(
-            "8007", "127.0.0.1:33000", 2
+            "8007", "127.0.0.1:33000", product_id("switch")
         )
         cmd_process.merchant_logout(
             "8008", "127.0.0.1:33000"
@@ -277,10 +319,10 @@ class TestClientRemoveItem(unittest.TestCase):
             "0", "127.0.0.1:33000", "liuhailin", "123456"
         )
         cmd_process.client_add_item(
-            "1", "127.0.0.1:33000", 1, 5
+            "1", "127.0.0.1:33000", product_id("router"), 5
         )
         result = cmd_process.client_remove_item(
-            "2", "127.0.0.1:33000", 1
+            "2", "127.0.0.1:33000", product_id("router")
         )
         expected_result = [
             "2 200 OK: This product has been removed from the shopping cart"
@@ -295,16 +337,16 @@ class TestClientRemoveItem(unittest.TestCase):
             "0", "127.0.0.1:33000", "liuhailin", "123456"
         )
         cmd_process.client_add_item(
-            "1", "127.0.0.1:33000", 1, 5
+            "1", "127.0.0.1:33000", product_id("router"), 5
         )
         result = cmd_process.client_remove_item(
-            "2", "127.0.0.1:33000", 2
+            "2", "127.0.0.1:33000", product_id("switch")
         )
         expected_result = [
             "2 404 Not Found: This product is not in your shopping cart"
             ]
         cmd_process.client_remove_item(
-            "3", "127.0.0.1:33000", 1
+            "3", "127.0.0.1:33000", product_id("router")
         )
         cmd_process.client_logout(
             "4", "127.0.0.1:33000"
@@ -344,10 +386,10 @@ class TestClientGetItems(unittest.TestCase):
             "8005", "127.0.0.1:33000", "Cybermarket", "123456"
         )
         cmd_process.merchant_del_product(
-            "8006", "127.0.0.1:33000", 1
+            "8006", "127.0.0.1:33000", product_id("router")
         )
         cmd_process.merchant_del_product(
-            "8007", "127.0.0.1:33000", 2
+            "8007", "127.0.0.1:33000", product_id("switch")
         )
         cmd_process.merchant_logout(
             "8008", "127.0.0.1:33000"
@@ -363,17 +405,18 @@ class TestClientGetItems(unittest.TestCase):
             "0", "127.0.0.1:33000", "liuhailin", "123456"
         )
         cmd_process.client_add_item(
-            "1", "127.0.0.1:33000", 1, 5
+            "1", "127.0.0.1:33000", product_id("router"), 5
         )
         cmd_process.client_add_item(
-            "2", "127.0.0.1:33000", 2, 5
+            "2", "127.0.0.1:33000", product_id("switch"), 5
         )
         result = cmd_process.client_get_items(
             "3", "127.0.0.1:33000"
         )
         data = {
             'storename': ["Cybermarket", "Cybermarket"],
-            'product_id': [1, 2],
+            'product_id': [product_id("router"),
+                           product_id("switch")],
             'productname': ['router', 'switch'],
             'price': [100.0, 200.0],
             'quantity': [5, 5]
@@ -383,16 +426,17 @@ class TestClientGetItems(unittest.TestCase):
             "3 200 OK: Obtained order list", df
             ]
         cmd_process.client_remove_item(
-            "4", "127.0.0.1:33000", 1
+            "4", "127.0.0.1:33000", product_id("router")
         )
         cmd_process.client_remove_item(
-            "5", "127.0.0.1:33000", 2
+            "5", "127.0.0.1:33000", product_id("switch")
         )
         cmd_process.client_logout(
             "6", "127.0.0.1:33000"
         )
         self.assertEqual(
-            [result[0], result[1].equals(expected_result[1])],
+            [result[0],
+             result[1].to_dataframe().equals(expected_result[1])],
             [expected_result[0], True]
             )
 
@@ -429,10 +473,10 @@ class TestClientGetPrice(unittest.TestCase):
             "8005", "127.0.0.1:33000", "Cybermarket", "123456"
         )
         cmd_process.merchant_del_product(
-            "8006", "127.0.0.1:33000", 1
+            "8006", "127.0.0.1:33000", product_id("router")
         )
         cmd_process.merchant_del_product(
-            "8007", "127.0.0.1:33000", 2
+            "8007", "127.0.0.1:33000", product_id("switch")
         )
         cmd_process.merchant_logout(
             "8008", "127.0.0.1:33000"
@@ -448,10 +492,10 @@ class TestClientGetPrice(unittest.TestCase):
             "0", "127.0.0.1:33000", "liuhailin", "123456"
         )
         cmd_process.client_add_item(
-            "1", "127.0.0.1:33000", 1, 5
+            "1", "127.0.0.1:33000", product_id("router"), 5
         )
         cmd_process.client_add_item(
-            "2", "127.0.0.1:33000", 2, 5
+            "2", "127.0.0.1:33000", product_id("switch"), 5
         )
         result = cmd_process.client_get_price(
             "3", "127.0.0.1:33000"
@@ -460,16 +504,53 @@ class TestClientGetPrice(unittest.TestCase):
             "3 200 OK: Order price obtained", 1500.0
             ]
         cmd_process.client_remove_item(
-            "4", "127.0.0.1:33000", 1
+            "4", "127.0.0.1:33000", product_id("router")
         )
         cmd_process.client_remove_item(
-            "5", "127.0.0.1:33000", 2
+            "5", "127.0.0.1:33000", product_id("switch")
         )
         cmd_process.client_logout(
             "6", "127.0.0.1:33000"
         )
         self.assertEqual(result, expected_result)
 
+    def test_1(self):
+        cmd_process.client_login(
+            "0", "127.0.0.1:33000", "liuhailin", "123456"
+        )
+        cmd_process.client_add_item(
+            "1", "127.0.0.1:33000", product_id("router"), 5
+        )
+        cmd_process.client_add_item(
+            "2", "127.0.0.1:33000", product_id("switch"), 5
+        )
+        result = cmd_process.client_get_cart(
+            "3", "127.0.0.1:33000"
+        )
+        expected_result = [
+            "3 200 OK: Obtained order list",
+            [["Cybermarket", product_id("router"), "router", 100.0, 5],
+             ["Cybermarket", product_id("switch"), "switch", 200.0, 5]],
+            1500.0
+            ]
+        cmd_process.client_remove_item(
+            "4", "127.0.0.1:33000", product_id("router")
+        )
+        cmd_process.client_remove_item(
+            "5", "127.0.0.1:33000", product_id("switch")
+        )
+        empty = cmd_process.client_get_cart(
+            "6", "127.0.0.1:33000"
+        )
+        cmd_process.client_logout(
+            "7", "127.0.0.1:33000"
+        )
+        self.assertEqual(
+            [result[0], result[1].rows(), result[2], len(empty[1]),
+             empty[2]],
+            expected_result + [0, 0]
+            )
+
 
 class TestClientCheckoutItem(unittest.TestCase):
     def setUp(cls):
@@ -488,13 +569,13 @@ class TestClientCheckoutItem(unittest.TestCase):
             "8001", "127.0.0.1:33000", "router", 100.0, ""
         )
         cmd_process.merchant_restock_product(
-            "8002", "127.0.0.1:33000", 1, 5
+            "8002", "127.0.0.1:33000", product_id("router"), 5
         )
         cmd_process.merchant_add_product(
             "8003", "127.0.0.1:33000", "switch", 200.0, ""
         )
         cmd_process.merchant_restock_product(
-            "8004", "127.0.0.1:33000", 2, 5
+            "8004", "127.0.0.1:33000", product_id("switch"), 5
         )
         cmd_process.merchant_logout(
             "8005", "127.0.0.1:33000"
@@ -509,10 +590,10 @@ class TestClientCheckoutItem(unittest.TestCase):
             "8007", "127.0.0.1:33000", "Cybermarket", "123456"
         )
         cmd_process.merchant_del_product(
-            "8008", "127.0.0.1:33000", 1
+            "8008", "127.0.0.1:33000", product_id("router")
         )
         cmd_process.merchant_del_product(
-            "8009", "127.0.0.1:33000", 2
+            "8009", "127.0.0.1:33000", product_id("switch")
         )
         cmd_process.merchant_logout(
             "8010", "127.0.0.1:33000"
@@ -528,10 +609,10 @@ class TestClientCheckoutItem(unittest.TestCase):
             "0", "127.0.0.1:33000", "liuhailin", "123456"
         )
         cmd_process.client_add_item(
-            "1", "127.0.0.1:33000", 1, 5
+            "1", "127.0.0.1:33000", product_id("router"), 5
         )
         cmd_process.client_add_item(
-            "2", "127.0.0.1:33000", 2, 5
+            "2", "127.0.0.1:33000", product_id("switch"), 5
         )
         result = cmd_process.client_checkout_item(
             "3", "127.0.0.1:33000"
@@ -540,10 +621,10 @@ class TestClientCheckoutItem(unittest.TestCase):
             "3 200 OK: Order has been checked out"
             ]
         cmd_process.client_remove_item(
-            "4", "127.0.0.1:33000", 1
+            "4", "127.0.0.1:33000", product_id("router")
         )
         cmd_process.client_remove_item(
-            "5", "127.0.0.1:33000", 2
+            "5", "127.0.0.1:33000", product_id("switch")
         )
         cmd_process.client_logout(
             "6", "127.0.0.1:33000"
@@ -555,10 +636,10 @@ class TestClientCheckoutItem(unittest.TestCase):
             "0", "127.0.0.1:33000", "liuhailin", "123456"
         )
         cmd_process.client_add_item(
-            "1", "127.0.0.1:33000", 1, 10
+            "1", "127.0.0.1:33000", product_id("router"), 10
         )
         cmd_process.client_add_item(
-            "2", "127.0.0.1:33000", 2, 10
+            "2", "127.0.0.1:33000", product_id("switch"), 10
         )
         result = cmd_process.client_checkout_item(
             "3", "127.0.0.1:33000"
@@ -569,19 +650,59 @@ merchant Cybermarket, checkout was not fully executed and this item is still \
 in your cart"
             ]
         cmd_process.client_remove_item(
-            "4", "127.0.0.1:33000", 1
+            "4", "127.0.0.1:33000", product_id("router")
         )
         cmd_process.client_remove_item(
-            "5", "127.0.0.1:33000", 2
+            "5", "127.0.0.1:33000", product_id("switch")
         )
         cmd_process.client_logout(
             "6", "127.0.0.1:33000"
         )
         self.assertEqual(result, expected_result)
 
+    def test_2(self):
+        cmd_process.client_login(
+            "0", "127.0.0.1:33000", "liuhailin", "123456"
+        )
+        cmd_process.client_add_item(
+            "1", "127.0.0.1:33000", product_id("router"), 5
+        )
+        cmd_process.client_add_item(
+            "2", "127.0.0.1:33000", product_id("switch"), 10
+        )
+        result = cmd_process.client_checkout_item(
+            "3", "127.0.0.1:33000"
+        )
+        stock = cmd_process.list_product(
+            "4", "127.0.0.1:33000", "Cybermarket"
+        )[1].column("stock")
+        items = cmd_process.client_get_items(
+            "5", "127.0.0.1:33000"
+        )[1]
+        expected_result = [
+            "3 400 Bad Request: Inventory shortage for product switch from \
+merchant Cybermarket, checkout was not fully executed and this item is still \
+in your cart"
+            ]
+        cmd_process.client_remove_item(
+            "6", "127.0.0.1:33000", product_id("router")
+        )
+        cmd_process.client_remove_item(
+            "7", "127.0.0.1:33000", product_id("switch")
+        )
+        cmd_process.client_logout(
+            "8", "127.0.0.1:33000"
+        )
+        self.assertEqual(
+            [result, list(stock), len(items)],
+            [expected_result, [5, 5], 2]
+            )
+
 
 class TestListMerchant(unittest.TestCase):
     def setUp(cls):
+        # The merchants below are added without going through the handlers
+        catalog.catalog.clear()
         cybermarket = cmd_process.Merchant(
             storename="Cybermarket",
             description="Cybermarket official store",
@@ -612,13 +733,16 @@ class TestListMerchant(unittest.TestCase):
             "0 200 OK", df
             ]
         self.assertEqual(
-            [result[0], result[1].equals(expected_result[1])],
+            [result[0],
+             result[1].to_dataframe().equals(expected_result[1])],
             [expected_result[0], True]
             )
 
 
 class TestListProduct(unittest.TestCase):
     def setUp(cls):
+        # The merchants below are added without going through the handlers
+        catalog.catalog.clear()
         cybermarket = cmd_process.Merchant(
             storename="Cybermarket",
             description="Cybermarket official store",
@@ -649,10 +773,10 @@ class TestListProduct(unittest.TestCase):
             "8005", "127.0.0.1:33000", "Cybermarket", "123456"
         )
         cmd_process.merchant_del_product(
-            "8006", "127.0.0.1:33000", 1
+            "8006", "127.0.0.1:33000", product_id("router")
         )
         cmd_process.merchant_del_product(
-            "8007", "127.0.0.1:33000", 2
+            "8007", "127.0.0.1:33000", product_id("switch")
         )
         cmd_process.merchant_logout(
             "8008", "127.0.0.1:33000"
@@ -668,16 +792,17 @@ class TestListProduct(unittest.TestCase):
             "0", "127.0.0.1:33000", "liuhailin", "123456"
         )
         cmd_process.client_add_item(
-            "1", "127.0.0.1:33000", 1, 5
+            "1", "127.0.0.1:33000", product_id("router"), 5
         )
         cmd_process.client_add_item(
-            "2", "127.0.0.1:33000", 2, 5
+            "2", "127.0.0.1:33000", product_id("switch"), 5
         )
         result = cmd_process.list_product(
             "3", "127.0.0.1:33000", "Cybermarket"
         )
         data = {
-            'product_id': [1, 2],
+            'product_id': [product_id("router"),
+                           product_id("switch")],
             'storename': ["Cybermarket", "Cybermarket"],
             'productname': ['router', 'switch'],
             'description': ["", ""],
@@ -689,16 +814,17 @@ class TestListProduct(unittest.TestCase):
             "3 200 OK: Product list has been obtained", df
             ]
         cmd_process.client_remove_item(
-            "4", "127.0.0.1:33000", 1
+            "4", "127.0.0.1:33000", product_id("router")
         )
         cmd_process.client_remove_item(
-            "5", "127.0.0.1:33000", 2
+            "5", "127.0.0.1:33000", product_id("switch")
         )
         cmd_process.client_logout(
             "6", "127.0.0.1:33000"
         )
         self.assertEqual(
-            [result[0], result[1].equals(expected_result[1])],
+            [result[0],
+             result[1].to_dataframe().equals(expected_result[1])],
             [expected_result[0], True]
             )
 
@@ -841,10 +967,10 @@ class TestMerchantRestockProduct(unittest.TestCase):
             "8004", "127.0.0.1:33000", "Cybermarket", "123456"
         )
         cmd_process.merchant_del_product(
-            "8005", "127.0.0.1:33000", 1
+            "8005", "127.0.0.1:33000", product_id("router")
         )
         cmd_process.merchant_del_product(
-            "8006", "127.0.0.1:33000", 2
+            "8006", "127.0.0.1:33000", product_id("switch")
         )
         cmd_process.merchant_logout(
             "8007", "127.0.0.1:33000"
@@ -860,7 +986,7 @@ class TestMerchantRestockProduct(unittest.TestCase):
             "0", "127.0.0.1:33000", "Cybermarket", "123456"
         )
         result = cmd_process.merchant_restock_product(
-            "1", "127.0.0.1:33000", 1, 5
+            "1", "127.0.0.1:33000", product_id("router"), 5
         )
         expected_result = [
             "1 200 OK: This product has been restock"
@@ -875,7 +1001,7 @@ class TestMerchantRestockProduct(unittest.TestCase):
             "0", "127.0.0.1:33000", "Cybermarket", "123456"
         )
         result = cmd_process.merchant_restock_product(
-            "1", "127.0.0.1:33000", 3, 5
+            "1", "127.0.0.1:33000", MISSING_PRODUCT_ID, 5
         )
         expected_result = [
             "1 400 Bad Request: You are restocking an item that is not from \
@@ -887,6 +1013,78 @@ this store"
         self.assertEqual(result, expected_result)
 
 
+class TestMerchantDelProduct(unittest.TestCase):
+    def setUp(cls):
+        for storename in ("Delstore", "Otherstore"):
+            cmd_process.session.add(cmd_process.Merchant(
+                storename=storename,
+                description="",
+                email=storename.lower() + "@cybermarket.com",
+                password="123456"
+            ))
+        cmd_process.session.commit()
+        cmd_process.merchant_login(
+            "8000", "127.0.0.1:33000", "Delstore", "123456"
+        )
+        cmd_process.merchant_login(
+            "8001", "127.0.0.1:33001", "Otherstore", "123456"
+        )
+        cmd_process.merchant_add_product(
+            "8002", "127.0.0.1:33000", "modem", 50.0, ""
+        )
+        cls.product_id = cmd_process.session.query(
+            cmd_process.Product.productId).filter(
+            cmd_process.Product.productname == "modem").scalar()
+
+    def tearDown(self):
+        cmd_process.release_connection("127.0.0.1:33000")
+        cmd_process.release_connection("127.0.0.1:33001")
+        for storename in ("Delstore", "Otherstore"):
+            merchant = cmd_process.session.query(
+                cmd_process.Merchant).filter(
+                cmd_process.Merchant.storename == storename).first()
+            for product in merchant.product:
+                cmd_process.session.delete(product)
+            cmd_process.session.query(model.ProductTombstone).filter(
+                model.ProductTombstone.merchant_id == merchant.merchantId
+                ).delete()
+            cmd_process.session.delete(merchant)
+        cmd_process.session.commit()
+
+    def test_0(self):
+        result = cmd_process.cmd_process(
+            "MERCHANT_DEL_PRODUCT", "1", "127.0.0.1:33001", self.product_id
+        )
+        self.assertEqual(result, [
+            "1 403 Forbidden: You are deleting an item that is not from \
+this store"
+            ])
+        self.assertIsNotNone(cmd_process.session.get(
+            cmd_process.Product, self.product_id))
+
+    def test_1(self):
+        result = cmd_process.cmd_process(
+            "MERCHANT_DEL_PRODUCT", "1", "127.0.0.1:33000", -1
+        )
+        self.assertEqual(result, [
+            "1 404 Not Found: The product you are trying to delete cannot \
+be found"
+            ])
+
+    def test_2(self):
+        catalog.catalog.get(catalog.products_key("Delstore"), lambda: "old")
+        result = cmd_process.cmd_process(
+            "MERCHANT_DEL_PRODUCT", "1", "127.0.0.1:33000", self.product_id
+        )
+        self.assertEqual(result, [
+            "1 200 OK: This product has been deleted from the product list"
+            ])
+        self.assertIsNone(cmd_process.session.get(
+            cmd_process.Product, self.product_id))
+        self.assertEqual(catalog.catalog.get(
+            catalog.products_key("Delstore"), lambda: "new"), "new")
+
+
 class TestMerchantGetProfit(unittest.TestCase):
     def setUp(cls):
         cybermarket = cmd_process.Merchant(
@@ -904,13 +1102,13 @@ class TestMerchantGetProfit(unittest.TestCase):
             "8001", "127.0.0.1:33000", "router", 100.0, ""
         )
         cmd_process.merchant_restock_product(
-            "8002", "127.0.0.1:33000", 1, 5
+            "8002", "127.0.0.1:33000", product_id("router"), 5
         )
         cmd_process.merchant_add_product(
             "8003", "127.0.0.1:33000", "switch", 200.0, ""
         )
         cmd_process.merchant_restock_product(
-            "8004", "127.0.0.1:33000", 2, 5
+            "8004", "127.0.0.1:33000", product_id("switch"), 5
         )
         cmd_process.merchant_logout(
             "8005", "127.0.0.1:33000"
@@ -923,10 +1121,10 @@ class TestMerchantGetProfit(unittest.TestCase):
             "8007", "127.0.0.1:33000", "liuhailin", "123456"
         )
         cmd_process.client_add_item(
-            "8008", "127.0.0.1:33000", 1, 5
+            "8008", "127.0.0.1:33000", product_id("router"), 5
         )
         cmd_process.client_add_item(
-            "8009", "127.0.0.1:33000", 2, 5
+            "8009", "127.0.0.1:33000", product_id("switch"), 5
         )
         cmd_process.client_checkout_item(
             "8010", "127.0.0.1:33000"
@@ -940,10 +1138,10 @@ class TestMerchantGetProfit(unittest.TestCase):
             "8012", "127.0.0.1:33000", "Cybermarket", "123456"
         )
         cmd_process.merchant_del_product(
-            "8013", "127.0.0.1:33000", 1
+            "8013", "127.0.0.1:33000", product_id("router")
         )
         cmd_process.merchant_del_product(
-            "8014", "127.0.0.1:33000", 2
+            "8014", "127.0.0.1:33000", product_id("switch")
         )
         cmd_process.merchant_logout(
             "8015", "127.0.0.1:33000"
@@ -968,3 +1166,1457 @@ class TestMerchantGetProfit(unittest.TestCase):
             "2", "127.0.0.1:33000"
         )
         self.assertEqual(result, expected_result)
+
+
+class TestFrameDecoder(unittest.TestCase):
+    def test_0(self):
+        decoder = protocol.FrameDecoder()
+        data = protocol.encode_frame(b"first") + \
+            protocol.encode_frame(b"") + protocol.encode_frame(b"second")
+        self.assertEqual(decoder.feed(data), [b"first", b"", b"second"])
+        self.assertEqual(decoder.pending(), 0)
+
+    def test_1(self):
+        decoder = protocol.FrameDecoder()
+        payload = bytes(range(256)) * 64
+        data = protocol.encode_frame(payload) + protocol.encode_frame(b"x")
+        frames = []
+        for i in range(0, len(data), 1000):
+            frames += decoder.feed(data[i:i + 1000])
+        self.assertEqual(frames, [payload, b"x"])
+
+    def test_2(self):
+        decoder = protocol.FrameDecoder(max_frame_size=4)
+        with self.assertRaises(protocol.ProtocolError):
+            decoder.feed(protocol.encode_frame(b"too long"))
+
+
+class TestProcessRequest(unittest.TestCase):
+    def setUp(cls):
+        server.connect_list["127.0.0.1:33000"] = outbox.Outbox()
+
+    def tearDown(self):
+        del server.connect_list["127.0.0.1:33000"]
+
+    def test_0(self):
+        async def run():
+            await asyncio.gather(
+                server.process_request(
+                    "127.0.0.1:33000", "LIST_MERCHANT", "0"),
+                server.process_request(
+                    "127.0.0.1:33000", "UNDEFINED", "1"),
+            )
+            messages = server.connect_list["127.0.0.1:33000"].messages
+            return [message[0] for message in messages]
+        result = asyncio.run(run())
+        expected_result = [
+            "0 200 OK",
+            "1 400 Bad Request: You are trying to call an undefined method"
+            ]
+        self.assertEqual(sorted(result), expected_result)
+
+    def test_1(self):
+        def fail(request_id, connected_address, *args):
+            raise ValueError("broken handler")
+
+        async def run():
+            await asyncio.gather(
+                server.process_request("127.0.0.1:33000", "FAIL", "0"),
+                server.process_request(
+                    "127.0.0.1:33000", "LIST_MERCHANT", "1"))
+            messages = server.connect_list["127.0.0.1:33000"].messages
+            return [message[0] for message in messages]
+        with mock.patch.dict(cmd_process.function_dict, {"FAIL": fail}):
+            result = asyncio.run(run())
+        self.assertEqual(sorted(result), ["0 500 Internal Server Error",
+                                          "1 200 OK"])
+
+
+class TestOutbox(unittest.TestCase):
+    def test_0(self):
+        async def run():
+            box = outbox.Outbox(2, "drop")
+            await box.put(["0"])
+            self.assertTrue(box.push(["1"]))
+            self.assertFalse(box.push(["PUSH"]))
+            # The reply waits for the writer to make room
+            put = asyncio.create_task(box.put(["2"]))
+            await asyncio.sleep(0)
+            self.assertFalse(put.done())
+            taken = await box.take()
+            await put
+            return taken, await box.take(), box.dropped
+        self.assertEqual(asyncio.run(run()), ([["0"], ["1"]], [["2"]], 1))
+
+    def test_1(self):
+        async def run():
+            box = outbox.Outbox(1, "disconnect")
+            box.push(["0"])
+            await box.put(["1"])
+            return box.closed, await box.take()
+        self.assertEqual(asyncio.run(run()), (True, []))
+
+    def test_2(self):
+        async def run():
+            box = outbox.Outbox(1, "block")
+            box.push(["0"])
+            self.assertTrue(box.push(["1"]))
+            box.close(discard=False)
+            await box.put(["2"])
+            return await box.take(), await box.take()
+        self.assertEqual(asyncio.run(run()), ([["0"], ["1"]], []))
+
+    def test_3(self):
+        with self.assertRaises(ValueError):
+            outbox.Outbox(1, "wait")
+        with self.assertRaises(ValueError):
+            config.ServerConfig().update({"slow_consumer": "wait"}, "test")
+
+
+class TestRateLimiter(unittest.TestCase):
+    def setUp(cls):
+        cls.config = config.ServerConfig()
+        cls.limiter = ratelimit.RateLimiter()
+
+    def allowed(self, connect, commands, now, count=1):
+        return [
+            self.limiter.allow(self.config, connect,
+                               ("host", "127.0.0.1"), commands, now)
+            for _ in range(count)
+        ]
+
+    def test_0(self):
+        bucket = ratelimit.TokenBucket(2.0, 4, 0.0)
+        bucket.tokens = 0.0
+        self.assertEqual(bucket.refill(1.0), 2.0)
+        self.assertEqual(bucket.refill(10.0), 4.0)
+        self.assertTrue(bucket.full(10.0))
+
+    def test_1(self):
+        self.assertEqual(
+            ratelimit.parse_command_rates(
+                "LIST_PRODUCT=5/20, search_product=2.5"),
+            {"LIST_PRODUCT": (5.0, 20), "SEARCH_PRODUCT": (2.5, 3)})
+        self.assertEqual(ratelimit.parse_command_rates(""), {})
+        for text in ("LIST_PRODUCT", "=1", "LIST_PRODUCT=1/0"):
+            with self.assertRaises(ValueError):
+                ratelimit.parse_command_rates(text)
+
+    def test_2(self):
+        self.assertEqual(self.allowed("a", ["LIST_PRODUCT"], 0.0, 100),
+                         [True] * 100)
+        self.config.rate_limit = 1.0
+        self.config.rate_burst = 2
+        self.assertEqual(self.allowed("a", ["LIST_PRODUCT"], 0.0, 3),
+                         [True, True, False])
+        # Another connection has its own bucket
+        self.assertEqual(self.allowed("b", ["LIST_PRODUCT"], 0.0), [True])
+        self.assertEqual(self.allowed("a", ["LIST_PRODUCT"], 1.0, 2),
+                         [True, False])
+
+    def test_3(self):
+        self.config.principal_rate_limit = 1.0
+        self.config.principal_rate_burst = 2
+        self.config.command_rate_limits = "SEARCH_PRODUCT=1/1"
+        # The connections of a principal share its buckets
+        self.assertEqual(self.allowed("a", ["SEARCH_PRODUCT"], 0.0), [True])
+        self.assertEqual(self.allowed("b", ["SEARCH_PRODUCT"], 0.0),
+                         [False])
+        self.assertEqual(self.allowed("b", ["LIST_PRODUCT"], 0.0, 2),
+                         [True, False])
+        self.assertEqual(self.allowed("b", ["SEARCH_PRODUCT"], 1.0),
+                         [True])
+
+    def test_4(self):
+        self.assertEqual(
+            ratelimit.request_commands(
+                "BATCH", ["EACH", ("LIST_PRODUCT", "a"), ("LIST_MERCHANT",)]),
+            ["LIST_PRODUCT", "LIST_MERCHANT"])
+        self.assertEqual(ratelimit.request_commands("BATCH", ["EACH"]),
+                         ["BATCH"])
+        self.assertEqual(ratelimit.principal("127.0.0.1:33000"),
+                         ("host", "127.0.0.1"))
+        # A batch takes a token for each command
+        self.config.rate_limit = 1.0
+        self.config.rate_burst = 3
+        self.assertEqual(
+            self.allowed("a", ["LIST_PRODUCT", "LIST_MERCHANT"], 0.0, 2),
+            [True, False])
+        # Not even once, however long the connection waited
+        self.assertEqual(
+            self.allowed("b", ["LIST_PRODUCT"] * 4, 100.0), [False])
+        self.config.command_rate_limits = "LIST_PRODUCT=5/20"
+        self.config.rate_limit = 0.0
+        self.assertEqual(
+            self.allowed("c", ["LIST_PRODUCT"] * 1000, 200.0), [False])
+        self.assertEqual(
+            self.allowed("c", ["LIST_PRODUCT"] * 20, 200.0, 2),
+            [True, False])
+
+
+class TestWorkerPool(unittest.TestCase):
+    def setUp(cls):
+        cls.pool = worker.WorkerPool(2, 0)
+
+    def tearDown(self):
+        self.pool.shutdown()
+
+    def test_0(self):
+        async def run():
+            return await asyncio.gather(
+                self.pool.run("LIST_MERCHANT", "0", "127.0.0.1:33000"),
+                self.pool.run("UNDEFINED", "1", "127.0.0.1:33000"),
+            )
+        result = asyncio.run(run())
+        expected_result = [
+            "0 200 OK",
+            "1 400 Bad Request: You are trying to call an undefined method"
+            ]
+        self.assertEqual([result[0][0], result[1][0]], expected_result)
+
+    def test_1(self):
+        async def run():
+            await self.pool.admit()
+            await self.pool.admit()
+            saturated = self.pool.saturated()
+            self.pool.release()
+            return [saturated, self.pool.saturated()]
+        self.assertEqual(asyncio.run(run()), [True, False])
+
+    def test_2(self):
+        pool = worker.WorkerPool(0, 0)
+        asyncio.run(pool.run("LIST_MERCHANT", "0", "127.0.0.1:33000"))
+        self.assertFalse(cmd_process.session.registry.has())
+
+    def test_3(self):
+        pool = worker.WorkerPool(1, 0)
+        order = []
+
+        async def run():
+            await asyncio.gather(*(
+                pool.schedule(connect, order.append, name)
+                for connect, name in [("a", "a1"), ("a", "a2"),
+                                      ("a", "a3"), ("b", "b1")]
+            ))
+        asyncio.run(run())
+        pool.shutdown()
+        # b does not wait for every request of a
+        self.assertEqual(order, ["a1", "a2", "b1", "a3"])
+        self.assertEqual((pool.running, pool.queues), (0, {}))
+
+
+class TestBinaryCodec(unittest.TestCase):
+    def test_0(self):
+        message = ("CLIENT_ADD_ITEM", "0", 1, 2.5, None, True, b"\x00",
+                   ["a", ("b", {"c": -1})])
+        binary = codec.BinaryCodec()
+        self.assertEqual(binary.decode(binary.encode(message)), message)
+
+    def test_1(self):
+        data = {
+            'product_id': [1, 2],
+            'storename': ["Cybermarket", "Cybermarket"],
+            'price': [100.0, 200.0],
+        }
+        table = resultset.ResultSet(data.keys(), data.values())
+        binary = codec.BinaryCodec()
+        payload = binary.encode(["0 200 OK", table])
+        result = binary.decode(payload)
+        self.assertEqual(result, ["0 200 OK", table])
+        self.assertLess(
+            len(payload),
+            len(codec.PickleCodec().encode(["0 200 OK", table]))
+            )
+
+    def test_2(self):
+        binary = codec.BinaryCodec()
+        with self.assertRaises(codec.CodecError):
+            binary.decode(binary.encode(["0 200 OK"])[:-1])
+
+    def test_3(self):
+        table = resultset.ResultSet(
+            ["product_id", "productname"], [[1, 2], ["router", "switch"]]
+            )
+        binary = codec.BinaryCodec()
+        first = binary.encode(["0 200 OK", table])
+        second = binary.encode(["12 200 OK: Product list", table])
+        self.assertIn("binary", table.encodings)
+        self.assertEqual(binary.decode(first), ["0 200 OK", table])
+        self.assertEqual(
+            binary.decode(second), ["12 200 OK: Product list", table]
+            )
+
+    def test_4(self):
+        table = resultset.ResultSet(
+            ["product_id", "productname"], [[1, 2], ["router", "switch"]]
+            )
+        legacy = codec.PickleCodec()
+        legacy.encode(["0 200 OK", table])
+        result = legacy.decode(legacy.encode(["12 200 OK: Продукты", table]))
+        self.assertEqual(result[0], "12 200 OK: Продукты")
+        self.assertTrue(result[1].equals(table.to_dataframe()))
+
+
+class TestNegotiate(unittest.TestCase):
+    def test_0(self):
+        offered = codec.parse_hello(codec.encode_hello(["msgpack", "binary"]))
+        self.assertEqual(codec.negotiate(offered).name, "binary")
+
+    def test_1(self):
+        self.assertEqual(codec.negotiate(["msgpack"]), codec.LEGACY_CODEC)
+
+    def test_2(self):
+        request = codec.PickleCodec().encode(("LIST_MERCHANT", "0"))
+        self.assertIsNone(codec.parse_hello(request))
+
+
+class TestResultSet(unittest.TestCase):
+    def test_0(self):
+        table = resultset.ResultSet.from_rows(
+            ["product_id", "productname", "price"],
+            [(1, "router", 100.0), (2, "switch", 200.0)]
+            )
+        self.assertEqual(
+            [len(table), table.column("price").typecode, table.rows()],
+            [2, "d", [[1, "router", 100.0], [2, "switch", 200.0]]]
+            )
+
+    def test_1(self):
+        table = resultset.ResultSet.from_rows(["storename", "stock"], [])
+        df = pd.DataFrame({"storename": [], "stock": []})
+        self.assertEqual(
+            [len(table), table.to_dataframe().equals(df)], [0, True]
+            )
+
+    def test_2(self):
+        table = resultset.ResultSet.from_rows(
+            ["product_id", "storename"], [(1, "Cybermarket")]
+            )
+        legacy = codec.PickleCodec()
+        result = legacy.decode(legacy.encode(["0 200 OK", table]))
+        df = pd.DataFrame({"product_id": [1], "storename": ["Cybermarket"]})
+        self.assertTrue(result[1].equals(df))
+
+
+class TestSessionRegistry(unittest.TestCase):
+    def test_0(self):
+        sessions = registry.SessionRegistry()
+        first = sessions.login_client("127.0.0.1:33000", 1)
+        second = sessions.login_client("127.0.0.1:33000", 2)
+        sessions.login_merchant("127.0.0.1:33000", 3)
+        self.assertEqual(
+            [first, second, sessions.client("127.0.0.1:33000"),
+             sessions.drop("127.0.0.1:33000"),
+             sessions.merchant("127.0.0.1:33000")],
+            [True, False, 1, (1, 3), None]
+            )
+
+
+class TestReleaseConnection(unittest.TestCase):
+    def setUp(cls):
+        cmd_process.client_create(
+            "8000", "127.0.0.1:33100", "qitang",
+            "qitang@cybermarket.com", "123456"
+            )
+        cmd_process.client_login(
+            "8001", "127.0.0.1:33100", "qitang", "123456"
+            )
+
+    def test_0(self):
+        cmd_process.release_connection("127.0.0.1:33100")
+        result = cmd_process.client_get_price(
+            "0", "127.0.0.1:33100"
+            )
+        expected_result = [
+            "0 401 Unauthorized: You have not logged in or your login has \
+timed out"
+            ]
+        self.assertEqual(result, expected_result)
+
+
+class TestMigration(unittest.TestCase):
+    def setUp(cls):
+        cls.engine = sqlalchemy.create_engine("sqlite:///:memory:")
+        with cls.engine.begin() as connection:
+            connection.exec_driver_sql(
+                'CREATE TABLE "order" (id INTEGER PRIMARY KEY, '
+                'client_id INTEGER, product_id INTEGER, quantity INTEGER)'
+                )
+
+    def tearDown(self):
+        self.engine.dispose()
+
+    def test_0(self):
+        created = migration.create_missing_indexes(
+            self.engine, cmd_process.Order.metadata
+            )
+        indexes = sqlalchemy.inspect(self.engine).get_indexes("order")
+        self.assertEqual(
+            sorted(created),
+            ["ix_order_client_id_product_id", "ix_order_product_id"]
+            )
+        self.assertEqual(
+            sorted(index["name"] for index in indexes), sorted(created)
+            )
+
+    def test_1(self):
+        migration.create_missing_indexes(
+            self.engine, cmd_process.Order.metadata
+            )
+        created = migration.create_missing_indexes(
+            self.engine, cmd_process.Order.metadata
+            )
+        self.assertEqual(created, [])
+
+    def test_2(self):
+        with self.engine.begin() as connection:
+            connection.exec_driver_sql(
+                'CREATE TABLE product ("productId" INTEGER PRIMARY KEY, '
+                'productname VARCHAR, price FLOAT, stock INTEGER, '
+                'description VARCHAR, merchant_id INTEGER)'
+                )
+            connection.exec_driver_sql(
+                "INSERT INTO product VALUES (1, 'router', 1.0, 0, '', 1)"
+                )
+        added = migration.add_missing_columns(
+            self.engine, cmd_process.Product.metadata
+            )
+        with self.engine.connect() as connection:
+            version = connection.exec_driver_sql(
+                "SELECT version FROM product").scalar()
+        self.assertEqual(
+            [added, version],
+            [["product.version", "order.reserved", "order.reserved_until"],
+             0]
+            )
+
+    def test_3(self):
+        with self.engine.begin() as connection:
+            connection.exec_driver_sql(
+                'CREATE TABLE product ("productId" INTEGER PRIMARY KEY, '
+                'productname VARCHAR, price FLOAT, stock INTEGER, '
+                'description VARCHAR, merchant_id INTEGER)'
+                )
+            connection.exec_driver_sql(
+                "INSERT INTO product VALUES (1, 'router', 1.0, 0, '', 1)"
+                )
+        self.assertTrue(search.ensure_search_index(self.engine))
+        self.assertFalse(search.ensure_search_index(self.engine))
+        with self.engine.connect() as connection:
+            found = connection.exec_driver_sql(
+                "SELECT rowid FROM product_fts WHERE product_fts MATCH 'rout*'"
+                ).scalar()
+        self.assertEqual(found, 1)
+
+
+class TestBatch(unittest.TestCase):
+    def setUp(cls):
+        batchstore = cmd_process.Merchant(
+            storename="Batchstore",
+            description="",
+            email="batchstore@cybermarket.com",
+            password="123456"
+        )
+        cmd_process.session.add(batchstore)
+        cmd_process.session.commit()
+        cmd_process.cmd_process(
+            "MERCHANT_LOGIN", "8000", "127.0.0.1:33200",
+            "Batchstore", "123456"
+            )
+
+    def tearDown(self):
+        cmd_process.cmd_process(
+            "MERCHANT_LOGOUT", "8001", "127.0.0.1:33200"
+            )
+        result = cmd_process.session.query(cmd_process.Merchant).filter(
+            cmd_process.Merchant.email == "batchstore@cybermarket.com"
+        ).first()
+        for product in result.product:
+            cmd_process.session.delete(product)
+        cmd_process.session.delete(result)
+        cmd_process.session.commit()
+
+    def products(self):
+        return [product.productname for product in cmd_process.session.query(
+            cmd_process.Product).join(cmd_process.Merchant).filter(
+                cmd_process.Merchant.email == "batchstore@cybermarket.com"
+            ).order_by(cmd_process.Product.productId)]
+
+    def test_0(self):
+        result = cmd_process.cmd_process(
+            "BATCH", "0", "127.0.0.1:33200", "ATOMIC",
+            ("SET_MERCHANT_DESCRIPTION", "Batch store"),
+            ("MERCHANT_ADD_PRODUCT", "router", 100.0, ""),
+            ("MERCHANT_ADD_PRODUCT", "switch", 200.0, "")
+            )
+        self.assertEqual(result[0], "0 200 OK: The batch has been executed")
+        self.assertEqual(len(result[1]), 3)
+        self.assertEqual(self.products(), ["router", "switch"])
+
+    def test_1(self):
+        result = cmd_process.cmd_process(
+            "BATCH", "0", "127.0.0.1:33200", "ATOMIC",
+            ("MERCHANT_ADD_PRODUCT", "router", 100.0, ""),
+            ("MERCHANT_RESTOCK_PRODUCT", 0, 5),
+            ("MERCHANT_ADD_PRODUCT", "switch", 200.0, "")
+            )
+        expected_result = [
+            "0 409 Conflict: A command of the batch failed, the batch was \
+rolled back",
+            [
+                ["0 200 OK: This product has been added to the product list"],
+                ["0 400 Bad Request: You are restocking an item that is not \
+from this store"]
+            ]
+            ]
+        self.assertEqual(result, expected_result)
+        self.assertEqual(self.products(), [])
+
+    def test_2(self):
+        result = cmd_process.cmd_process(
+            "BATCH", "0", "127.0.0.1:33200", "EACH",
+            ("MERCHANT_ADD_PRODUCT", "router", 100.0, ""),
+            ("MERCHANT_RESTOCK_PRODUCT", 0, 5),
+            ("MERCHANT_ADD_PRODUCT", "switch", 200.0, "")
+            )
+        self.assertEqual(result[0], "0 200 OK: The batch has been executed")
+        self.assertEqual(len(result[1]), 3)
+        self.assertEqual(self.products(), ["router", "switch"])
+
+    def test_3(self):
+        result = cmd_process.cmd_process(
+            "BATCH", "0", "127.0.0.1:33200", "EACH",
+            ("MERCHANT_LOGOUT",),
+            ("BATCH", "EACH")
+            )
+        expected_result = [
+            ["0 400 Bad Request: This method cannot be called in a batch"]
+            ] * 2
+        self.assertEqual(result[1], expected_result)
+        self.assertIsNotNone(
+            cmd_process.logged_in_merchant("127.0.0.1:33200")
+            )
+
+    def test_4(self):
+        fail = mock.Mock(side_effect=RuntimeError("broken"))
+        with mock.patch.dict(cmd_process.function_dict, {"BROKEN": fail}):
+            result = cmd_process.cmd_process(
+                "BATCH", "0", "127.0.0.1:33200", "EACH",
+                ("MERCHANT_ADD_PRODUCT", "router", 100.0, ""),
+                ("MERCHANT_RESTOCK_PRODUCT", 0, "abc"),
+                ("MERCHANT_ADD_PRODUCT", "switch"),
+                ("BROKEN",),
+                ("MERCHANT_ADD_PRODUCT", "switch", 200.0, "")
+                )
+        self.assertEqual(result[0], "0 200 OK: The batch has been executed")
+        self.assertEqual(result[1][2], [
+            "0 400 Bad Request: The arguments of the command are invalid"])
+        self.assertEqual(result[1][3], ["0 500 Internal Server Error"])
+        self.assertEqual(self.products(), ["router", "switch"])
+
+    def test_5(self):
+        result = cmd_process.cmd_process(
+            "BATCH", "0", "127.0.0.1:33200", "ATOMIC",
+            ("SUBSCRIBE_STORE", "Batchstore"),
+            ("UNSUBSCRIBE_STORE", "Batchstore")
+            )
+        self.assertEqual(result[1], [
+            ["0 400 Bad Request: This method cannot be called in a batch"]
+            ])
+
+
+class TestSqlitePragmas(unittest.TestCase):
+    def setUp(cls):
+        cls.directory = tempfile.TemporaryDirectory()
+        cls.engine = sqlalchemy.create_engine(
+            "sqlite:///" + os.path.join(cls.directory.name, "test.db")
+            )
+
+    def tearDown(self):
+        self.engine.dispose()
+        self.directory.cleanup()
+        os.environ.pop("CYBERMARKET_SQLITE_SYNCHRONOUS", None)
+
+    def test_0(self):
+        pragmas = setting.sqlite_pragmas("fast")
+        sqlalchemy.event.listen(
+            self.engine, "connect",
+            lambda dbapi_connection, record: setting.apply_pragmas(
+                dbapi_connection, pragmas
+                )
+            )
+        with self.engine.connect() as connection:
+            result = [
+                connection.exec_driver_sql(
+                    "PRAGMA " + name).scalar()
+                for name in ("journal_mode", "synchronous", "temp_store")
+                ]
+        self.assertEqual(result, ["wal", 1, 2])
+
+    def test_1(self):
+        os.environ["CYBERMARKET_SQLITE_SYNCHRONOUS"] = "EXTRA"
+        pragmas = setting.sqlite_pragmas("durable")
+        self.assertEqual(pragmas["synchronous"], "EXTRA")
+        self.assertEqual(pragmas["journal_mode"], "WAL")
+
+    def test_2(self):
+        with self.assertRaises(ValueError):
+            setting.sqlite_pragmas("unsafe")
+
+
+class TestCatalogCache(unittest.TestCase):
+    def setUp(cls):
+        cls.cache = catalog.CatalogCache(2)
+
+    def test_0(self):
+        self.cache.get("a", lambda: 1)
+        self.cache.get("b", lambda: 2)
+        self.cache.get("a", lambda: 3)
+        self.cache.get("c", lambda: 4)
+        result = [self.cache.get(key, lambda: None) for key in "abc"]
+        self.assertEqual(result, [1, None, 4])
+        self.assertEqual(
+            self.cache.stats(),
+            {"hits": 3, "misses": 4, "size": 2, "maxsize": 2}
+            )
+
+    def test_1(self):
+        def load():
+            self.cache.invalidate("b")
+            return 1
+        self.assertEqual(self.cache.get("a", load), 1)
+        self.assertEqual(self.cache.get("a", lambda: 2), 2)
+
+    def test_2(self):
+        cybermarket = cmd_process.Merchant(
+            storename="Cachestore",
+            description="",
+            email="cachestore@cybermarket.com",
+            password="123456"
+        )
+        cmd_process.session.add(cybermarket)
+        cmd_process.session.commit()
+        cmd_process.cmd_process(
+            "MERCHANT_LOGIN", "0", "127.0.0.1:33300", "Cachestore", "123456"
+            )
+        before = cmd_process.cmd_process(
+            "LIST_PRODUCT", "1", "127.0.0.1:33300", "Cachestore"
+            )
+        cmd_process.cmd_process(
+            "MERCHANT_ADD_PRODUCT", "2", "127.0.0.1:33300", "router", 1.0, ""
+            )
+        after = cmd_process.cmd_process(
+            "LIST_PRODUCT", "3", "127.0.0.1:33300", "Cachestore"
+            )
+        cmd_process.cmd_process(
+            "MERCHANT_DEL_PRODUCT", "4", "127.0.0.1:33300",
+            after[1].column("product_id")[0]
+            )
+        cmd_process.cmd_process("MERCHANT_LOGOUT", "5", "127.0.0.1:33300")
+        cmd_process.session.delete(cmd_process.session.query(
+            cmd_process.Merchant).filter(
+                cmd_process.Merchant.storename == "Cachestore").first())
+        cmd_process.session.commit()
+        self.assertEqual([len(before[1]), len(after[1])], [0, 1])
+
+    def test_3(self):
+        counter = multiprocessing.Value("Q", 0)
+        other = catalog.CatalogCache(2)
+        self.cache.share(counter)
+        other.share(counter)
+        self.cache.get("a", lambda: 1)
+        other.get("a", lambda: 1)
+        other.get("b", lambda: 2)
+        self.cache.invalidate("b")
+        self.assertEqual(self.cache.get("a", lambda: 3), 1)
+        self.assertEqual(other.get("a", lambda: 3), 3)
+        self.assertEqual(other.get("b", lambda: 4), 4)
+
+
+class TestNotificationHub(unittest.TestCase):
+    def setUp(cls):
+        cls.messages = []
+        notify.hub.attach(
+            lambda connect, message: cls.messages.append((connect, message))
+            )
+        pushstore = cmd_process.Merchant(
+            storename="Pushstore",
+            description="",
+            email="pushstore@cybermarket.com",
+            password="123456"
+        )
+        cmd_process.session.add(pushstore)
+        cmd_process.session.commit()
+        cmd_process.cmd_process(
+            "MERCHANT_LOGIN", "8000", "127.0.0.1:33400", "Pushstore", "123456"
+            )
+        cmd_process.cmd_process(
+            "MERCHANT_ADD_PRODUCT", "8001", "127.0.0.1:33400", "router",
+            100.0, ""
+            )
+        cls.product_id = cmd_process.session.query(
+            cmd_process.Product.productId).join(cmd_process.Merchant).filter(
+                cmd_process.Merchant.storename == "Pushstore").scalar()
+        cmd_process.cmd_process(
+            "SUBSCRIBE_STORE", "8002", "127.0.0.1:33401", "Pushstore"
+            )
+
+    def tearDown(self):
+        notify.hub.attach(None)
+        cmd_process.release_connection("127.0.0.1:33401")
+        cmd_process.cmd_process(
+            "MERCHANT_DEL_PRODUCT", "8003", "127.0.0.1:33400", self.product_id
+            )
+        cmd_process.release_connection("127.0.0.1:33400")
+        cmd_process.session.delete(cmd_process.session.query(
+            cmd_process.Merchant).filter(
+                cmd_process.Merchant.storename == "Pushstore").first())
+        cmd_process.session.commit()
+
+    def test_0(self):
+        cmd_process.cmd_process(
+            "MERCHANT_RESTOCK_PRODUCT", "0", "127.0.0.1:33400",
+            self.product_id, 5
+            )
+        connect, message = self.messages[0]
+        self.assertEqual(connect, "127.0.0.1:33401")
+        self.assertEqual(message[:2], ["PUSH STORE_CHANGED", "Pushstore"])
+        self.assertEqual(message[2].rows(), [
+            [self.product_id, "Pushstore", "router", "", 100.0, 5, False]
+            ])
+
+    def test_1(self):
+        cmd_process.cmd_process(
+            "BATCH", "0", "127.0.0.1:33400", "ATOMIC",
+            ("MERCHANT_RESTOCK_PRODUCT", self.product_id, 5),
+            ("MERCHANT_RESTOCK_PRODUCT", 0, 5)
+            )
+        self.assertEqual(self.messages, [])
+
+    def test_2(self):
+        cmd_process.cmd_process(
+            "UNSUBSCRIBE_STORE", "0", "127.0.0.1:33401", "Pushstore"
+            )
+        cmd_process.cmd_process(
+            "MERCHANT_RESTOCK_PRODUCT", "1", "127.0.0.1:33400",
+            self.product_id, 5
+            )
+        self.assertEqual(self.messages, [])
+
+    def test_3(self):
+        inboxes = [queue.Queue(), queue.Queue()]
+        received = queue.Queue()
+        peer = notify.NotificationHub()
+        peer.attach(lambda connect, message: received.put(
+            (connect, message)))
+        peer.subscribe("127.0.0.1:33402", "Pushstore")
+        peer.link(inboxes[1], [inboxes[0]])
+        notify.hub.link(inboxes[0], [inboxes[1]])
+        try:
+            cmd_process.cmd_process(
+                "MERCHANT_RESTOCK_PRODUCT", "0", "127.0.0.1:33400",
+                self.product_id, 5
+                )
+            connect, message = received.get(timeout=5)
+        finally:
+            notify.hub.peers = []
+        self.assertEqual(connect, "127.0.0.1:33402")
+        self.assertEqual(list(message[2].column("stock")), [5])
+        self.assertEqual(len(self.messages), 1)
+
+
+class TestListProductSince(unittest.TestCase):
+    def setUp(cls):
+        syncstore = cmd_process.Merchant(
+            storename="Syncstore",
+            description="",
+            email="syncstore@cybermarket.com",
+            password="123456"
+        )
+        cmd_process.session.add(syncstore)
+        cmd_process.session.commit()
+        cmd_process.cmd_process(
+            "MERCHANT_LOGIN", "8000", "127.0.0.1:33500", "Syncstore", "123456"
+            )
+        for name in ("router", "switch"):
+            cmd_process.cmd_process(
+                "MERCHANT_ADD_PRODUCT", "8001", "127.0.0.1:33500", name,
+                1.0, ""
+                )
+
+    def tearDown(self):
+        merchant = cmd_process.session.query(cmd_process.Merchant).filter(
+            cmd_process.Merchant.storename == "Syncstore").first()
+        for product in merchant.product:
+            cmd_process.session.delete(product)
+        cmd_process.session.query(model.ProductTombstone).filter(
+            model.ProductTombstone.merchant_id
+            == merchant.merchantId).delete()
+        cmd_process.session.delete(merchant)
+        cmd_process.session.commit()
+        cmd_process.release_connection("127.0.0.1:33500")
+
+    def test_0(self):
+        result = cmd_process.cmd_process(
+            "LIST_PRODUCT_SINCE", "0", "127.0.0.1:33500", "Syncstore", 0
+            )
+        self.assertEqual(
+            [row[2] for row in result[1].rows()], ["router", "switch"]
+            )
+        self.assertEqual(result[2:], [[], 2, True])
+
+    def test_1(self):
+        router, switch = cmd_process.cmd_process(
+            "LIST_PRODUCT_SINCE", "0", "127.0.0.1:33500", "Syncstore", 0
+            )[1].column("product_id")
+        cmd_process.cmd_process(
+            "MERCHANT_RESTOCK_PRODUCT", "1", "127.0.0.1:33500", router, 5
+            )
+        cmd_process.cmd_process(
+            "MERCHANT_DEL_PRODUCT", "2", "127.0.0.1:33500", switch
+            )
+        result = cmd_process.cmd_process(
+            "LIST_PRODUCT_SINCE", "3", "127.0.0.1:33500", "Syncstore", 2
+            )
+        self.assertEqual(
+            [row[0::5] for row in result[1].rows()], [[router, 5]]
+            )
+        self.assertEqual(result[2:], [[switch], 4, False])
+
+    def test_2(self):
+        result = cmd_process.cmd_process(
+            "LIST_PRODUCT_SINCE", "0", "127.0.0.1:33500", "Syncstore", 100
+            )
+        self.assertEqual(len(result[1]), 2)
+        self.assertEqual(result[2:], [[], 2, True])
+
+    def test_3(self):
+        router, switch = cmd_process.cmd_process(
+            "LIST_PRODUCT_SINCE", "0", "127.0.0.1:33500", "Syncstore", 0
+            )[1].column("product_id")
+        with mock.patch.object(model, "TOMBSTONE_LIMIT", 1):
+            for product_id in (router, switch):
+                cmd_process.cmd_process(
+                    "MERCHANT_DEL_PRODUCT", "1", "127.0.0.1:33500",
+                    product_id
+                    )
+            # The deletion of the router is forgotten, so a client that has
+            # not seen it reloads the whole list
+            outdated = cmd_process.cmd_process(
+                "LIST_PRODUCT_SINCE", "2", "127.0.0.1:33500", "Syncstore", 2
+                )
+            current = cmd_process.cmd_process(
+                "LIST_PRODUCT_SINCE", "3", "127.0.0.1:33500", "Syncstore", 4
+                )
+        self.assertEqual(cmd_process.session.query(
+            model.ProductTombstone.product_id).join(
+                cmd_process.Merchant).filter(
+                    cmd_process.Merchant.storename == "Syncstore").all(),
+            [(switch,)])
+        self.assertEqual(len(outdated[1]), 0)
+        self.assertEqual(outdated[2:], [[], 4, True])
+        self.assertEqual(current[2:], [[], 4, False])
+
+
+class TestPaging(unittest.TestCase):
+    def setUp(cls):
+        pagestore = cmd_process.Merchant(
+            storename="Pagestore",
+            description="",
+            email="pagestore@cybermarket.com",
+            password="123456"
+        )
+        cmd_process.session.add(pagestore)
+        cmd_process.session.commit()
+        cmd_process.cmd_process(
+            "MERCHANT_LOGIN", "8000", "127.0.0.1:33600", "Pagestore", "123456"
+            )
+        for name, price in (("cable", 2.0), ("adapter", 1.0), ("bridge", 2.0),
+                            ("dongle", 1.0), ("extender", 3.0)):
+            cmd_process.cmd_process(
+                "MERCHANT_ADD_PRODUCT", "8001", "127.0.0.1:33600", name,
+                price, ""
+                )
+
+    def tearDown(self):
+        merchant = cmd_process.session.query(cmd_process.Merchant).filter(
+            cmd_process.Merchant.storename == "Pagestore").first()
+        for product in merchant.product:
+            cmd_process.session.delete(product)
+        cmd_process.session.delete(merchant)
+        cmd_process.session.commit()
+        cmd_process.release_connection("127.0.0.1:33600")
+
+    def pages(self, limit, sort):
+        names = []
+        cursor = None
+        while True:
+            result = cmd_process.cmd_process(
+                "LIST_PRODUCT", "0", "127.0.0.1:33600", "Pagestore", limit,
+                cursor, sort
+                )
+            self.assertLessEqual(len(result[1]), limit)
+            names.append([row[2] for row in result[1].rows()])
+            cursor = result[2]
+            if cursor is None:
+                return names
+
+    def test_0(self):
+        self.assertEqual(
+            self.pages(2, "product_id"),
+            [["cable", "adapter"], ["bridge", "dongle"], ["extender"]]
+            )
+
+    def test_1(self):
+        self.assertEqual(
+            self.pages(2, "price"),
+            [["adapter", "dongle"], ["cable", "bridge"], ["extender"]]
+            )
+        self.assertEqual(
+            self.pages(3, "productname"),
+            [["adapter", "bridge", "cable"], ["dongle", "extender"]]
+            )
+
+    def test_2(self):
+        result = cmd_process.cmd_process(
+            "LIST_PRODUCT", "0", "127.0.0.1:33600", "Pagestore", 5
+            )
+        self.assertEqual(len(result[1]), 5)
+        self.assertIsNone(result[2])
+        result = cmd_process.cmd_process(
+            "LIST_PRODUCT", "1", "127.0.0.1:33600", "Pagestore", 5, None,
+            "color"
+            )
+        self.assertEqual(
+            result, ["1 400 Bad Request: Unknown sort key"]
+            )
+
+    def test_3(self):
+        result = cmd_process.cmd_process(
+            "LIST_MERCHANT", "0", "127.0.0.1:33600", 1
+            )
+        self.assertEqual(len(result[1]), 1)
+        storenames = result[1].column("storename")
+        while result[2] is not None:
+            result = cmd_process.cmd_process(
+                "LIST_MERCHANT", "0", "127.0.0.1:33600", 1, result[2]
+                )
+            storenames += result[1].column("storename")
+        self.assertEqual(storenames, sorted(storenames))
+        self.assertIn("Pagestore", storenames)
+
+    def test_4(self):
+        expected_result = [
+            "0 400 Bad Request: The page size should be an integer"
+            ]
+        self.assertEqual(cmd_process.cmd_process(
+            "LIST_PRODUCT", "0", "127.0.0.1:33600", "Pagestore", "ten"
+            ), expected_result)
+        self.assertEqual(cmd_process.cmd_process(
+            "LIST_MERCHANT", "0", "127.0.0.1:33600", None
+            ), expected_result)
+
+
+class TestSearchProduct(unittest.TestCase):
+    def setUp(cls):
+        searchstore = cmd_process.Merchant(
+            storename="Searchstore",
+            description="",
+            email="searchstore@cybermarket.com",
+            password="123456"
+        )
+        cmd_process.session.add(searchstore)
+        cmd_process.session.commit()
+        cmd_process.cmd_process(
+            "MERCHANT_LOGIN", "8000", "127.0.0.1:33700", "Searchstore",
+            "123456"
+            )
+        for name, price, description in (
+                ("Gigabit router", 10.0, "Dual band"),
+                ("Patch cable", 2.0, "Cat6, for any router"),
+                ("Switch", 5.0, "Eight gigabit ports")):
+            cmd_process.cmd_process(
+                "MERCHANT_ADD_PRODUCT", "8001", "127.0.0.1:33700", name,
+                price, description
+                )
+
+    def tearDown(self):
+        merchant = cmd_process.session.query(cmd_process.Merchant).filter(
+            cmd_process.Merchant.storename == "Searchstore").first()
+        for product in merchant.product:
+            cmd_process.session.delete(product)
+        cmd_process.session.query(model.ProductTombstone).filter(
+            model.ProductTombstone.merchant_id
+            == merchant.merchantId).delete()
+        cmd_process.session.delete(merchant)
+        cmd_process.session.commit()
+        cmd_process.release_connection("127.0.0.1:33700")
+
+    def search(self, *args):
+        result = cmd_process.cmd_process(
+            "SEARCH_PRODUCT", "0", "127.0.0.1:33700", *args
+            )
+        return [row[2] for row in result[1].rows()]
+
+    def test_0(self):
+        self.assertEqual(
+            self.search("rout"), ["Gigabit router", "Patch cable"]
+            )
+        self.assertEqual(
+            self.search("giga"), ["Gigabit router", "Switch"]
+            )
+        self.assertEqual(self.search("gigabit ROUTER"), ["Gigabit router"])
+        if setting.engine.dialect.name == "sqlite":
+            # Not taken as an FTS5 query, other backends have no index
+            self.assertEqual(self.search('router" OR *'), [])
+
+    def test_1(self):
+        self.assertEqual(
+            self.search("rout", {"max_price": 5.0}), ["Patch cable"]
+            )
+        self.assertEqual(
+            self.search("giga", {"storename": "Searchstore",
+                                 "min_price": 6.0}),
+            ["Gigabit router"]
+            )
+        self.assertEqual(self.search("giga", {"in_stock": True}), [])
+
+    def test_2(self):
+        names = []
+        cursor = None
+        while True:
+            result = cmd_process.cmd_process(
+                "SEARCH_PRODUCT", "0", "127.0.0.1:33700", "giga", None, 1,
+                cursor
+                )
+            names += [row[2] for row in result[1].rows()]
+            cursor = result[2]
+            if cursor is None:
+                break
+        self.assertEqual(names, ["Gigabit router", "Switch"])
+
+    def test_3(self):
+        product = cmd_process.session.query(cmd_process.Product).filter(
+            cmd_process.Product.productname == "Switch").first()
+        product.set_productname("Hub")
+        cmd_process.session.commit()
+        self.assertEqual(self.search("switch"), [])
+        self.assertEqual(self.search("hub"), ["Hub"])
+        cmd_process.cmd_process(
+            "MERCHANT_DEL_PRODUCT", "1", "127.0.0.1:33700", product.productId
+            )
+        self.assertEqual(self.search("hub"), [])
+
+    def test_4(self):
+        self.assertEqual(
+            cmd_process.cmd_process(
+                "SEARCH_PRODUCT", "1", "127.0.0.1:33700", "?!"
+                ),
+            ["1 400 Bad Request: Nothing to search"]
+            )
+        self.assertEqual(
+            cmd_process.cmd_process(
+                "SEARCH_PRODUCT", "2", "127.0.0.1:33700", "router",
+                {"colour": "red"}
+                ),
+            ["2 400 Bad Request: Unknown search filter"]
+            )
+
+    def test_5(self):
+        for filters in ({"min_price": "cheap"}, {"max_price": None},
+                        {"in_stock": "yes"}):
+            self.assertEqual(
+                cmd_process.cmd_process(
+                    "SEARCH_PRODUCT", "1", "127.0.0.1:33700", "router",
+                    filters
+                    ),
+                ["1 400 Bad Request: The value of a search filter is "
+                 "invalid"]
+                )
+
+    def test_6(self):
+        self.assertEqual(
+            cmd_process.cmd_process(
+                "SEARCH_PRODUCT", "1", "127.0.0.1:33700", "router", None,
+                "all"
+                ),
+            ["1 400 Bad Request: The page size should be an integer"]
+            )
+
+
+class TestInventory(unittest.TestCase):
+    def setUp(cls):
+        cls.ttl = mock.patch.object(model, "RESERVATION_TTL", 60)
+        cls.ttl.start()
+        stockstore = cmd_process.Merchant(
+            storename="Stockstore",
+            description="",
+            email="stockstore@cybermarket.com",
+            password="123456"
+        )
+        cmd_process.session.add(stockstore)
+        cmd_process.session.commit()
+        cmd_process.cmd_process(
+            "MERCHANT_LOGIN", "8000", "127.0.0.1:33800", "Stockstore",
+            "123456"
+            )
+        cmd_process.cmd_process(
+            "MERCHANT_ADD_PRODUCT", "8001", "127.0.0.1:33800", "router",
+            10.0, ""
+            )
+        cls.product_id = cmd_process.session.query(
+            cmd_process.Product.productId).filter(
+            cmd_process.Product.productname == "router").scalar()
+        cmd_process.cmd_process(
+            "MERCHANT_RESTOCK_PRODUCT", "8002", "127.0.0.1:33800",
+            cls.product_id, 3
+            )
+        cmd_process.cmd_process(
+            "CLIENT_CREATE", "8003", "127.0.0.1:33801", "stockclient",
+            "stockclient@cybermarket.com", "123456"
+            )
+        cmd_process.cmd_process(
+            "CLIENT_LOGIN", "8004", "127.0.0.1:33801", "stockclient",
+            "123456"
+            )
+
+    def tearDown(self):
+        self.ttl.stop()
+        client = cmd_process.session.query(cmd_process.Client).filter(
+            cmd_process.Client.username == "stockclient").first()
+        cmd_process.session.query(cmd_process.Order).filter(
+            cmd_process.Order.client_id == client.clientId).delete()
+        cmd_process.session.delete(client)
+        merchant = cmd_process.session.query(cmd_process.Merchant).filter(
+            cmd_process.Merchant.storename == "Stockstore").first()
+        for product in merchant.product:
+            cmd_process.session.delete(product)
+        cmd_process.session.delete(merchant)
+        cmd_process.session.commit()
+        cmd_process.release_connection("127.0.0.1:33800")
+        cmd_process.release_connection("127.0.0.1:33801")
+
+    def add(self, quantity):
+        return cmd_process.cmd_process(
+            "CLIENT_ADD_ITEM", "0", "127.0.0.1:33801", self.product_id,
+            quantity
+            )
+
+    def stock_and_cart(self):
+        cmd_process.session.expire_all()
+        stock = cmd_process.session.get(
+            cmd_process.Product, self.product_id).stock
+        order = cmd_process.session.query(cmd_process.Order).filter(
+            cmd_process.Order.product_id == self.product_id).first()
+        if order is None:
+            return [stock, None]
+        return [stock, [order.quantity, order.reserved]]
+
+    def test_0(self):
+        self.add(2)
+        self.assertEqual(self.stock_and_cart(), [1, [2, 2]])
+        self.assertEqual(
+            self.add(2),
+            ["0 400 Bad Request: Not enough stock for this product"]
+            )
+        self.assertEqual(self.stock_and_cart(), [1, [2, 2]])
+
+    def test_1(self):
+        self.add(2)
+        cmd_process.cmd_process(
+            "CLIENT_CHECKOUT_ITEM", "1", "127.0.0.1:33801"
+            )
+        self.assertEqual(self.stock_and_cart(), [1, None])
+
+    def test_2(self):
+        self.add(2)
+        self.assertEqual(inventory.release_expired(time.time()), 0)
+        self.assertEqual(inventory.release_expired(time.time() + 120), 1)
+        self.assertEqual(self.stock_and_cart(), [3, [2, 0]])
+        cmd_process.cmd_process(
+            "CLIENT_CHECKOUT_ITEM", "1", "127.0.0.1:33801"
+            )
+        self.assertEqual(self.stock_and_cart(), [1, None])
+
+    def test_3(self):
+        self.add(2)
+        cmd_process.cmd_process(
+            "CLIENT_REMOVE_ITEM", "1", "127.0.0.1:33801", self.product_id
+            )
+        self.assertEqual(self.stock_and_cart(), [3, None])
+
+    def test_4(self):
+        product = cmd_process.session.get(cmd_process.Product, self.product_id)
+        self.assertFalse(product.adjust_stock(-4))
+        self.assertTrue(product.adjust_stock(-3))
+        self.assertEqual(product.stock, 0)
+        cmd_process.session.rollback()
+        with mock.patch.object(model, "RESERVATION_TTL", 0):
+            self.add(3)
+            self.assertEqual(self.stock_and_cart(), [3, [3, 0]])
+            # Sold elsewhere between the check and the update of a checkout
+            next_version = model.next_catalog_version
+
+            def sell_one(session, merchant_id):
+                stock = cmd_process.Product.__table__.c.stock
+                session.execute(sqlalchemy.update(
+                    cmd_process.Product.__table__).values(stock=stock - 1))
+                return next_version(session, merchant_id)
+
+            with mock.patch.object(model, "next_catalog_version",
+                                   side_effect=sell_one), \
+                    mock.patch.object(model, "checkout_shortage",
+                                      wraps=model.checkout_shortage) as error:
+                result = cmd_process.cmd_process(
+                    "CLIENT_CHECKOUT_ITEM", "1", "127.0.0.1:33801"
+                    )
+            self.assertIn("400 Bad Request", result[0])
+            error.assert_called_once()
+            self.assertEqual(self.stock_and_cart(), [3, [3, 0]])
+
+    def test_5(self):
+        self.add(2)
+        # The reservation expires between the read and the update of a
+        # checkout, the first attempt must not take the stock it released
+        next_version = model.next_catalog_version
+        released = []
+
+        def release(session, merchant_id):
+            if not released:
+                order = cmd_process.Order.__table__
+                product = cmd_process.Product.__table__
+                session.execute(sqlalchemy.update(order).values(
+                    reserved=0, reserved_until=None))
+                session.execute(sqlalchemy.update(product).values(
+                    stock=product.c.stock + 2))
+                released.append(True)
+            return next_version(session, merchant_id)
+
+        with mock.patch.object(model, "next_catalog_version",
+                               side_effect=release):
+            result = cmd_process.cmd_process(
+                "CLIENT_CHECKOUT_ITEM", "1", "127.0.0.1:33801"
+                )
+        self.assertEqual(result, ["1 200 OK: Order has been checked out"])
+        self.assertEqual(self.stock_and_cart(), [1, None])
+
+    def test_6(self):
+        self.add(2)
+        order = cmd_process.session.query(cmd_process.Order).filter(
+            cmd_process.Order.product_id == self.product_id).one()
+        # Checked out or released elsewhere since it was loaded
+        cmd_process.session.execute(sqlalchemy.update(
+            cmd_process.Order.__table__).values(reserved=0))
+        self.assertEqual(order.release(), 0)
+        cmd_process.session.commit()
+        self.assertEqual(self.stock_and_cart(), [1, [2, 0]])
+
+
+class TestServerConfig(unittest.TestCase):
+    def setUp(cls):
+        cls.directory = tempfile.TemporaryDirectory()
+        cls.path = os.path.join(cls.directory.name, "server.toml")
+        with open(cls.path, "w") as file:
+            file.write('[server]\nport = 1\nbacklog = 7\nhost = "0.0.0.0"\n')
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def test_0(self):
+        result = config.load_config([], {})
+        self.assertEqual(
+            [result.host, result.port, result.read_size, result.tcp_nodelay],
+            ["127.0.0.1", 22333, 65536, True]
+            )
+
+    def test_1(self):
+        result = config.load_config(
+            ["--config", self.path, "--port", "3", "--no-tcp-nodelay"],
+            {"CYBERMARKET_PORT": "2", "CYBERMARKET_BACKLOG": "8",
+             "CYBERMARKET_READ_SIZE": "1024"}
+            )
+        self.assertEqual(
+            [result.host, result.port, result.backlog, result.read_size,
+             result.tcp_nodelay],
+            ["0.0.0.0", 3, 8, 1024, False]
+            )
+        self.assertEqual(
+            [result.sources["host"], result.sources["backlog"],
+             result.sources["port"]],
+            [self.path, "environment", "command line"]
+            )
+
+    def test_2(self):
+        self.assertEqual(
+            config.load_config(
+                [], {"CYBERMARKET_CONFIG": self.path}).backlog, 7
+            )
+        with self.assertRaises(ValueError):
+            config.load_config([], {"CYBERMARKET_TCP_NODELAY": "maybe"})
+        with self.assertRaises(ValueError):
+            config.load_config([], {"CYBERMARKET_EVENT_LOOP": "trio"})
+        result = config.load_config(["--event-loop", "asyncio"], {})
+        self.assertEqual(config.event_loop_factory(result), ("asyncio", None))
+
+    def test_3(self):
+        result = config.load_config(
+            ["--port", "0", "--receive-buffer", "65536"], {}
+            )
+        sock = config.create_listener(result)
+        try:
+            self.assertNotEqual(sock.getsockname()[1], 0)
+            self.assertGreaterEqual(
+                sock.getsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF), 65536
+                )
+        finally:
+            sock.close()
+
+
+class TestHandleClient(unittest.TestCase):
+    def setUp(cls):
+        cls.config = mock.patch.object(server, "config", config.ServerConfig())
+        cls.config.start()
+
+    def tearDown(self):
+        self.config.stop()
+
+    def serve(self, client):
+        async def run():
+            listener = await asyncio.start_server(
+                server.handle_client, "127.0.0.1", 0)
+            port = listener.sockets[0].getsockname()[1]
+            async with listener:
+                result = await client(port)
+                # Let the connections finish their cleanup
+                for _ in range(100):
+                    if not server.connect_list:
+                        break
+                    await asyncio.sleep(0.01)
+                return result
+        return asyncio.run(run())
+
+    async def call(self, reader, writer, *message):
+        writer.write(protocol.encode_frame(pickle.dumps(message)))
+        header = await reader.readexactly(4)
+        (length,) = protocol.HEADER.unpack(header)
+        return pickle.loads(await reader.readexactly(length))
+
+    def test_0(self):
+        async def client(port):
+            reader, writer = await asyncio.open_connection("127.0.0.1", port)
+            reply = await self.call(reader, writer, "PING", "1")
+            writer.close()
+            return reply
+        self.assertEqual(self.serve(client), ["1 200 OK"])
+        self.assertEqual(server.connect_list, {})
+
+    def test_1(self):
+        server.config.idle_timeout = 0.1
+
+        async def client(port):
+            reader, writer = await asyncio.open_connection("127.0.0.1", port)
+            await self.call(reader, writer, "PING", "1")
+            closed = await asyncio.wait_for(reader.read(), 5)
+            writer.close()
+            return closed
+        self.assertEqual(self.serve(client), b"")
+        self.assertEqual(server.connect_list, {})
+
+    def test_2(self):
+        server.config.read_timeout = 0.1
+
+        async def client(port):
+            reader, writer = await asyncio.open_connection("127.0.0.1", port)
+            writer.write(protocol.HEADER.pack(10) + b"abc")
+            closed = await asyncio.wait_for(reader.read(), 5)
+            writer.close()
+            return closed
+        self.assertEqual(self.serve(client), b"")
+
+    def test_3(self):
+        server.config.max_connections = 1
+
+        async def client(port):
+            first = await asyncio.open_connection("127.0.0.1", port)
+            await self.call(*first, "PING", "1")
+            reader, writer = await asyncio.open_connection("127.0.0.1", port)
+            refused = await asyncio.wait_for(reader.read(), 5)
+            first[1].close()
+            writer.close()
+            return refused
+        self.assertEqual(self.serve(client), b"")
+
+    def test_4(self):
+        async def client(port):
+            reader, writer = await asyncio.open_connection("127.0.0.1", port)
+            writer.write(protocol.encode_frame(b"not a request"))
+            closed = await asyncio.wait_for(reader.read(), 5)
+            writer.close()
+            return closed
+        self.assertEqual(self.serve(client), b"")
+        self.assertEqual(server.connect_list, {})
+
+    def test_5(self):
+        async def client(port):
+            reader, writer = await asyncio.open_connection("127.0.0.1", port)
+            # Pipelined requests, answered in one write
+            writer.write(b"".join(
+                protocol.encode_frame(pickle.dumps(("PING", str(i))))
+                for i in range(20)))
+            decoder = protocol.FrameDecoder()
+            frames = []
+            while len(frames) < 20:
+                data = await asyncio.wait_for(reader.read(65536), 5)
+                frames += decoder.feed(data)
+            writer.close()
+            return [pickle.loads(frame)[0] for frame in frames]
+        self.assertEqual(self.serve(client),
+                         [f"{i} 200 OK" for i in range(20)])
+
+    def test_6(self):
+        server.config.send_queue = 1
+        server.config.slow_consumer = "disconnect"
+
+        async def client(port):
+            reader, writer = await asyncio.open_connection("127.0.0.1", port)
+            await self.call(reader, writer, "PING", "0")
+            box = next(iter(server.connect_list.values()))
+            box.push(["PUSH"])
+            box.push(["PUSH"])
+            await asyncio.wait_for(reader.read(), 5)
+            writer.close()
+            return box.closed
+        self.assertTrue(self.serve(client))
+        self.assertEqual(server.connect_list, {})
+
+    def test_7(self):
+        server.config.rate_limit = 0.001
+        server.config.rate_burst = 1
+
+        async def client(port):
+            reader, writer = await asyncio.open_connection("127.0.0.1", port)
+            first = await self.call(reader, writer, "LIST_MERCHANT", "0")
+            second = await self.call(reader, writer, "LIST_MERCHANT", "1")
+            writer.close()
+            return first[0], second[0]
+        self.assertEqual(self.serve(client), (
+            "0 200 OK",
+            "1 429 Too Many Requests: Too many requests, please slow down"))
+
+    @unittest.skipUnless(os.name == "posix", "SIGTERM needs POSIX")
+    def test_8(self):
+        async def run():
+            sock = socket.create_server(("127.0.0.1", 0))
+            port = sock.getsockname()[1]
+            serving = asyncio.create_task(server.main(sock, 1))
+            reader, writer = await asyncio.open_connection("127.0.0.1", port)
+            reply = await self.call(reader, writer, "PING", "1")
+            os.kill(os.getpid(), signal.SIGTERM)
+            closed = await asyncio.wait_for(reader.read(), 5)
+            await asyncio.wait_for(serving, 5)
+            writer.close()
+            return reply, closed
+        with mock.patch.object(server.pool, "shutdown"):
+            self.assertEqual(asyncio.run(run()), (["1 200 OK"], b""))
+        self.assertEqual(server.connect_list, {})
+        self.assertEqual(server.clients, {})